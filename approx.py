@@ -0,0 +1,346 @@
+import math
+import random
+import time
+from itertools import product
+from statistics import median
+from cnf import ClauseStore, BudgetExceeded
+import ddnnf
+
+SMALL_COMPONENT = 12 # components with at most this many variables are counted and sampled by trying every assignment
+
+def threshold(epsilon: float) -> int:
+    '''Cell size of ApproxMC for a tolerance epsilon: cells with fewer models than this are counted exactly.'''
+    return math.ceil(1 + 9.84 * (1 + epsilon / (1 + epsilon)) * (1 + 1 / epsilon) ** 2)
+
+def repetitions(delta: float) -> int:
+    '''Number of hashed counts whose median is within the tolerance with probability at least 1 - delta.'''
+    return math.ceil(17 * math.log2(3 / delta))
+
+def decompose(store: ClauseStore):
+    '''
+    Unit propagation followed by a split of the remaining clauses into components that share no variable, so that
+    every component is counted on its own and the counts multiply. Returns (units {var id: bool}, [component clauses]),
+    or None if propagation falsifies a clause.
+    '''
+    units = {}
+    clauses = list(store)
+    while True:
+        remaining, changed = [], False
+        for clause in clauses:
+            if any(units.get(abs(lit)) == (lit > 0) for lit in clause):
+                continue
+            left = tuple(lit for lit in clause if abs(lit) not in units)
+            if not left:
+                return None
+            if len(left) == 1:
+                units[abs(left[0])] = left[0] > 0
+                changed = True
+            else:
+                remaining.append(left)
+        clauses = remaining
+        if not changed:
+            break
+    parent = {}
+    def find(v):
+        while parent.setdefault(v, v) != v:
+            parent[v] = parent[parent[v]]
+            v = parent[v]
+        return v
+    for clause in clauses:
+        for lit in clause[1:]:
+            parent[find(abs(lit))] = find(abs(clause[0]))
+    groups = {}
+    for clause in clauses:
+        groups.setdefault(find(abs(clause[0])), []).append(clause)
+    return units, list(groups.values())
+
+def _support(clauses) -> list:
+    return sorted({abs(lit) for clause in clauses for lit in clause})
+
+def _store(varmap, clauses) -> ClauseStore:
+    '''A store of clauses with a copy of varmap, so that hash constraints and their auxiliary variables do not leak out.'''
+    store = ClauseStore(varmap.copy())
+    for clause in clauses:
+        store.add_clause(clause)
+    return store
+
+def _assignments(clauses, var_ids):
+    '''Every model of a small component as {var id: bool}, by trying every assignment of var_ids.'''
+    for values in product((False, True), repeat=len(var_ids)):
+        model = dict(zip(var_ids, values))
+        if all(any(model[abs(lit)] == (lit > 0) for lit in clause) for clause in clauses):
+            yield model
+
+def add_xor(store: ClauseStore, var_ids, parity: bool) -> None:
+    '''
+    Adds var_ids[0] xor var_ids[1] xor ... = parity as clauses, chaining the variables through auxiliary
+    variables t_i = t_(i-1) xor v_i so that each link takes four clauses.
+    '''
+    var_ids = list(var_ids)
+    if not var_ids:
+        if parity: # 0 = 1
+            contradiction = store.pos(("xor", store.num_clauses))
+            store.add(contradiction)
+            store.add(-contradiction)
+        return
+    acc = var_ids[0]
+    for v in var_ids[1:]:
+        t = store.pos(("xor", store.num_clauses, v))
+        store.add(-t, acc, v)
+        store.add(-t, -acc, -v)
+        store.add(t, -acc, v)
+        store.add(t, acc, -v)
+        acc = t
+    store.add(acc if parity else -acc)
+
+def _check(deadline) -> None:
+    if deadline is not None and time.perf_counter() > deadline:
+        raise BudgetExceeded("The approximate count ran out of time.")
+
+def enumerate_models(store: ClauseStore, var_ids, limit: int, portfolio=None, deadline=None) -> list:
+    '''
+    Up to limit models {var id: bool} of store that differ on var_ids, found by SAT calls that block every model found so
+    far. Raises BudgetExceeded once time.perf_counter() passes deadline.
+    '''
+    blocked = _store(store.varmap, store)
+    models = []
+    while len(models) < limit:
+        _check(deadline)
+        model = blocked.solve(portfolio)
+        if model is None:
+            break
+        model = {v: model.get(blocked.varmap.names[v], False) for v in var_ids}
+        models.append(model)
+        blocked.add_clause([-v if value else v for v, value in model.items()])
+    return models
+
+def _random_hash(var_ids, m: int, rng) -> list:
+    '''m random XOR constraints (variables, parity), every variable taken with probability 1/2.'''
+    return [([v for v in var_ids if rng.random() < 0.5], rng.random() < 0.5) for _ in range(m)]
+
+def _cell(store: ClauseStore, xors) -> ClauseStore:
+    cell = _store(store.varmap, store)
+    for var_ids, parity in xors:
+        add_xor(cell, var_ids, parity)
+    return cell
+
+def _smallest_hash(small, n: int, start: int) -> int:
+    '''
+    Smallest m in 1..n for which small(m) holds, small being monotone and false at 0, by galloping from start and then
+    bisecting (the search of ApproxMC2). n if small never holds.
+    '''
+    lo, hi = 0, n
+    m = min(max(start, 1), n)
+    step = 1
+    if small(m):
+        hi = m
+        while hi - step > lo:
+            if not small(hi - step):
+                lo = hi - step
+                break
+            hi = hi - step
+            step *= 2
+    else:
+        lo = m
+        while lo + step < hi:
+            if small(lo + step):
+                hi = lo + step
+                break
+            lo = lo + step
+            step *= 2
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if small(mid):
+            hi = mid
+        else:
+            lo = mid
+    return hi
+
+def _cells(store: ClauseStore, var_ids, epsilon, delta, rng, portfolio, iterations, deadline=None) -> list:
+    '''
+    The cells of ApproxMC on one component, [(models of the cell, m)] for a cell cut out by m random XOR constraints,
+    one per repetition, so that every model is in a cell with probability 2^-m; [(every model, 0)] if there are few.
+    Past deadline, the cells of the repetitions done so far, or BudgetExceeded if there are none.
+    '''
+    limit = threshold(epsilon)
+    models = enumerate_models(store, var_ids, limit, portfolio, deadline)
+    if len(models) < limit:
+        return [(models, 0)]
+    cells = []
+    start = 1
+    for _ in range(iterations or repetitions(delta)):
+        xors = _random_hash(var_ids, len(var_ids), rng) # prefix hashing: the cell of m constraints uses the first m
+        found = {}
+        def small(m):
+            if m not in found:
+                found[m] = enumerate_models(_cell(store, xors[:m]), var_ids, limit, portfolio, deadline)
+            return len(found[m]) < limit
+        try:
+            m = _smallest_hash(small, len(var_ids), start)
+            small(m)
+        except BudgetExceeded:
+            if not cells:
+                raise
+            break
+        start = m
+        if found[m]:
+            cells.append((found[m], m))
+    return cells
+
+def _count_component(store: ClauseStore, var_ids, epsilon, delta, rng, portfolio, iterations, deadline=None) -> int:
+    '''ApproxMC on one component: the median over the repetitions of cell size * number of cells.'''
+    cells = _cells(store, var_ids, epsilon, delta, rng, portfolio, iterations, deadline)
+    return round(median(len(models) << m for models, m in cells)) if cells else 0
+
+def approx_count(store: ClauseStore, epsilon: float = 0.8, delta: float = 0.2, rng=None, portfolio=None, iterations: int = None, memo: dict = None, deadline: float = None) -> int:
+    '''
+    Number of models of store over every variable of its VarMap, within a factor (1 + epsilon) of the exact count with
+    probability at least 1 - delta (ApproxMC). The theory is decomposed first; small components are counted exactly, and
+    in a large one random XOR constraints split the models into cells whose models are enumerated with the SAT backend.
+    The tolerance is shared out so that the product of the component counts keeps the bound. iterations overrides the
+    number of repetitions given by delta. memo keeps the counts of large components by their clauses over variable names,
+    for theories that share most of their clauses (e.g. the moves of evaluate_moves). Past deadline (a time.perf_counter()
+    value) a component keeps the repetitions done so far; BudgetExceeded is raised if one has none.
+    '''
+    rng = rng or random.Random()
+    decomposition = decompose(store)
+    if decomposition is None:
+        return 0
+    units, components = decomposition
+    used = len(units) + sum(len(_support(component)) for component in components)
+    total = 1 << (len(store.varmap) - used)
+    large = [component for component in components if len(_support(component)) > SMALL_COMPONENT]
+    component_epsilon = (1 + epsilon) ** (1 / max(len(large), 1)) - 1
+    component_delta = delta / max(len(large), 1)
+    for component in components:
+        var_ids = _support(component)
+        if len(var_ids) <= SMALL_COMPONENT:
+            total *= sum(1 for model in _assignments(component, var_ids))
+        else:
+            names = store.varmap.names
+            key = frozenset(frozenset((names[abs(lit)], lit > 0) for lit in clause) for clause in component)
+            count = memo.get(key) if memo is not None else None
+            if count is None:
+                count = _count_component(_store(store.varmap, component), var_ids, component_epsilon, component_delta, rng, portfolio, iterations, deadline)
+                if memo is not None:
+                    memo[key] = count
+            total *= count
+        if total == 0:
+            return 0
+    return total
+
+def _component_sampler(store: ClauseStore, var_ids, epsilon, rng, portfolio, deadline=None):
+    '''
+    Function drawing near-uniform models of one component (UniGen): a random cell of about pivot models is picked with
+    XOR constraints, its models are enumerated and one of them is chosen uniformly; cells outside [lo, hi] are rejected.
+    The models are enumerated once when there are few of them, and the cell size is chosen once from an approximate count.
+    '''
+    pivot = math.ceil(4.03 * (1 + 1 / epsilon) ** 2)
+    hi = 1 + math.ceil(1.41 * (1 + epsilon) * pivot)
+    lo = pivot / (1.41 * (1 + epsilon))
+    models = enumerate_models(store, var_ids, hi + 1, portfolio, deadline)
+    if len(models) <= hi: # few models: sample them exactly
+        return lambda: rng.choice(models) if models else None
+    count = _count_component(store, var_ids, epsilon, 0.2, rng, portfolio, 3, deadline)
+    q = max(1, math.ceil(math.log2(max(count, 1) / pivot)))
+    def draw():
+        for attempt in range(20):
+            for m in (q - 1, q, q + 1):
+                if m < 1:
+                    continue
+                cell_models = enumerate_models(_cell(store, _random_hash(var_ids, m, rng)), var_ids, hi + 1, portfolio, deadline)
+                if lo <= len(cell_models) <= hi:
+                    return rng.choice(cell_models)
+        return None
+    return draw
+
+def sample(store: ClauseStore, num_samples: int = 1, epsilon: float = 0.8, rng=None, portfolio=None) -> list:
+    '''
+    Near-uniform models {name: bool} of store. Every component of the decomposition is sampled on its own, exactly
+    from its models when it is small and with UniGen otherwise; variables in no clause are set uniformly at random.
+    Returns num_samples models, or fewer if the theory has no model (or UniGen keeps rejecting cells).
+    '''
+    rng = rng or random.Random()
+    decomposition = decompose(store)
+    if decomposition is None:
+        return []
+    units, components = decomposition
+    names = store.varmap.names
+    samplers = []
+    for component in components:
+        var_ids = _support(component)
+        if len(var_ids) <= SMALL_COMPONENT:
+            models = list(_assignments(component, var_ids))
+            samplers.append(lambda models=models: rng.choice(models) if models else None)
+        else:
+            samplers.append(_component_sampler(_store(store.varmap, component), var_ids, epsilon, rng, portfolio))
+    samples = []
+    for _ in range(num_samples):
+        model = {v: rng.random() < 0.5 for v in range(1, len(names))}
+        model.update(units)
+        for draw in samplers:
+            part = draw()
+            if part is None:
+                return samples
+            model.update(part)
+        samples.append({names[v]: value for v, value in model.items()})
+    return samples
+
+def size_polynomial(store: ClauseStore, groups: dict, limits, epsilon: float = 0.8, delta: float = 0.2, rng=None, portfolio=None,
+                    iterations: int = None, memo: dict = None, deadline: float = None) -> dict:
+    '''
+    approx_count by sizes: the polynomial {sizes: count} of ddnnf.size_polynomial, the number of models of store with
+    sizes[i] true variables of group i ({name: i}), up to limits, without cardinality constraints in the theory (their
+    counters would join every component into one). Units, free variables and small components are counted exactly by
+    sizes. A large component is counted by the cells of ApproxMC: the models of a cell of m XOR constraints, by sizes,
+    times 2^m estimate its polynomial, averaged over the repetitions. memo and deadline are as in approx_count.
+    '''
+    if min(limits, default=0) < 0:
+        return {}
+    rng = rng or random.Random()
+    decomposition = decompose(store)
+    if decomposition is None:
+        return {}
+    units, components = decomposition
+    names = store.varmap.names
+    group_of = {v: groups[names[v]] for v in range(1, len(names)) if names[v] in groups}
+    def sizes_of(model) -> tuple:
+        sizes = [0] * len(limits)
+        for v, value in model.items():
+            if value and v in group_of:
+                sizes[group_of[v]] += 1
+        return tuple(sizes)
+    def histogram(models) -> dict:
+        poly = {}
+        for model in models:
+            key = sizes_of(model)
+            poly[key] = poly.get(key, 0) + 1
+        return poly
+    poly = ddnnf.multiply({(0,) * len(limits): 1}, {sizes_of(units): 1}, limits)
+    used = set(units).union(*(_support(component) for component in components))
+    for v in range(1, len(names)):
+        if v not in used: # a free variable doubles the count, and may or may not count towards its group
+            poly = ddnnf.multiply(poly, histogram([{v: False}, {v: True}]), limits)
+    large = [component for component in components if len(_support(component)) > SMALL_COMPONENT]
+    component_epsilon = (1 + epsilon) ** (1 / max(len(large), 1)) - 1
+    component_delta = delta / max(len(large), 1)
+    for component in components:
+        var_ids = _support(component)
+        if len(var_ids) <= SMALL_COMPONENT:
+            part = histogram(_assignments(component, var_ids))
+        else:
+            key = ('sizes', frozenset(frozenset((names[abs(lit)], lit > 0) for lit in clause) for clause in component))
+            part = memo.get(key) if memo is not None else None
+            if part is None:
+                cells = _cells(_store(store.varmap, component), var_ids, component_epsilon, component_delta, rng, portfolio, iterations, deadline)
+                part = {}
+                for models, m in cells:
+                    for sizes, n in histogram(models).items():
+                        part[sizes] = part.get(sizes, 0) + (n << m)
+                part = {sizes: round(total / len(cells)) for sizes, total in part.items()}
+                if memo is not None:
+                    memo[key] = part
+        poly = ddnnf.multiply(poly, part, limits)
+        if not poly:
+            return {}
+    return {sizes: count for sizes, count in poly.items() if count}
@@ -0,0 +1,116 @@
+import json
+import mmap
+import os
+import struct
+import tempfile
+import numpy as np
+import nnf
+from cnf import VarMap, ClauseStore
+
+MAGIC = b'BASETHY1'
+LIT, AND, OR = 0, 1, 2 # node kinds of the flattened d-DNNF
+
+def flatten(sentence: nnf.NNF, varmap: VarMap):
+    '''
+    The d-DNNF as arrays, children before parents and the root last: kinds, args (the literal +id/-id of a leaf),
+    and the children of node i in children[offsets[i]:offsets[i+1]] as node indices.
+    '''
+    index = {}
+    kinds, args, offsets, children = [], [], [0], []
+    stack = [(sentence, False)]
+    while stack:
+        node, expanded = stack.pop()
+        if id(node) in index:
+            continue
+        if isinstance(node, nnf.Var):
+            kinds.append(LIT)
+            args.append(varmap.var(node.name) * (1 if node.true else -1))
+        elif not expanded:
+            stack.append((node, True))
+            stack.extend((child, False) for child in node.children if id(child) not in index)
+            continue
+        else:
+            kinds.append(AND if isinstance(node, nnf.And) else OR)
+            args.append(0)
+            children.extend(index[id(child)] for child in node.children)
+        offsets.append(len(children))
+        index[id(node)] = len(kinds) - 1
+    return [np.array(a, dtype=np.int32) for a in (kinds, args, offsets, children)]
+
+def save(path: str, config: dict, store: ClauseStore, sentence: nnf.NNF) -> None:
+    '''
+    Writes the base theory of a deck configuration: a JSON header (config and the array lengths), then the flat clause
+    array of store and the flattened d-DNNF as int32 arrays, which BaseTheory maps into memory without parsing.
+    '''
+    arrays = [np.asarray(store.lits, dtype=np.int32)] + flatten(sentence, store.varmap)
+    header = dict(config, num_vars=len(store.varmap), num_clauses=store.num_clauses, lengths=[len(a) for a in arrays])
+    text = json.dumps(header).encode()
+    text += b' ' * (-(len(MAGIC) + 4 + len(text)) % 4) # the arrays start 4-byte aligned
+    # a temporary file of its own, so that processes building the same file at once do not write into each other's
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(MAGIC + struct.pack('<I', len(text)) + text)
+            for a in arrays:
+                f.write(a.astype('<i4').tobytes())
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+class BaseTheory:
+    '''
+    A base theory file mapped into memory. lits is the flat clause array of the CNF and kinds/args/offsets/children the
+    d-DNNF, all numpy views of the mapping; nothing is parsed beyond the header until a theory is built from them.
+    '''
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a base theory file.")
+        (size,) = struct.unpack_from('<I', self._map, len(MAGIC))
+        start = len(MAGIC) + 4
+        self.header = json.loads(self._map[start:start+size])
+        offset = start + size
+        arrays = []
+        for length in self.header['lengths']:
+            arrays.append(np.frombuffer(self._map, dtype='<i4', count=length, offset=offset))
+            offset += 4 * length
+        self.lits, self.kinds, self.args, self.offsets, self.children = arrays
+
+    def store(self, varmap: VarMap) -> ClauseStore:
+        '''A ClauseStore holding the base clauses, over varmap, which must number the variables as when the file was built.'''
+        assert len(varmap) >= self.header['num_vars'], "The VarMap does not match the base theory."
+        store = ClauseStore(varmap)
+        store.lits.frombytes(self.lits.astype(np.int32).tobytes())
+        store.num_clauses = self.header['num_clauses']
+        return store
+
+    def sentence(self, names) -> nnf.NNF:
+        '''The d-DNNF over the variable names (names[i] is the name of id i), marked deterministic and decomposable.'''
+        nodes = []
+        kinds, args, offsets, children = (a.tolist() for a in (self.kinds, self.args, self.offsets, self.children))
+        for i, kind in enumerate(kinds):
+            if kind == LIT:
+                nodes.append(nnf.Var(names[abs(args[i])], args[i] > 0))
+            else:
+                members = [nodes[c] for c in children[offsets[i]:offsets[i+1]]]
+                nodes.append(nnf.And(members) if kind == AND else nnf.Or(members))
+        result = nodes[-1]
+        result.mark_deterministic()
+        nnf.NNF.decomposable.set(result, True)
+        return result
+
+if __name__ == "__main__":
+    # build step: precompiles the base theory of the deck configuration of run.py, or of --ranks N --suits ABCD
+    import argparse
+    import run
+    from bitboard import CardLayout
+    parser = argparse.ArgumentParser(description="Precompiles the base (card placement) theory of a deck configuration.")
+    parser.add_argument('--ranks', type=int, default=None, help="ranks 1..N, the ranks of run.py by default")
+    parser.add_argument('--suits', default=None, help="suit letters, the suits of run.py by default")
+    args = parser.parse_args()
+    ranks = range(1, args.ranks + 1) if args.ranks else run.RANKS
+    suits = tuple(args.suits) if args.suits else run.SUITS
+    path = run.build_base_theory(CardLayout(ranks, suits))
+    print("Wrote", path, f"({os.path.getsize(path)} bytes)")
@@ -0,0 +1,112 @@
+import numpy as np
+from bitboard import CardLayout
+
+# winner codes of BatchGames.winner
+PLAYING, PLAYER, OPPONENT, DRAW = 0, 1, 2, 3
+WINNERS = {PLAYER: 'player', OPPONENT: 'opponent', DRAW: 'draw'}
+
+def _highest_bit(masks: np.ndarray) -> np.ndarray:
+    '''Index of the highest bit of every uint64 mask (-1 for 0). Exact while the masks stay below 2**53.'''
+    mantissas, exponents = np.frexp(masks.astype(np.float64))
+    return exponents.astype(np.int64) - 1
+
+class BatchGames:
+    '''
+    N games of the heuristic play of run.play_round advanced in lockstep. The hands are kept as one uint64 bitboard of
+    the layout per game and seat, the packed form of an (N, cards) ownership matrix, so CardLayout.melds finds the melds
+    and wanting masks of every game with one pass of array operations. decks is an (N, num_cards) array of card indices
+    (LAYOUT.index) in dealing order: hands of hand_size cards for the player and then the opponent, then the face up card.
+    '''
+    def __init__(self, layout: CardLayout, decks: np.ndarray, hand_size: int):
+        assert layout.num_cards <= 53, "Bitboards of more than 53 cards do not fit in the float mantissa used by _highest_bit."
+        self.layout = layout
+        self.decks = np.asarray(decks, dtype=np.int64)
+        n = len(self.decks)
+        self.rows = np.arange(n)
+        bits = np.left_shift(np.uint64(1), self.decks.astype(np.uint64))
+        self.player = np.bitwise_or.reduce(bits[:, :hand_size], axis=1)
+        self.opponent = np.bitwise_or.reduce(bits[:, hand_size:2*hand_size], axis=1)
+        self.top = self.decks[:, 2*hand_size].copy() # card index of the face up card
+        self.deck_index = np.full(n, 2*hand_size + 1)
+        self.rounds = np.zeros(n, dtype=np.int64)
+        self.winner = np.full(n, PLAYING, dtype=np.int8)
+
+    @classmethod
+    def shuffled(cls, layout: CardLayout, n: int, hand_size: int, seed=None) -> 'BatchGames':
+        '''n games dealt from independent shuffles of the deck, reproducible with seed.'''
+        rng = np.random.default_rng(seed)
+        decks = rng.permuted(np.tile(np.arange(layout.num_cards), (n, 1)), axis=1)
+        return cls(layout, decks, hand_size)
+
+    def ownership(self) -> np.ndarray:
+        '''(N, num_cards) matrix: 1 where the player holds the card, 2 where the opponent holds it, 0 elsewhere.'''
+        shifts = np.arange(self.layout.num_cards, dtype=np.uint64)
+        player = (self.player[:, None] >> shifts) & np.uint64(1)
+        opponent = (self.opponent[:, None] >> shifts) & np.uint64(1)
+        return (player + 2 * opponent).astype(np.int8)
+
+    def _card_bits(self, cards: np.ndarray) -> np.ndarray:
+        return np.left_shift(np.uint64(1), cards.astype(np.uint64))
+
+    def _next_card(self, games: np.ndarray) -> np.ndarray:
+        return self.decks[games, np.minimum(self.deck_index[games], self.layout.num_cards - 1)]
+
+    def step(self) -> int:
+        '''Plays one round of every game still running, the same way as run.play_round. Returns the number of games still running.'''
+        g = self.rows[self.winner == PLAYING]
+        if len(g) == 0:
+            return 0
+        num_cards = self.layout.num_cards
+        player, opponent = self.player[g], self.opponent[g]
+        opp_melds = self.layout.melds(opponent)
+        pl_melds = self.layout.melds(player)
+        # game over checks, in the order of play_round
+        draw = self.deck_index[g] >= num_cards
+        opp_won = ~draw & (opp_melds.remaining == 0) & (opp_melds.potential == 0)
+        pl_won = ~draw & ~opp_won & (pl_melds.remaining == 0) & (pl_melds.potential == 0)
+        self.winner[g[draw]] = DRAW
+        self.winner[g[opp_won]] = OPPONENT
+        self.winner[g[pl_won]] = PLAYER
+        playing = ~(draw | opp_won | pl_won)
+        g, player, opponent = g[playing], player[playing], opponent[playing]
+        pl_melds = type(pl_melds)(*(field[playing] for field in pl_melds))
+        opp_melds = type(opp_melds)(*(field[playing] for field in opp_melds))
+
+        # player: pick up the face up card if it is wanted, otherwise draw; then discard from the hand before the pick up
+        top_bits = self._card_bits(self.top[g])
+        pick = (top_bits & pl_melds.wanted) != 0
+        player = player | np.where(pick, top_bits, self._card_bits(self._next_card(g)))
+        self.deck_index[g] += ~pick
+        pl_discard = _highest_bit(np.where(pl_melds.remaining != 0, pl_melds.remaining, pl_melds.potential))
+        player = player & ~self._card_bits(pl_discard)
+
+        # opponent: the same with the player's discard, the game is a draw if it has to draw from an empty deck
+        discard_bits = self._card_bits(pl_discard)
+        pick = (discard_bits & opp_melds.wanted) != 0
+        empty = ~pick & (self.deck_index[g] >= num_cards)
+        opponent = opponent | np.where(pick, discard_bits, self._card_bits(self._next_card(g)))
+        self.deck_index[g] += ~pick & ~empty
+        opp_discard = _highest_bit(np.where(opp_melds.remaining != 0, opp_melds.remaining, opp_melds.potential))
+        opponent = opponent & ~self._card_bits(opp_discard)
+
+        self.winner[g[empty]] = DRAW
+        done = ~empty
+        g = g[done]
+        self.player[g], self.opponent[g], self.top[g] = player[done], opponent[done], opp_discard[done]
+        self.rounds[g] += 1
+        return len(g)
+
+    def run(self, max_rounds=None) -> None:
+        '''Steps until every game is over, or max_rounds rounds (the unfinished games keep the winner PLAYING).'''
+        while (max_rounds is None or self.rounds.max(initial=0) < max_rounds) and self.step():
+            pass
+
+    def stats(self) -> dict:
+        '''Win rates and the distribution of the game lengths (in rounds) of the batch.'''
+        n = max(len(self.winner), 1)
+        return {
+            'games': len(self.winner),
+            'win_rates': {name: float(np.count_nonzero(self.winner == code)) / n for code, name in WINNERS.items()},
+            'mean_rounds': float(self.rounds.mean()) if len(self.rounds) else 0.0,
+            'rounds_histogram': np.bincount(self.rounds).tolist(),
+        }
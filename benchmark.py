@@ -0,0 +1,193 @@
+import argparse
+import hashlib
+import itertools
+import json
+import platform
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import run
+import ddnnf
+from compile_cache import version_stamp
+
+# the phases of one decision, timed separately: meld analysis of the hand, CNF encoding, dsharp compilation,
+# model counting on the d-DNNF, kissat solving, and extraction of a model from the d-DNNF into card vectors
+PHASES = ('melds', 'encode', 'compile', 'count', 'solve', 'extract')
+SUIT_LETTERS = 'ABCDEFGH'
+DEFAULT_GRID = {'ranks': (6, 9), 'suits': (3, 4), 'hand': (7, 10), 'rounds': (0, 4, 8), 'encoding': ('direct',)}
+DEFAULT_SEEDS = (1, 2)
+
+def _cards(cards) -> list:
+    return [tuple(card) for card in cards]
+
+def record_history(seed: int, rounds: int) -> dict:
+    '''Plays the game of seed for up to rounds rounds in the current configuration and records the state the player decides on.'''
+    game = run.Game(seed)
+    opp_pickup, opp_not_pickup, opp_discard = [], [], []
+    while game.rounds < rounds:
+        observation = game.play_round()
+        if observation is None:
+            break
+        (picked, card), discard = observation
+        (opp_pickup if picked else opp_not_pickup).append(card)
+        opp_discard.append(discard)
+    return {'seed': seed, 'rounds': game.rounds, 'deck': game.deck, 'player_cards': list(game.player_cards),
+            'face_up': game.discard_pile_top_card, 'opp_pickup': opp_pickup, 'opp_not_pickup': opp_not_pickup, 'opp_discard': opp_discard}
+
+def history_digest(history: dict) -> str:
+    '''Short hash of a recorded history, which tells whether two results measured the same workload.'''
+    return hashlib.sha256(json.dumps(history, sort_keys=True).encode()).hexdigest()[:16]
+
+def _best(function, repeat: int):
+    '''Fastest of repeat calls of function (the least disturbed by the rest of the machine) and its result.'''
+    best, result = None, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best, result
+
+def run_case(case: dict, repeat: int = 3, history: dict = None) -> dict:
+    '''
+    Measures one case, {ranks, suits, hand, rounds, seed, encoding}: the game of seed is played for rounds rounds (or
+    history is replayed) and every phase of the decision on its state is timed, the theory written with the meld encoding
+    of the case (run.MELD_ENCODING, "direct" if the case has none). Meant to run in a process of its own, since it
+    reconfigures run and the peak memory is that of the process (and of its largest dsharp/kissat child).
+    '''
+    run.configure(range(1, case['ranks'] + 1), SUIT_LETTERS[:case['suits']], case['hand'])
+    history = history or record_history(case['seed'], case['rounds'])
+    run.deck = _cards(history['deck'])
+    player_cards = _cards(history['player_cards'])
+    observations = tuple(_cards(history[key]) for key in ('opp_pickup', 'opp_not_pickup', 'opp_discard'))
+    run.load_base_theory() # made by the build step in production, so it is not timed
+    seconds = {}
+    seconds['melds'], _ = _best(lambda: run.meld_list_generator(player_cards), repeat)
+    seconds['encode'], store = _best(lambda: run.example_cnf(player_cards, *observations, meld_encoding=case.get('encoding', 'direct')), repeat)
+    seconds['compile'], sentence = _best(store.compile, repeat)
+    seconds['count'], model_count = _best(lambda: ddnnf.count(sentence), repeat)
+    seconds['solve'], _ = _best(store.solve, repeat)
+    seconds['extract'], _ = _best(lambda: run.MODEL_VIEW.vectors(ddnnf.solve(sentence)), repeat) if model_count else (0.0, None)
+    return {
+        'case': case,
+        'history': history,
+        'history_digest': history_digest(history),
+        'variables': len(store.varmap),
+        'clauses': store.num_clauses,
+        'model_count': model_count,
+        'seconds': seconds,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'peak_solver_rss_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    }
+
+def grid_cases(grid: dict = None, seeds=DEFAULT_SEEDS) -> list:
+    '''Every case of the grid {ranks, suits, hand, rounds, encoding: values} and seeds, leaving out decks too small to deal.'''
+    grid = dict(DEFAULT_GRID, **(grid or {}))
+    cases = []
+    for ranks, suits, hand, rounds, seed, encoding in itertools.product(grid['ranks'], grid['suits'], grid['hand'], grid['rounds'], seeds, grid['encoding']):
+        if 2 * hand < ranks * suits:
+            cases.append({'ranks': ranks, 'suits': suits, 'hand': hand, 'rounds': rounds, 'seed': seed, 'encoding': encoding})
+    return cases
+
+def run_cases(cases, repeat: int = 3, histories=None):
+    '''Measures the cases one after another, each in a fresh process. histories replays recorded histories, one per case. Yields the results.'''
+    histories = histories or [None] * len(cases)
+    for case, history in zip(cases, histories):
+        with ProcessPoolExecutor(1) as pool: # a pool per case, so that no case inherits the caches or peak RSS of another
+            yield pool.submit(run_case, case, repeat, history).result()
+
+def _key(case: dict) -> tuple:
+    return tuple(case[field] for field in ('ranks', 'suits', 'hand', 'rounds', 'seed')) + (case.get('encoding', 'direct'),)
+
+def compare_encodings(results, metrics=('variables', 'clauses', 'compile', 'solve')) -> list:
+    '''
+    The meld encodings side by side: for every case measured with both "direct" and "ladder", the ratio ladder / direct
+    of the theory size and of the dsharp (compile) and kissat (solve) times. Returns one {case, metric: ratio} per case.
+    '''
+    by_encoding = {}
+    for result in results:
+        key = _key(result['case'])
+        by_encoding.setdefault(key[:-1], {})[key[-1]] = result
+    def value(result, metric):
+        return result['seconds'][metric] if metric in PHASES else result[metric]
+    rows = []
+    for pair in by_encoding.values():
+        if 'direct' in pair and 'ladder' in pair:
+            direct, ladder = pair['direct'], pair['ladder']
+            row = {'case': {field: value for field, value in direct['case'].items() if field != 'encoding'}}
+            for metric in metrics:
+                row[metric] = value(ladder, metric) / value(direct, metric) if value(direct, metric) else float('inf')
+            rows.append(row)
+    return rows
+
+def compare(results, baseline, threshold: float = 0.25, min_seconds: float = 0.005, min_kb: int = 4096) -> list:
+    '''
+    Regressions of results against the results of a baseline: a phase or peak memory more than threshold (relative) over
+    the baseline, and by more than the noise floor min_seconds or min_kb, or a different model count on the same history.
+    Returns one {case, metric, baseline, current} per regression.
+    '''
+    previous = {_key(result['case']): result for result in baseline}
+    regressions = []
+    def check(result, metric, old, new, floor):
+        if new > old * (1 + threshold) and new - old > floor:
+            regressions.append({'case': result['case'], 'metric': metric, 'baseline': old, 'current': new})
+    for result in results:
+        old = previous.get(_key(result['case']))
+        if old is None or old['history_digest'] != result['history_digest']:
+            continue # a new case, or another workload: nothing to compare with
+        if old['model_count'] != result['model_count']:
+            regressions.append({'case': result['case'], 'metric': 'model_count', 'baseline': old['model_count'], 'current': result['model_count']})
+        for phase in PHASES:
+            check(result, phase, old['seconds'][phase], result['seconds'][phase], min_seconds)
+        for metric in ('peak_rss_kb', 'peak_solver_rss_kb'):
+            check(result, metric, old[metric], result[metric], min_kb)
+    return regressions
+
+def environment() -> dict:
+    return {'python': sys.version.split()[0], 'platform': platform.platform(), 'dsharp': version_stamp()}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the phases of a decision over a grid of deck sizes, hand sizes and game lengths.")
+    parser.add_argument('--ranks', type=int, nargs='+', default=DEFAULT_GRID['ranks'])
+    parser.add_argument('--suits', type=int, nargs='+', default=DEFAULT_GRID['suits'])
+    parser.add_argument('--hand', type=int, nargs='+', default=DEFAULT_GRID['hand'], help="NUM_OF_CARDS values")
+    parser.add_argument('--rounds', type=int, nargs='+', default=DEFAULT_GRID['rounds'], help="rounds played before the decision")
+    parser.add_argument('--seeds', type=int, nargs='+', default=DEFAULT_SEEDS)
+    parser.add_argument('--encodings', nargs='+', choices=('direct', 'ladder'), default=DEFAULT_GRID['encoding'],
+                        help="meld encodings; with both, the sizes and times of ladder / direct are reported for every case, "
+                             "e.g. --ranks 13 --suits 4 8 --encodings direct ladder for a 52-card deck and a 104-card one")
+    parser.add_argument('--repeat', type=int, default=3, help="runs of every phase, the fastest counts")
+    parser.add_argument('--out', help="write the results as JSON, e.g. to record a baseline")
+    parser.add_argument('--compare', help="baseline JSON: replays its recorded histories and reports regressions")
+    parser.add_argument('--threshold', type=float, default=0.25, help="relative slowdown or memory growth reported as a regression")
+    args = parser.parse_args()
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        cases, histories = [result['case'] for result in baseline], [result['history'] for result in baseline]
+    else:
+        cases = grid_cases({'ranks': args.ranks, 'suits': args.suits, 'hand': args.hand, 'rounds': args.rounds, 'encoding': args.encodings}, args.seeds)
+        histories = None
+    results = []
+    for result in run_cases(cases, args.repeat, histories):
+        results.append(result)
+        case, seconds = result['case'], result['seconds']
+        print(f"{case['ranks']}x{case['suits']} hand {case['hand']} round {result['history']['rounds']} seed {case['seed']} "
+              f"{case.get('encoding', 'direct')} ({result['variables']} vars, {result['clauses']} clauses): "
+              + ' '.join(f"{phase} {seconds[phase]*1000:.1f}ms" for phase in PHASES) + f" peak {result['peak_rss_kb']//1024}MB", flush=True)
+    for row in compare_encodings(results):
+        case = row['case']
+        print(f"ladder/direct {case['ranks']}x{case['suits']} hand {case['hand']} round {case['rounds']} seed {case['seed']}: "
+              + ' '.join(f"{metric} {row[metric]:.2f}" for metric in row if metric != 'case'))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump({'environment': environment(), 'results': results}, f, indent=1)
+    if baseline is not None:
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print("REGRESSION", regression['case'], regression['metric'], regression['baseline'], "->", regression['current'])
+        print(f"{len(regressions)} regressions past {args.threshold:.0%}")
+        sys.exit(1 if regressions else 0)
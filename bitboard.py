@@ -0,0 +1,178 @@
+from itertools import combinations
+from collections import namedtuple
+
+# Result of CardLayout.melds(), every field is a bitboard of cards
+Melds = namedtuple('Melds', ['existing', 'remaining', 'wanted', 'potential', 'run_cards', 'set_ranks'])
+
+class CardLayout:
+    '''
+    Maps every (rank, suit) of a deck to one bit of an integer, so that a hand, the deck or the discard pile is a bitboard.
+    Bits are stored suit by suit and by rank inside a suit: bit (suit_index * len(ranks) + rank_index) is card (rank, suit).
+    The ranks must be consecutive integers, e.g. RANKS = (1,2,...,9).
+    '''
+    def __init__(self, ranks, suits):
+        self.ranks = tuple(ranks)
+        self.suits = tuple(suits)
+        assert self.ranks == tuple(range(self.ranks[0], self.ranks[0] + len(self.ranks))), "Ranks must be consecutive."
+        n = len(self.ranks)
+        self.num_ranks = n
+        self.num_cards = n * len(self.suits)
+        self.full = (1 << self.num_cards) - 1
+        self.rank_word = (1 << n) - 1 # the ranks of one suit
+        self.repunit = sum(1 << (s * n) for s in range(len(self.suits))) # rank_word * repunit copies a rank word into every suit
+        self.low_edge = self.repunit # lowest rank of every suit
+        self.high_edge = self.repunit << (n - 1) # highest rank of every suit
+        self.not_high = self.full & ~self.high_edge # masks without negative ints, so that melds also runs on numpy uint64 arrays
+        self.not_low = self.full & ~self.low_edge
+        self.suit_masks = tuple(self.rank_word << (s * n) for s in range(len(self.suits)))
+        self.rank_masks = tuple(self.repunit << r for r in range(n))
+        self.cards = tuple((rank, suit) for suit in self.suits for rank in self.ranks) # card of every bit index
+        self._bits = {card: 1 << index for index, card in enumerate(self.cards)}
+
+    def bit(self, card) -> int:
+        return self._bits[card]
+
+    def index(self, card) -> int:
+        '''Bit index of card, also its position in cards and in arrays indexed by card.'''
+        return self._bits[card].bit_length() - 1
+
+    def to_mask(self, cards) -> int:
+        mask = 0
+        for card in cards:
+            mask |= self._bits[card]
+        return mask
+
+    def to_cards(self, mask: int) -> list:
+        '''List view of a bitboard, ordered by suit and then by rank.'''
+        cards = []
+        while mask:
+            low = mask & -mask
+            cards.append(self.cards[low.bit_length() - 1])
+            mask ^= low
+        return cards
+
+    def highest(self, mask: int):
+        '''The card of the highest bit in mask (the last card of to_cards), or None.'''
+        return self.cards[mask.bit_length() - 1] if mask else None
+
+    def above(self, mask: int) -> int:
+        '''Moves every card one rank up inside its suit.'''
+        return (mask & self.not_high) << 1
+
+    def below(self, mask: int) -> int:
+        '''Moves every card one rank down inside its suit.'''
+        return (mask & self.not_low) >> 1
+
+    def melds(self, hand: int) -> Melds:
+        '''
+        Finds the melds of a hand with shift/AND word operations, by the rules of the list-based meld_list_generator:
+          existing  - runs of 3+ consecutive ranks in a suit, and sets of 3+ suits of a rank among the cards left after runs
+          potential - two consecutive ranks of a suit holding 3+ cards, unless a higher card of the suit follows them, and
+                      two suits of a rank among the cards left after runs (which may also be in a run's potential pair)
+          remaining - cards that are neither in an existing nor a potential meld
+          wanted    - the rank below a run or a potential run and, unless it is the suit's last segment, the rank above it
+                      when that is not the top rank; the other suits of a potential set, even if they are held in a run
+        run_cards holds the cards of the existing runs, set_ranks is a rank word (bit r = rank index r) of the existing sets.
+        hand can also be a numpy uint64 array of bitboards, which gives the melds of every hand in one pass.
+        '''
+        # RUNS are only looked for in the suits holding 3+ cards, counted with a bit-sliced counter over the ranks
+        ones = twos = three_or_more = 0
+        for r in range(self.num_ranks):
+            word = (hand >> r) & self.repunit
+            three_or_more |= twos & word
+            twos |= ones & word
+            ones |= word
+        runs = hand & (three_or_more * self.rank_word)
+        # pair marks r when r and r+1 are held, triple marks r when r, r+1 and r+2 are held
+        pair = runs & self.below(runs)
+        triple = pair & self.below(pair)
+        in_run = triple | self.above(triple) | self.above(self.above(triple))
+        pair_start = pair & ~in_run # segments of exactly two cards
+        followed = 0 # cards with a higher card of their suit in the hand
+        lower = runs
+        for _ in range(self.num_ranks - 1):
+            lower = self.below(lower)
+            followed |= lower
+        pair_start &= self.below(followed) # the suit's last segment is not a potential run
+        run_pairs = pair_start | self.above(pair_start)
+        starts = (in_run | run_pairs) & ~self.above(in_run | run_pairs)
+        ends = (in_run | run_pairs) & ~self.below(in_run | run_pairs) & followed
+        wanted = self.below(starts) | (self.above(ends) & self.not_high)
+        # SETS: count the suits held of every rank with a bit-sliced counter over the suit words
+        rest = hand & ~in_run
+        ones = twos = three_or_more = 0
+        for s in range(len(self.suits)):
+            word = (rest >> (s * self.num_ranks)) & self.rank_word
+            three_or_more |= twos & word
+            twos |= ones & word
+            ones |= word
+        in_set = rest & (three_or_more * self.repunit)
+        set_pairs = rest & ((twos & ~three_or_more) * self.repunit)
+        wanted |= ((twos & ~three_or_more) * self.repunit) & ~rest
+
+        existing = in_run | in_set
+        potential = run_pairs | set_pairs
+        remaining = hand & ~existing & ~potential
+        return Melds(existing, remaining, wanted, potential, in_run, three_or_more)
+
+    def meld_lists(self, hand: int):
+        '''
+        List-of-tuples view of melds(hand): [existing_meld_list, remaining_cards, wanting_list, potential_meld_list],
+        where an existing run is (suit, [ranks]) and an existing set is (rank, {suits}).
+        '''
+        m = self.melds(hand)
+        existing_meld_list = []
+        starts = m.run_cards & ~self.above(m.run_cards)
+        while starts:
+            low = starts & -starts
+            rank, suit = self.cards[low.bit_length() - 1]
+            run = []
+            while low & m.run_cards:
+                run.append(rank + len(run))
+                low = self.above(low)
+            existing_meld_list.append((suit, run))
+            starts &= starts - 1
+        for r in range(self.num_ranks):
+            if m.set_ranks >> r & 1:
+                existing_meld_list.append((self.ranks[r], {suit for rank, suit in self.to_cards(m.existing & ~m.run_cards & self.rank_masks[r])}))
+        return existing_meld_list, self.to_cards(m.remaining), self.to_cards(m.wanted), self.to_cards(m.potential)
+
+class MeldCatalogue:
+    '''
+    Every legal meld of a deck configuration, built once: sets of 3+ suits of a rank and runs of 3+ consecutive ranks of a suit.
+    A meld id indexes members (its cards) and masks (its bitboard); by_card is the inverted index card -> ids of the melds containing it.
+    '''
+    def __init__(self, layout: CardLayout):
+        self.layout = layout
+        self.members = []
+        self.masks = []
+        for rank in layout.ranks:
+            for size in range(3, len(layout.suits) + 1):
+                for suits in combinations(layout.suits, size):
+                    self._add(tuple((rank, suit) for suit in suits))
+        for suit in layout.suits:
+            for low in range(layout.num_ranks):
+                for high in range(low + 2, layout.num_ranks):
+                    self._add(tuple((rank, suit) for rank in layout.ranks[low:high+1]))
+        by_card = {card: [] for card in layout.cards}
+        for meld_id, cards in enumerate(self.members):
+            for card in cards:
+                by_card[card].append(meld_id)
+        self.by_card = {card: tuple(ids) for card, ids in by_card.items()}
+        # the 3-card melds are enough to say whether a card can be melded: every larger meld contains one with the same card
+        self.smallest_by_card = {card: tuple(i for i in ids if len(self.members[i]) == 3) for card, ids in self.by_card.items()}
+
+    def _add(self, cards: tuple) -> None:
+        self.members.append(cards)
+        self.masks.append(self.layout.to_mask(cards))
+
+    def __len__(self) -> int:
+        return len(self.members)
+
+    def completions(self, card) -> list:
+        '''For every 3-card meld containing card, the other two cards the hand needs to make it.'''
+        return [tuple(c for c in self.members[i] if c != card) for i in self.smallest_by_card[card]]
+
+    def melds_in(self, hand: int) -> list:
+        '''Ids of the catalogued melds fully contained in the bitboard hand.'''
+        return [i for i, mask in enumerate(self.masks) if hand & mask == mask]
@@ -0,0 +1,301 @@
+import math
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, namedtuple
+from array import array
+import nnf
+from nnf import dsharp
+
+# bundled solvers: bin/dsharp of this repository and the kissat binary shipped with nnf, unless they are on the PATH
+DSHARP = shutil.which('dsharp') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bin', 'dsharp')
+KISSAT = shutil.which('kissat') or os.path.join(os.path.dirname(os.path.abspath(nnf.__file__)), 'bin', 'kissat')
+
+# backends raced by a Portfolio: name -> command, which gets the path of a DIMACS file and answers like kissat
+# (exit code 10 with "v" lines for a model, 20 if unsatisfiable). "native" is the pure Python solver of nnf, run by this module.
+PORTFOLIO_BACKENDS = {
+    'kissat': [KISSAT, '-q'],
+    'kissat-seed-1': [KISSAT, '-q', '--seed=1'],
+    'native': [sys.executable, os.path.abspath(__file__)],
+}
+# backends whose models a Portfolio checks against the clauses before trusting them, by default
+UNTRUSTED_BACKENDS = ('native',)
+
+# limits of a dsharp compilation: wall-clock seconds and size of the d-DNNF output in bytes, None for no limit
+Budget = namedtuple('Budget', ['seconds', 'nnf_bytes'], defaults=(None, None))
+
+class BudgetExceeded(RuntimeError):
+    '''Raised when a dsharp compilation runs over its Budget.'''
+
+PORTFOLIO = None # a Portfolio that ClauseStore.solve races, instead of running kissat alone
+
+class VarMap:
+    '''
+    Numbers the variables of a theory 1..n for DIMACS. The propositions of card_props are numbered first, class by class
+    and in the card order of the layout, so their ids are the same in every game with the same deck configuration.
+    Other variables (melds, auxiliary variables) get the next free id when they are first used.
+    '''
+    def __init__(self, layout=None, card_props=()):
+        self.names = [None] # id -> name, id 0 is the clause terminator
+        self.ids = {}
+        for prop in card_props:
+            for card in layout.cards:
+                self.var(prop(card[0], card[1]))
+
+    def var(self, name) -> int:
+        '''The id of name, a proposition or any hashable auxiliary name.'''
+        try:
+            return self.ids[name]
+        except KeyError:
+            self.ids[name] = len(self.names)
+            self.names.append(name)
+            return len(self.names) - 1
+
+    def name(self, var_id: int):
+        return self.names[abs(var_id)]
+
+    def __len__(self) -> int:
+        return len(self.names) - 1
+
+    def copy(self) -> 'VarMap':
+        other = VarMap()
+        other.names = list(self.names)
+        other.ids = dict(self.ids)
+        return other
+
+class ClauseStore:
+    '''
+    A CNF theory stored as integer literals in one flat array('i'), each clause terminated by 0 like a DIMACS file.
+    Literals are +id/-id of a VarMap, so no nnf objects are built while the theory is encoded.
+    '''
+    def __init__(self, varmap: VarMap):
+        self.varmap = varmap
+        self.lits = array('i')
+        self.num_clauses = 0
+        self.defined = set() # auxiliary variables whose defining clauses are already in the store
+
+    def add(self, *lits) -> None:
+        self.add_clause(lits)
+
+    def add_clause(self, lits) -> None:
+        self.lits.extend(lits)
+        self.lits.append(0)
+        self.num_clauses += 1
+
+    def pos(self, name) -> int:
+        return self.varmap.var(name)
+
+    def neg(self, name) -> int:
+        return -self.varmap.var(name)
+
+    def __len__(self) -> int:
+        return self.num_clauses
+
+    def __iter__(self):
+        clause = []
+        for lit in self.lits:
+            if lit == 0:
+                yield tuple(clause)
+                clause = []
+            else:
+                clause.append(lit)
+
+    def named(self):
+        '''The clauses as tuples of (name, value) literals, which do not depend on the VarMap.'''
+        names = self.varmap.names
+        for clause in self:
+            yield tuple((names[abs(lit)], lit > 0) for lit in clause)
+
+    def add_named(self, clause) -> None:
+        self.add_clause([self.pos(name) if value else self.neg(name) for name, value in clause])
+
+    def copy(self) -> 'ClauseStore':
+        '''A copy that shares the VarMap, for adding the clauses of different moves to the same base.'''
+        other = ClauseStore(self.varmap)
+        other.lits = array('i', self.lits)
+        other.num_clauses = self.num_clauses
+        other.defined = set(self.defined)
+        return other
+
+    def dimacs(self) -> str:
+        lines = [f"p cnf {len(self.varmap)} {self.num_clauses}"]
+        lines.extend(' '.join(map(str, clause)) + ' 0' for clause in self)
+        return '\n'.join(lines) + '\n'
+
+    def to_nnf(self) -> nnf.And:
+        '''The theory as an nnf CNF sentence over the variable names, for the bauhaus/nnf utilities.'''
+        names = self.varmap.names
+        return nnf.And([nnf.Or([nnf.Var(names[abs(lit)], lit > 0) for lit in clause]) for clause in self])
+
+    def solve(self, portfolio=None):
+        '''
+        Runs kissat on the clauses, or races the backends of portfolio (by default the module's PORTFOLIO, if set).
+        Returns a model {name: bool} or None if the theory is unsatisfiable.
+        '''
+        portfolio = portfolio or PORTFOLIO
+        if portfolio is not None:
+            return portfolio.solve(self)
+        proc = subprocess.run([KISSAT], input=self.dimacs(), stdout=subprocess.PIPE, universal_newlines=True)
+        return parse_solver_output(proc.returncode, proc.stdout, self.varmap.names, 'kissat')
+
+    def satisfiable(self) -> bool:
+        return self.solve() is not None
+
+    def compile(self, smooth: bool = True, cache=None, budget: Budget = None) -> nnf.NNF:
+        '''
+        Compiles the clauses to d-DNNF with dsharp, over the variable names. With a CompileCache, a theory compiled before
+        is loaded from disk. Raises BudgetExceeded if dsharp runs over budget.
+        '''
+        if cache is not None:
+            return cache.compile(self, smooth, budget)
+        out, log = run_dsharp(self.dimacs(), smooth, budget=budget)
+        return load_dsharp(out, log, self.varmap.names)
+
+    def model_count(self, cache=None) -> int:
+        '''Number of models over every variable of the VarMap.'''
+        if cache is None and not self.satisfiable(): # dsharp can miss trivially unsatisfiable theories, the cache checks on a miss
+            return 0
+        return self.compile(smooth=True, cache=cache).model_count()
+
+def parse_solver_output(returncode: int, out: str, names, solver: str):
+    '''Model {name: bool} from the output of a SAT competition style solver, None if it answered unsatisfiable.'''
+    if returncode == 20:
+        return None
+    if returncode != 10:
+        raise RuntimeError("{} failed with code {}. Log:\n\n{}".format(solver, returncode, out))
+    model = {}
+    for line in out.split('\n'):
+        if line.startswith('v '):
+            for lit in map(int, line[2:].split()):
+                if lit != 0:
+                    model[names[abs(lit)]] = lit > 0
+    return model
+
+def satisfies(store: 'ClauseStore', model: dict) -> bool:
+    '''Whether the model {name: bool} makes every clause of store true, the variables it leaves out being false.'''
+    names = store.varmap.names
+    return all(any(model.get(names[abs(lit)], False) == (lit > 0) for lit in clause) for clause in store)
+
+class Portfolio:
+    '''
+    Races several SAT backends on the same theory, each in its own process, and returns the first answer, killing the
+    other processes. Wins are recorded per instance class, by default the shape of the theory (log2 buckets of the
+    number of variables and clauses). With learn_after, a class raced that many times only starts the backends that
+    have won it, so the slow ones stop costing a process. The models of the backends in verify (UNTRUSTED_BACKENDS) are
+    checked against the clauses before they win.
+    '''
+    def __init__(self, backends=None, learn_after=None, verify=UNTRUSTED_BACKENDS):
+        self.backends = dict(backends or PORTFOLIO_BACKENDS)
+        self.learn_after = learn_after
+        self.verify = set(verify)
+        self.wins = {} # instance class -> Counter {backend: wins}
+
+    @staticmethod
+    def instance_class(store: 'ClauseStore') -> tuple:
+        return (int(math.log2(len(store.varmap) + 1)), int(math.log2(store.num_clauses + 1)))
+
+    def contenders(self, instance_class) -> list:
+        wins = self.wins.get(instance_class, Counter())
+        if self.learn_after is not None and sum(wins.values()) >= self.learn_after:
+            return [name for name, count in wins.most_common() if name in self.backends]
+        return list(self.backends)
+
+    def solve(self, store: 'ClauseStore', instance_class=None):
+        '''
+        Model {name: bool} of store from the first backend to answer, or None if it is unsatisfiable. A backend that
+        fails (an error code, or a model that does not satisfy the clauses if it is in verify) is dropped from the race,
+        and RuntimeError is raised only when every backend has failed.
+        '''
+        instance_class = instance_class if instance_class is not None else self.instance_class(store)
+        infd, infname = tempfile.mkstemp(text=True)
+        with open(infd, 'w') as f:
+            f.write(store.dimacs())
+        procs, running, failures = {}, [], {}
+        try:
+            for name in self.contenders(instance_class):
+                out = tempfile.TemporaryFile('w+') # a file, not a pipe, so that no solver blocks on a full pipe
+                procs[name] = (subprocess.Popen(self.backends[name] + [infname], stdout=out, stderr=subprocess.DEVNULL), out)
+                running.append(name)
+            delay = 0.0005
+            while running:
+                for name in list(running):
+                    proc, out = procs[name]
+                    if proc.poll() is None:
+                        continue
+                    running.remove(name)
+                    out.seek(0)
+                    try:
+                        model = parse_solver_output(proc.returncode, out.read(), store.varmap.names, name)
+                    except (RuntimeError, ValueError, IndexError) as e:
+                        failures[name] = e
+                        continue
+                    if model is not None and name in self.verify and not satisfies(store, model):
+                        failures[name] = RuntimeError("{} answered a model that does not satisfy the clauses".format(name))
+                        continue
+                    self.wins.setdefault(instance_class, Counter())[name] += 1
+                    return model
+                time.sleep(delay)
+                delay = min(delay * 2, 0.02)
+            raise RuntimeError("Every backend failed:\n\n" + "\n\n".join("{}: {}".format(name, e) for name, e in failures.items()))
+        finally:
+            for proc, out in procs.values():
+                if proc.poll() is None:
+                    proc.kill()
+                proc.wait()
+                out.close()
+            os.remove(infname)
+
+    def stats(self) -> dict:
+        '''{instance class: {backend: wins}}.'''
+        return {instance_class: dict(wins) for instance_class, wins in self.wins.items()}
+
+def run_dsharp(dimacs: str, smooth: bool = True, executable: str = DSHARP, budget: Budget = None):
+    '''Runs dsharp on a DIMACS CNF text. Returns its nnf output and its log. Raises BudgetExceeded if dsharp runs over budget.'''
+    budget = budget or Budget()
+    infd, infname = tempfile.mkstemp(text=True)
+    outfd, outfname = tempfile.mkstemp()
+    os.close(outfd)
+    try:
+        with open(infd, 'w') as f:
+            f.write(dimacs)
+        args = [executable] + (['-smoothNNF'] if smooth else []) + ['-Fnnf', outfname, infname]
+        try:
+            log = subprocess.run(args, stdout=subprocess.PIPE, universal_newlines=True, timeout=budget.seconds).stdout
+        except subprocess.TimeoutExpired:
+            raise BudgetExceeded("dsharp ran over {} seconds".format(budget.seconds))
+        if budget.nnf_bytes is not None and os.path.getsize(outfname) > budget.nnf_bytes:
+            raise BudgetExceeded("the d-DNNF is over {} bytes".format(budget.nnf_bytes))
+        with open(outfname) as f:
+            out = f.read()
+    finally:
+        os.remove(infname)
+        os.remove(outfname)
+    return out, log
+
+def load_dsharp(out: str, log: str, names) -> nnf.NNF:
+    '''Loads the output of run_dsharp as a d-DNNF sentence, where names[i] is the name of variable i.'''
+    if 'Theory is unsat' in log:
+        return nnf.false
+    if not out or out == 'nnf 0 0 0\n':
+        raise RuntimeError("Something went wrong. Log:\n\n{}".format(log))
+    result = dsharp.loads(out, var_labels=dict(enumerate(names)))
+    result.mark_deterministic()
+    nnf.NNF.decomposable.set(result, True)
+    return result
+
+if __name__ == "__main__":
+    # the "native" backend of PORTFOLIO_BACKENDS: solves a DIMACS file with the pure Python solver of nnf
+    from nnf import config, dimacs as nnf_dimacs
+    with open(sys.argv[1]) as f:
+        sentence = nnf_dimacs.load(f)
+    with config(sat_backend="native"):
+        model = sentence.solve()
+    if model is None:
+        print("s UNSATISFIABLE")
+        sys.exit(20)
+    print("s SATISFIABLE")
+    print("v " + " ".join(str(var if value else -var) for var, value in sorted(model.items())) + " 0")
+    sys.exit(10)
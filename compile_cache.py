@@ -0,0 +1,112 @@
+import os
+import hashlib
+import tempfile
+from functools import lru_cache
+import nnf
+from cnf import DSHARP, Budget, ClauseStore, run_dsharp, load_dsharp
+
+@lru_cache(maxsize=None)
+def version_stamp(executable: str = DSHARP) -> str:
+    '''Short hash of the dsharp binary, so that a new dsharp build does not reuse outputs of the old one.'''
+    with open(executable, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()[:16]
+
+def canonical_cnf(store: ClauseStore):
+    '''
+    Canonical DIMACS text of the clauses of store: the variables are renumbered 1..n in the order of their names, so the
+    text does not depend on the order in which ids were handed out, then literals are sorted in each clause, duplicate
+    clauses are removed and the clauses are sorted. Returns the text and names, where names[i] is variable i of the text.
+    '''
+    old_names = store.varmap.names
+    names = [None] + sorted(old_names[1:], key=str)
+    new_id = {store.varmap.ids[name]: i for i, name in enumerate(names) if i > 0}
+    clauses = sorted({tuple(sorted({new_id[lit] if lit > 0 else -new_id[-lit] for lit in clause}, key=lambda lit: (abs(lit), lit)))
+                      for clause in store})
+    lines = [f"p cnf {len(names) - 1} {len(clauses)}"]
+    lines.extend(' '.join(map(str, clause)) + ' 0' for clause in clauses)
+    return '\n'.join(lines) + '\n', names
+
+class CompileCache:
+    '''
+    Content-addressed on-disk cache of dsharp compilations. A theory is keyed by the hash of its canonical CNF, and the
+    dsharp output is stored under a directory named after the dsharp version stamp. The least recently used entries are
+    evicted when the cache grows over max_bytes. hits and misses count the lookups since the cache was created.
+    '''
+    def __init__(self, directory: str, max_bytes: int = 256 * 2**20, executable: str = DSHARP):
+        self.executable = executable
+        self.directory = os.path.join(directory, version_stamp(executable))
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key + '.nnf')
+
+    def compile(self, store: ClauseStore, smooth: bool = True, budget: Budget = None) -> nnf.NNF:
+        '''
+        d-DNNF of the clauses of store over the variable names, from the cache if this CNF was compiled before.
+        A compilation that runs over budget raises BudgetExceeded and is not stored.
+        '''
+        text, names = canonical_cnf(store)
+        key = hashlib.sha256((('smooth\n' if smooth else 'plain\n') + text).encode()).hexdigest()
+        path = self.path(key)
+        try:
+            with open(path) as f:
+                out = f.read()
+            os.utime(path) # most recently used
+            self.hits += 1
+            return load_dsharp(out, '', names) if out else nnf.false
+        except FileNotFoundError:
+            pass
+        self.misses += 1
+        if not store.satisfiable(): # dsharp can miss trivially unsatisfiable theories, stored as an empty entry
+            out, result = '', nnf.false
+        else:
+            out, log = run_dsharp(text, smooth, self.executable, budget)
+            result = load_dsharp(out, log, names) # raises if dsharp failed, before anything is stored
+        self.store(path, out)
+        return result
+
+    def store(self, path: str, out: str) -> None:
+        # a temporary file of its own, so that processes storing the same entry at once do not write into each other's;
+        # other processes never read a partly written entry
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(out)
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        self.evict()
+
+    def evict(self) -> None:
+        '''Removes the least recently used entries until the cache fits in max_bytes.'''
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.nnf'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError: # evicted by another process meanwhile
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'entries': sum(1 for e in os.scandir(self.directory) if e.name.endswith('.nnf'))}
+
+    def clear(self) -> None:
+        for entry in os.scandir(self.directory):
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,292 @@
+from itertools import product
+import nnf
+
+def _post_order(sentence: nnf.NNF) -> list:
+    '''Every node of the sentence once, children before their parents, without recursion.'''
+    order = []
+    seen = set()
+    stack = [(sentence, False)]
+    while stack:
+        node, expanded = stack.pop()
+        if expanded:
+            order.append(node)
+        elif id(node) not in seen:
+            seen.add(id(node))
+            stack.append((node, True))
+            if not isinstance(node, nnf.Var):
+                stack.extend((child, False) for child in node.children)
+    return order
+
+def _counts(sentence: nnf.NNF, assignment: dict, order=None) -> dict:
+    '''Model count of every node, {id(node): count}, with the variables of assignment fixed.'''
+    counts = {}
+    for node in order if order is not None else _post_order(sentence):
+        if isinstance(node, nnf.Var):
+            value = assignment.get(node.name)
+            counts[id(node)] = 1 if value is None or value == node.true else 0
+        elif isinstance(node, nnf.And):
+            c = 1
+            for child in node.children:
+                c *= counts[id(child)]
+                if c == 0:
+                    break
+            counts[id(node)] = c
+        else:
+            counts[id(node)] = sum(counts[id(child)] for child in node.children)
+    return counts
+
+def count(sentence: nnf.NNF, assignment: dict = None) -> int:
+    '''
+    Number of models of a smooth d-DNNF (e.g. from dsharp -smoothNNF) with the variables of assignment fixed.
+    This conditions and counts in one bottom-up pass over the sentence, without building a conditioned copy.
+    '''
+    return _counts(sentence, assignment or {})[id(sentence)]
+
+def solve(sentence: nnf.NNF, assignment: dict = None):
+    '''A model of a smooth d-DNNF that agrees with assignment, or None. Free variables of the model are set to False.'''
+    assignment = assignment or {}
+    order = _post_order(sentence)
+    counts = _counts(sentence, assignment, order)
+    if counts[id(sentence)] == 0:
+        return None
+    model = {}
+    stack = [sentence]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, nnf.Var):
+            model[node.name] = node.true
+        elif isinstance(node, nnf.And):
+            stack.extend(node.children)
+        else:
+            stack.append(next(child for child in node.children if counts[id(child)] > 0))
+    for node in order:
+        if isinstance(node, nnf.Var):
+            model.setdefault(node.name, False)
+    model.update(assignment)
+    return model
+
+def marginals(sentence: nnf.NNF, assignment: dict = None):
+    '''
+    Model count of a smooth d-DNNF and, for every variable of the sentence, the number of models in which it is true,
+    with the variables of assignment fixed. One bottom-up pass counts every node, one top-down pass accumulates the
+    derivative of the root count by every node; the models with a variable true are those through its positive literals.
+    Returns (count, {name: count of models where name is true}).
+    '''
+    assignment = assignment or {}
+    order = _post_order(sentence)
+    counts = _counts(sentence, assignment, order)
+    derivatives = {id(sentence): 1}
+    true_counts = {}
+    for node in reversed(order):
+        d = derivatives.get(id(node), 0)
+        if isinstance(node, nnf.Var):
+            true_counts.setdefault(node.name, 0)
+            if node.true:
+                true_counts[node.name] += d * counts[id(node)]
+        elif d == 0:
+            continue
+        elif isinstance(node, nnf.And):
+            children = list(node.children)
+            # product of the other children's counts, from prefix and suffix products so that zero counts need no division
+            suffix = [1] * (len(children) + 1)
+            for i in range(len(children) - 1, -1, -1):
+                suffix[i] = suffix[i + 1] * counts[id(children[i])]
+            prefix = 1
+            for i, child in enumerate(children):
+                derivatives[id(child)] = derivatives.get(id(child), 0) + d * prefix * suffix[i + 1]
+                prefix *= counts[id(child)]
+        else:
+            for child in node.children:
+                derivatives[id(child)] = derivatives.get(id(child), 0) + d
+    return counts[id(sentence)], true_counts
+
+# Counting with sizes: every node gets a polynomial {sizes: count}, the number of its models in which sizes[i] of the
+# variables of group i are true, for the variables {name: i} of groups. Terms over the limits are dropped, since sizes
+# only grow on the way up, so the coefficient of the wanted sizes at the root counts the models of a cardinality
+# constraint without encoding it. Inside the passes the sizes are packed into ints (_Packing), which keeps the products
+# of polynomials to an addition and a table lookup per pair of terms.
+
+class _Packing:
+    '''
+    Sizes up to limits packed into one int, sum(sizes[i] * strides[i]). Group i takes a digit of base 2 * limits[i] + 1,
+    so the sum of two packed sizes carries into no other group, valid[key] tells whether such a sum is within the limits,
+    and a difference of packed sizes (which may have negative digits) is the packing of valid sizes only if it is one.
+    '''
+    def __init__(self, limits):
+        self.limits = tuple(limits)
+        self.strides = []
+        stride = 1
+        for limit in self.limits:
+            self.strides.append(stride)
+            stride *= 2 * limit + 1
+        self.valid = bytearray(stride)
+        for sizes in product(*(range(limit + 1) for limit in self.limits)):
+            self.valid[self.pack(sizes)] = 1
+
+    def pack(self, sizes) -> int:
+        return sum(size * stride for size, stride in zip(sizes, self.strides))
+
+    def unpack(self, key: int) -> tuple:
+        return tuple(key // stride % (2 * limit + 1) for limit, stride in zip(self.limits, self.strides))
+
+def _multiply(a: dict, b: dict, valid: bytearray) -> dict:
+    '''Product of two packed polynomials, without the terms over the limits of valid.'''
+    if len(a) > len(b):
+        a, b = b, a
+    result = {}
+    for key_a, count_a in a.items():
+        for key_b, count_b in b.items():
+            key = key_a + key_b
+            if valid[key]:
+                result[key] = result.get(key, 0) + count_a * count_b
+    return result
+
+def multiply(a: dict, b: dict, limits) -> dict:
+    '''Product of two polynomials {sizes: count}, without the terms over limits.'''
+    packing = _Packing(limits)
+    def packed(poly):
+        return {packing.pack(s): c for s, c in poly.items() if all(size <= limit for size, limit in zip(s, limits))}
+    result = _multiply(packed(a), packed(b), packing.valid)
+    return {packing.unpack(key): count for key, count in result.items()}
+
+def _size_counts(sentence: nnf.NNF, groups: dict, packing: _Packing, assignment: dict, order=None) -> dict:
+    '''Packed polynomial of every node, {id(node): {key: count}}, with the variables of assignment fixed.'''
+    polys = {}
+    for node in order if order is not None else _post_order(sentence):
+        if isinstance(node, nnf.Var):
+            value = assignment.get(node.name)
+            if value is not None and value != node.true:
+                polys[id(node)] = {}
+            elif node.true and node.name in groups:
+                group = groups[node.name]
+                polys[id(node)] = {packing.strides[group]: 1} if packing.limits[group] else {}
+            else:
+                polys[id(node)] = {0: 1}
+        elif isinstance(node, nnf.And):
+            poly = {0: 1}
+            for child in node.children:
+                poly = _multiply(poly, polys[id(child)], packing.valid)
+                if not poly:
+                    break
+            polys[id(node)] = poly
+        else:
+            poly = {}
+            for child in node.children:
+                for key, count in polys[id(child)].items():
+                    poly[key] = poly.get(key, 0) + count
+            polys[id(node)] = poly
+    return polys
+
+def size_polynomial(sentence: nnf.NNF, groups: dict, limits, assignment: dict = None) -> dict:
+    '''The polynomial {sizes: count} of a smooth d-DNNF, the number of its models by the number of true variables of each group, up to limits.'''
+    if min(limits, default=0) < 0:
+        return {}
+    packing = _Packing(limits)
+    poly = _size_counts(sentence, groups, packing, assignment or {})[id(sentence)]
+    return {packing.unpack(key): count for key, count in poly.items()}
+
+def count_sized(sentence: nnf.NNF, groups: dict, sizes, assignment: dict = None) -> int:
+    '''Number of models of a smooth d-DNNF in which exactly sizes[i] variables of group i are true, with the variables of assignment fixed.'''
+    return size_polynomial(sentence, groups, sizes, assignment).get(tuple(sizes), 0)
+
+def _split(polys: list, target: int, valid: bytearray) -> list:
+    suffix = [{0: 1}]
+    for poly in reversed(polys[1:]):
+        suffix.append(_multiply(poly, suffix[-1], valid))
+    suffix.reverse()
+    parts = []
+    for poly, rest in zip(polys, suffix):
+        part = next((key for key in poly if rest.get(target - key, 0) > 0), None)
+        if part is None:
+            return None
+        parts.append(part)
+        target -= part
+    return parts
+
+def split(polys: list, sizes) -> list:
+    '''
+    Sizes of every factor of a product of polynomials, [sizes_i], that add up to sizes with a nonzero count in every
+    factor, or None if the product has no term at sizes. Used to pick a model of a conjunction of independent parts.
+    '''
+    if min(sizes, default=0) < 0:
+        return None
+    packing = _Packing(sizes)
+    parts = _split([{packing.pack(s): c for s, c in poly.items()} for poly in polys], packing.pack(sizes), packing.valid)
+    return None if parts is None else [packing.unpack(key) for key in parts]
+
+def solve_sized(sentence: nnf.NNF, groups: dict, sizes, assignment: dict = None):
+    '''A model of a smooth d-DNNF that agrees with assignment and has sizes[i] true variables in group i, or None.'''
+    if min(sizes, default=0) < 0:
+        return None
+    assignment = assignment or {}
+    packing = _Packing(sizes)
+    target = packing.pack(sizes)
+    order = _post_order(sentence)
+    polys = _size_counts(sentence, groups, packing, assignment, order)
+    if polys[id(sentence)].get(target, 0) == 0:
+        return None
+    model = {}
+    stack = [(sentence, target)]
+    while stack:
+        node, target = stack.pop()
+        if isinstance(node, nnf.Var):
+            model[node.name] = node.true
+        elif isinstance(node, nnf.And):
+            children = list(node.children)
+            stack.extend(zip(children, _split([polys[id(child)] for child in children], target, packing.valid)))
+        else:
+            stack.append((next(child for child in node.children if polys[id(child)].get(target, 0) > 0), target))
+    for node in order:
+        if isinstance(node, nnf.Var):
+            model.setdefault(node.name, False)
+    model.update(assignment)
+    return model
+
+def marginals_sized(sentence: nnf.NNF, groups: dict, sizes, assignment: dict = None, context: dict = None):
+    '''
+    marginals() over the models with sizes[i] true variables in group i. context is the polynomial of the parts the
+    sentence is conjoined with (e.g. the other components of a theory), whose sizes count towards sizes.
+    The derivative of a node is only kept at sizes - s for the sizes s of its own models, the only points through which
+    it reaches the count at the root, so the top-down pass does not multiply whole polynomials.
+    Returns (count, {name: count of models where name is true}).
+    '''
+    if min(sizes, default=0) < 0:
+        return 0, {}
+    assignment = assignment or {}
+    packing = _Packing(sizes)
+    target = packing.pack(sizes)
+    order = _post_order(sentence)
+    polys = _size_counts(sentence, groups, packing, assignment, order)
+    context = {packing.pack(s): c for s, c in (context or {(0,) * len(sizes): 1}).items()}
+    derivatives = {id(sentence): {target - key: context.get(target - key, 0) for key in polys[id(sentence)]}}
+    true_counts = {}
+    for node in reversed(order):
+        d = derivatives.get(id(node))
+        if isinstance(node, nnf.Var):
+            true_counts.setdefault(node.name, 0)
+            if node.true and d and polys[id(node)]:
+                (key,) = polys[id(node)]
+                true_counts[node.name] += d.get(target - key, 0)
+        elif not d:
+            continue
+        elif isinstance(node, nnf.And):
+            children = list(node.children)
+            suffix = [{0: 1}]
+            for child in reversed(children[1:]):
+                suffix.append(_multiply(polys[id(child)], suffix[-1], packing.valid))
+            suffix.reverse()
+            prefix = {point: value for point, value in d.items() if value}
+            for child, rest in zip(children, suffix):
+                child_d = derivatives.setdefault(id(child), {})
+                for key in polys[id(child)]:
+                    point = target - key
+                    child_d[point] = child_d.get(point, 0) + sum(value * rest.get(point - a, 0) for a, value in prefix.items())
+                prefix = _multiply(prefix, polys[id(child)], packing.valid)
+        else:
+            for child in node.children:
+                child_d = derivatives.setdefault(id(child), {})
+                for key in polys[id(child)]:
+                    point = target - key
+                    child_d[point] = child_d.get(point, 0) + d.get(point, 0)
+    root = _multiply(polys[id(sentence)], context, packing.valid)
+    return root.get(target, 0), true_counts
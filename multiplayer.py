@@ -0,0 +1,143 @@
+import argparse
+import random
+from concurrent.futures import ProcessPoolExecutor
+
+import run
+from compile_cache import CompileCache
+
+def default_hand_size(opponents: int) -> int:
+    '''NUM_OF_CARDS, or less when the deck cannot deal that many hands and still leave cards to draw.'''
+    return min(run.NUM_OF_CARDS, (run.LAYOUT.num_cards - 1) // (opponents + 2))
+
+class MultiGame:
+    '''
+    A game of the player against `opponents` opponents seated after them, every hand playing the heuristic of play_round.
+    The face up card is offered to the next seat only; if it does not pick it up, the card goes to the dump and the seat
+    draws. hands[0] is the player's hand and hands[seat] the hand of seat 1..N; observations[seat - 1] holds what the
+    player sees of that seat, in the (opp_pickup_list, opp_not_pickup_list, opp_discard_list) form of opponent_cnf.
+    '''
+    def __init__(self, seed=None, opponents: int = 2, hand_size: int = None):
+        self.seed = seed
+        self.opponents = opponents
+        hand_size = hand_size or default_hand_size(opponents)
+        assert (opponents + 1) * hand_size < run.LAYOUT.num_cards, "The deck is too small to deal every hand and the face up card."
+        self.deck = list(run.LAYOUT.cards)
+        random.Random(seed).shuffle(self.deck)
+        self.hands = [self.deck[i * hand_size:(i + 1) * hand_size] for i in range(opponents + 1)]
+        self.deck_index = (opponents + 1) * hand_size
+        self.face_up = self.deck[self.deck_index]
+        self.deck_index += 1
+        self.dumped = [] # cards passed on, which everyone has seen go to the dump
+        self.observations = [([], [], []) for seat in range(opponents)]
+        self.held = [set() for seat in range(opponents)] # cards each seat picked up and has not discarded since
+        self.rounds = 0
+        self.winner = None # 'player', the seat number or 'draw' once the game is over
+
+    def _turn(self, seat: int) -> bool:
+        '''One turn of seat (0: the player). False if the deck runs out.'''
+        hand = self.hands[seat]
+        melds = run.LAYOUT.melds(run.LAYOUT.to_mask(hand))
+        card = self.face_up
+        picked = bool(run.LAYOUT.bit(card) & melds.wanted)
+        if picked:
+            hand.append(card)
+        else:
+            self.dumped.append(card)
+            if self.deck_index >= len(self.deck):
+                return False
+            hand.append(self.deck[self.deck_index])
+            self.deck_index += 1
+        # the discard is chosen from the hand before the pick up, as in play_round
+        self.face_up = run.LAYOUT.highest(melds.remaining or melds.potential)
+        hand.remove(self.face_up)
+        if seat:
+            pickup, not_pickup, discards = self.observations[seat - 1]
+            (pickup if picked else not_pickup).append(card)
+            discards.append(self.face_up)
+            if picked:
+                self.held[seat - 1].add(card)
+            self.held[seat - 1].discard(self.face_up)
+        return True
+
+    def play_round(self) -> bool:
+        '''Plays one round, the player and then every seat. False once the game is over.'''
+        if self.winner is not None:
+            return False
+        for seat, hand in enumerate(self.hands):
+            melds = run.LAYOUT.melds(run.LAYOUT.to_mask(hand))
+            if not melds.remaining and not melds.potential:
+                self.winner = seat or 'player'
+                return False
+        for seat in range(len(self.hands)):
+            if not self._turn(seat):
+                self.winner = 'draw'
+                return False
+        self.rounds += 1
+        return True
+
+    def seat_request(self, seat: int) -> dict:
+        '''
+        What the player knows about seat 1..N, as the input of infer_seat: the seat's observations, the cards seen going to
+        the dump, the cards other seats are known to hold, and the sizes of the seat's one-opponent theory, in which the deck
+        also holds the other seats' hands.
+        '''
+        others = [s for s in range(1, self.opponents + 1) if s != seat]
+        deck = len(self.deck) - self.deck_index + sum(len(self.hands[s]) for s in others)
+        return {
+            'seat': seat,
+            'player_cards': list(self.hands[0]),
+            'observations': tuple(list(cards) for cards in self.observations[seat - 1]),
+            'dumped': list(self.dumped),
+            'elsewhere': sorted(set().union(*(self.held[s - 1] for s in others))),
+            'counts': [len(self.hands[0]), len(self.hands[seat]), deck],
+        }
+
+def infer_seat(request: dict, cache_dir: str = None) -> dict:
+    '''The model count of the one-opponent theory of a seat and the probability that the seat holds each card (by LAYOUT.index).'''
+    session = run.InferenceSession(run.LAYOUT.cards, CompileCache(cache_dir) if cache_dir else None)
+    session.observe_history(*request['observations'])
+    session.observe_known(request['dumped'], request['elsewhere'])
+    counts = run.GameCounts(*request['counts'])
+    estimate = session.estimate(request['player_cards'], counts)
+    marginals = session.marginals(request['player_cards'], counts=counts)[run.MARGINAL_PROPS.index(run.Opponent)]
+    return {'seat': request['seat'], 'model_count': estimate.model_count, 'probabilities': marginals.tolist()}
+
+def infer_seats(requests, workers: int = None, cache_dir: str = None) -> list:
+    '''infer_seat on every request, in parallel worker processes if workers is given, in the order of the requests.'''
+    if not workers:
+        return [infer_seat(request, cache_dir) for request in requests]
+    run.load_base_theory() # built once here rather than by every worker on a first run
+    with ProcessPoolExecutor(workers) as pool:
+        return list(pool.map(infer_seat, requests, [cache_dir] * len(requests)))
+
+def joint_model(game: MultiGame) -> dict:
+    '''One model of the joint theory of all the seats (run.joint_cnf), as {seat: cards it holds}, or None if there is none.'''
+    store = run.joint_cnf(game.hands[0], game.observations, game.dumped)
+    model = store.solve()
+    if model is None:
+        return None
+    return {seat: [card for card in run.LAYOUT.cards if model.get(run.Opponent_at(seat, card[0], card[1]))]
+            for seat in range(1, game.opponents + 1)}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Plays a game against several opponents and infers every opponent's hand.")
+    parser.add_argument('--opponents', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--rounds', type=int, default=4, help="rounds played before the inference")
+    parser.add_argument('--hand', type=int, default=None, help="cards per hand, the most the deck allows up to NUM_OF_CARDS by default")
+    parser.add_argument('--workers', type=int, default=None, help="worker processes, one seat each, default one per seat")
+    parser.add_argument('--joint', action='store_true', help="also solve the joint theory of all the seats")
+    args = parser.parse_args()
+    game = MultiGame(args.seed, args.opponents, args.hand)
+    while game.rounds < args.rounds and game.play_round():
+        pass
+    print(f"Round {game.rounds}" + (f", game over: {game.winner}" if game.winner is not None else ""))
+    print("Player cards:", sorted(game.hands[0]))
+    requests = [game.seat_request(seat) for seat in range(1, args.opponents + 1)]
+    for result in infer_seats(requests, args.workers or args.opponents, run.COMPILE_CACHE_DIR):
+        seat, probabilities = result['seat'], result['probabilities']
+        guess = [card for card in run.LAYOUT.cards if probabilities[run.LAYOUT.index(card)] > 0.5]
+        correct = len(set(guess) & set(game.hands[seat]))
+        print(f"Seat {seat}: {result['model_count']} models, guess {sorted(guess)}, {correct}/{len(guess)} correct")
+    if args.joint:
+        print("Joint model:", joint_model(game))
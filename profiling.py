@@ -0,0 +1,154 @@
+import csv
+import json
+import time
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+import nnf
+from nnf import tseitin
+from cnf import VarMap, ClauseStore, run_dsharp
+
+PROFILER = None # the Profiler of the innermost `with Profiler():` block; the hooks below do nothing while it is None
+_OFF = nullcontext()
+
+FAMILY_FIELDS = ['family', 'calls', 'seconds', 'constraints', 'nnf_nodes', 'cnf_clauses', 'cnf_vars', 'dsharp_seconds', 'kissat_seconds']
+PHASES = ('encode', 'compile', 'count', 'solve')
+
+def family(name: str, theory):
+    '''
+    Context manager around the code that adds the constraints of one family to theory, a TheoryBuilder or a ClauseStore.
+    The constraints added inside the block are the family's; with theory None the block adds none of its own (it forks
+    or loads a prebuilt theory) and only its time is measured. Nothing is measured unless a Profiler is active.
+    '''
+    if PROFILER is None:
+        return _OFF
+    return PROFILER.family(name, theory)
+
+def decision(name: str):
+    '''Context manager around one decision (e.g. evaluate_moves); the phases timed inside it are reported together.'''
+    if PROFILER is None:
+        return _OFF
+    return PROFILER.decision(name)
+
+def profiled(name: str):
+    '''Decorator making every call of the function a decision name.'''
+    def decorate(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if PROFILER is None:
+                return function(*args, **kwargs)
+            with PROFILER.decision(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def phase(name: str):
+    '''Context manager adding the time of its block to the phase name (encode, compile, count or solve) of the current decision.'''
+    if PROFILER is None or PROFILER._decision is None:
+        return _OFF
+    return PROFILER.phase(name)
+
+def _tseitin_store(constraints) -> ClauseStore:
+    '''The constraints as one CNF, with the auxiliary variables of the Tseitin transformation.'''
+    store = ClauseStore(VarMap())
+    for clause in tseitin.to_CNF(nnf.And(constraints)).children:
+        store.add_clause([store.pos(var.name) if var.true else store.neg(var.name) for var in clause.children])
+    return store
+
+class Profiler:
+    '''
+    Collects what each constraint family costs in the theories built inside `with Profiler() as profiler:`: encoding time,
+    number of constraints, nnf nodes (0 for a ClauseStore, which builds none), clauses and variables of the CNF (after
+    Tseitin for nnf constraints), and with solvers=True the time of dsharp and kissat on the family's clauses alone.
+    records has one row per family and theory, decisions one row per decision with the seconds of each phase; the time
+    spent measuring the families is left out of the phases. Profilers nest; the innermost one collects.
+    '''
+    def __init__(self, solvers: bool = True):
+        self.solvers = solvers
+        self.records = []
+        self.decisions = []
+        self._decision = None
+        self._previous = None
+        self._overhead = 0.0 # seconds spent measuring families so far
+
+    def __enter__(self) -> 'Profiler':
+        global PROFILER
+        self._previous, PROFILER = PROFILER, self
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        global PROFILER
+        PROFILER = self._previous
+
+    @contextmanager
+    def family(self, name: str, theory):
+        start_len = len(theory) if theory is not None else 0
+        start = time.perf_counter()
+        yield
+        seconds = time.perf_counter() - start
+        measuring = time.perf_counter()
+        if theory is None:
+            store = ClauseStore(VarMap())
+            record = {'constraints': 0, 'nnf_nodes': 0}
+        elif isinstance(theory, ClauseStore):
+            store = ClauseStore(VarMap())
+            for clause in list(theory.named())[start_len:]:
+                store.add_named(clause)
+            record = {'constraints': store.num_clauses, 'nnf_nodes': 0}
+        else:
+            constraints = list(theory)[start_len:]
+            store = _tseitin_store(constraints) if constraints else ClauseStore(VarMap())
+            nodes = {node for constraint in constraints for node in constraint.walk()}
+            record = {'constraints': len(constraints), 'nnf_nodes': len(nodes)}
+        record.update(family=name, calls=1, seconds=seconds, cnf_clauses=store.num_clauses, cnf_vars=len(store.varmap),
+                      dsharp_seconds=0.0, kissat_seconds=0.0)
+        if self.solvers and store.num_clauses:
+            start = time.perf_counter()
+            store.solve()
+            record['kissat_seconds'] = time.perf_counter() - start
+            start = time.perf_counter()
+            run_dsharp(store.dimacs(), True)
+            record['dsharp_seconds'] = time.perf_counter() - start
+        self.records.append(record)
+        self._overhead += time.perf_counter() - measuring
+
+    @contextmanager
+    def decision(self, name: str):
+        outer, self._decision = self._decision, dict({'decision': name, 'seconds': 0.0}, **{p: 0.0 for p in PHASES})
+        start, overhead = time.perf_counter(), self._overhead
+        try:
+            yield self._decision
+        finally:
+            self._decision['seconds'] = time.perf_counter() - start - (self._overhead - overhead)
+            self.decisions.append(self._decision)
+            self._decision = outer
+
+    @contextmanager
+    def phase(self, name: str):
+        current = self._decision
+        start, overhead = time.perf_counter(), self._overhead
+        try:
+            yield
+        finally:
+            current[name] = current.get(name, 0.0) + time.perf_counter() - start - (self._overhead - overhead)
+
+    def families(self) -> list:
+        '''The records summed by family, in the order the families were first seen.'''
+        totals = {}
+        for record in self.records:
+            total = totals.setdefault(record['family'], dict.fromkeys(FAMILY_FIELDS[1:], 0))
+            for field in FAMILY_FIELDS[1:]:
+                total[field] += record[field]
+        return [dict(family=name, **total) for name, total in totals.items()]
+
+    def to_json(self, path: str) -> None:
+        with open(path, 'w') as f:
+            json.dump({'families': self.families(), 'records': self.records, 'decisions': self.decisions}, f, indent=2)
+
+    def to_csv(self, path: str, table: str = 'families') -> None:
+        '''Writes one table as CSV: "families" (the summary), "records" or "decisions".'''
+        rows = self.families() if table == 'families' else getattr(self, table)
+        fields = FAMILY_FIELDS if table != 'decisions' else ['decision', 'seconds'] + list(PHASES)
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fields, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(rows)
@@ -0,0 +1,211 @@
+import argparse
+import json
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import run
+import server
+
+# A game log is a stream of JSON lines, one event each, tagged with the game it belongs to; the events of several games
+# may be interleaved. Cards are [rank, suit].
+#   {"game": g, "type": "deal", "player_cards": [...], "face_up": card, "deck_size": n, "opponent_cards": [...]}
+#   {"game": g, "type": "pickup", "who": "player" | "opponent", "card": card}   the face up card is taken
+#   {"game": g, "type": "draw", "who": "player" | "opponent", "card": card}     card is left out when it is hidden
+#   {"game": g, "type": "discard", "who": "player" | "opponent", "card": card}
+#   {"game": g, "type": "end", "winner": "player" | "opponent" | "draw"}
+# opponent_cards and the opponent's drawn cards are optional; when a log has them, the guesses are scored against them.
+
+def _card(card) -> tuple:
+    return (int(card[0]), str(card[1]))
+
+def read_events(lines):
+    '''The events of a log, one per non-blank line, read lazily from any iterable of lines (e.g. an open file).'''
+    for line in lines:
+        if line.strip():
+            yield json.loads(line)
+
+def record_events(seed, max_rounds=None):
+    '''The events of the game of seed played by run.Game, with the opponent's cards, e.g. to build a test archive.'''
+    game = run.Game(seed)
+    yield {'game': seed, 'type': 'deal', 'player_cards': list(game.player_cards), 'opponent_cards': list(game.opponent_cards),
+           'face_up': game.discard_pile_top_card, 'deck_size': len(game.deck) - game.deck_index}
+    while max_rounds is None or game.rounds < max_rounds:
+        face_up, hand, deck_index = game.discard_pile_top_card, list(game.player_cards), game.deck_index
+        observation = game.play_round()
+        if observation is None:
+            break
+        (picked, card), opp_discard = observation
+        if face_up in game.player_cards: # the player's discard comes from the hand before the pick up
+            yield {'game': seed, 'type': 'pickup', 'who': 'player', 'card': face_up}
+        else:
+            yield {'game': seed, 'type': 'draw', 'who': 'player', 'card': game.deck[deck_index]}
+            deck_index += 1
+        yield {'game': seed, 'type': 'discard', 'who': 'player', 'card': card}
+        if picked:
+            yield {'game': seed, 'type': 'pickup', 'who': 'opponent', 'card': card}
+        else:
+            yield {'game': seed, 'type': 'draw', 'who': 'opponent', 'card': game.deck[deck_index]}
+        yield {'game': seed, 'type': 'discard', 'who': 'opponent', 'card': opp_discard}
+    yield {'game': seed, 'type': 'end', 'winner': game.winner}
+
+class GameReplay:
+    '''
+    The state of one game rebuilt from its events: the player's hand, the face up card, the observation lists of
+    opponent_cnf, the sizes of the opponent's hand and of the deck, and the opponent's hand while the log shows it.
+    '''
+    def __init__(self, event: dict):
+        self.game = event['game']
+        self.player_cards = [_card(card) for card in event['player_cards']]
+        self.face_up = _card(event['face_up'])
+        self.deck_size = event['deck_size']
+        known = event.get('opponent_cards')
+        self.opponent_cards = [_card(card) for card in known] if known is not None else None
+        self.opponent_size = len(known) if known is not None else len(self.player_cards)
+        self.opp_pickup, self.opp_not_pickup, self.opp_discard = [], [], []
+        self.rounds = 0
+
+    def apply(self, event: dict) -> bool:
+        '''Applies one event; True once the opponent has discarded, which ends a round.'''
+        kind, who = event['type'], event.get('who')
+        card = _card(event['card']) if event.get('card') is not None else None
+        hand = self.player_cards if who == 'player' else self.opponent_cards
+        if kind == 'pickup':
+            if who == 'opponent':
+                self.opp_pickup.append(self.face_up)
+                self.opponent_size += 1
+            if hand is not None:
+                hand.append(self.face_up)
+            self.face_up = None
+        elif kind == 'draw':
+            if who == 'opponent':
+                self.opp_not_pickup.append(self.face_up)
+                self.opponent_size += 1
+                if card is None: # the opponent's hand is hidden from here on
+                    self.opponent_cards = None
+            self.face_up = None # it goes to the dump
+            if hand is not None and card is not None:
+                hand.append(card)
+            self.deck_size -= 1
+        elif kind == 'discard':
+            if who == 'opponent':
+                self.opp_discard.append(card)
+                self.opponent_size -= 1
+            if hand is not None:
+                hand.remove(card)
+            self.face_up = card
+            if who == 'opponent':
+                self.rounds += 1
+                return True
+        return False
+
+    def checkpoint(self) -> dict:
+        '''The decision of the player at this point, as an advisor request with the game, round and opponent's hand.'''
+        return {
+            'id': [self.game, self.rounds],
+            'player_cards': list(self.player_cards),
+            'face_up': self.face_up,
+            'opp_pickup': list(self.opp_pickup),
+            'opp_not_pickup': list(self.opp_not_pickup),
+            'opp_discard': list(self.opp_discard),
+            'counts': [len(self.player_cards), self.opponent_size, self.deck_size],
+            'opponent_cards': list(self.opponent_cards) if self.opponent_cards is not None else None,
+        }
+
+def checkpoints(events, every: int = 1, final: bool = True):
+    '''
+    The checkpoints of a stream of events, in stream order: the player's decision every `every` rounds, and with final
+    at the end of every game. Only the games in progress are kept, so memory does not grow with the stream.
+    '''
+    games = {}
+    for event in events:
+        if event['type'] == 'deal':
+            games[event['game']] = GameReplay(event)
+            continue
+        replay = games.get(event['game'])
+        if replay is None:
+            continue # a game whose deal is not in the stream
+        if event['type'] == 'end':
+            del games[event['game']]
+            # the state after the last round, unless it was a checkpoint already
+            if final and replay.rounds and (not every or replay.rounds % every) and replay.face_up is not None:
+                yield replay.checkpoint()
+        elif replay.apply(event) and every and replay.rounds % every == 0:
+            yield replay.checkpoint()
+
+def score(request: dict, capacity: int = 64) -> dict:
+    '''Runs the advisor on one checkpoint and scores its guess of the opponent's hand when the checkpoint knows it.'''
+    start = time.perf_counter()
+    answer = server.advise(request, capacity)
+    seconds = time.perf_counter() - start
+    game, round = request['id']
+    result = {'game': game, 'round': round, 'advice': answer['advice'], 'model_counts': answer['model_counts'],
+              'guess': answer['opponent_estimate'], 'correct': None, 'accuracy': None, 'seconds': seconds}
+    if request.get('opponent_cards') is not None:
+        actual = {tuple(card) for card in request['opponent_cards']}
+        result['correct'] = len(actual & set(answer['opponent_estimate']))
+        result['accuracy'] = result['correct'] / len(answer['opponent_estimate']) if answer['opponent_estimate'] else None
+    return result
+
+def replay(requests, workers: int = 2, window: int = None, capacity: int = 64):
+    '''
+    Scores the checkpoints in a pool of workers and yields the results in the order of the checkpoints. At most window
+    (2 per worker by default) checkpoints are in flight: the next one is only read once the oldest result is taken, so
+    a slow consumer or slow inference holds back the reading of the log instead of filling memory.
+    '''
+    window = window or 2 * workers
+    run.load_base_theory() # built once here rather than by every worker on a first run
+    with ProcessPoolExecutor(workers) as pool:
+        pending = deque()
+        for request in requests:
+            pending.append(pool.submit(score, request, capacity))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+class Summary:
+    '''Running totals of the results, for the report at the end of a replay.'''
+    def __init__(self):
+        self.checkpoints = self.guesses = self.correct = self.unsatisfiable = 0
+        self.seconds = 0.0
+
+    def update(self, result: dict) -> None:
+        self.checkpoints += 1
+        self.seconds += result['seconds']
+        self.unsatisfiable += result['advice'] is None
+        if result['correct'] is not None:
+            self.guesses += len(result['guess'])
+            self.correct += result['correct']
+
+    def summary(self) -> dict:
+        return {
+            'checkpoints': self.checkpoints,
+            'guess_accuracy': self.correct / self.guesses if self.guesses else None,
+            'unsatisfiable': self.unsatisfiable,
+            'seconds_per_checkpoint': self.seconds / self.checkpoints if self.checkpoints else None,
+        }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replays JSON-lines game logs and scores the advisor at checkpoints.")
+    parser.add_argument('log', nargs='?', default='-', help="game log, - for stdin")
+    parser.add_argument('--out', default='-', help="where to write the results as JSON lines, - for stdout")
+    parser.add_argument('--every', type=int, default=1, help="checkpoint every k rounds, 0 for the end of the games only")
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--window', type=int, default=None, help="checkpoints in flight, 2 per worker by default")
+    parser.add_argument('--record', type=int, default=None, help="write the log of this many seeded games instead of replaying")
+    args = parser.parse_args()
+    out = sys.stdout if args.out == '-' else open(args.out, 'w')
+    if args.record is not None:
+        for seed in range(args.record):
+            for event in record_events(seed):
+                out.write(json.dumps(event) + '\n')
+        raise SystemExit
+    log = sys.stdin if args.log == '-' else open(args.log)
+    summary = Summary()
+    for result in replay(checkpoints(read_events(log), args.every), args.workers, args.window):
+        summary.update(result)
+        out.write(json.dumps(result) + '\n')
+        out.flush()
+    print(json.dumps(summary.summary()), file=sys.stderr)
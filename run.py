@@ -1,35 +1,90 @@
 from typing import Any
-from bauhaus import Encoding, proposition, constraint, Or, And
+import argparse
+import os
+from bauhaus import Encoding, proposition, Or, And
 from bauhaus.utils import count_solutions, likelihood
-from itertools import product, combinations
+from itertools import product
+from functools import wraps, lru_cache
+from collections import namedtuple
 import random
+import time
+import numpy as np
 # These two lines make sure a faster SAT solver is used.
 from nnf import config
 config.sat_backend = "kissat"
+from theory import TheoryBuilder
+from bitboard import CardLayout, MeldCatalogue
+import cnf
+from cnf import VarMap, ClauseStore, Budget, BudgetExceeded, Portfolio
+from compile_cache import CompileCache
+import ddnnf
+import approx
+import base_theory
+import profiling
+import search
 
 #----------------Constants----------------- # feel free to change the size of the deck and see what the model suggests
 RANKS = (1,2,3,4,5,6,7,8,9) 
 SUITS = ('A', 'B', 'C', 'D')
 NUM_OF_CARDS = 10
+COMPILE_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.dsharp_cache') # compiled theories, see compile_cache.py
+BASE_THEORY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'base_theories') # precompiled card placement theories, see base_theory.py
+# Exploration 2 falls back to approximate counting (approx.py) when dsharp runs over this budget
+COMPILE_BUDGET = Budget(seconds=60, nnf_bytes=512 * 2**20)
+LOOKAHEAD_SECONDS = 1.0 # time budget of the lookahead search of a turn, see search.py
+APPROX_EPSILON, APPROX_DELTA = 0.8, 0.2 # the approximate counts are within a factor 1 + epsilon with probability 1 - delta
+APPROX_SECONDS = 30 # time budget of the approximate fallback of Exploration 2, on top of COMPILE_BUDGET
+APPROX_ITERATIONS = 9 # repetitions of an approximate count in the fallback, instead of the 67 that APPROX_DELTA asks for
+MARGINAL_SAMPLES = 100 # near-uniform samples of a component over COMPILE_BUDGET, from which its marginals are estimated
+MELD_ENCODING = "direct" # "direct" writes out every meld of the opponent, "ladder" uses auxiliary Opp_run/Opp_set variables and stays near-linear in the deck size
+LAYOUT = CardLayout(RANKS, SUITS) # one bit per card, for hands, the deck and the discard pile as bitboards
+CATALOGUE = MeldCatalogue(LAYOUT) # every legal set and run, and the melds each card is in
 #-------------Global Variables-------------
 global deck, discarded_pile
 discarded_pile = []
 
-# Encoding that will store all of your constraints
+# Encoding that registers the propositions; the constraints of each game state are stored in a TheoryBuilder
 E = Encoding()
 
 class Hashable: #recommanded
-    def __hash__(self):
-        return hash(str(self))
+    # Instances are interned (see interned below), so equality is identity and the hash is computed once at creation
+    __slots__ = ('_key', '_hash', '_var', '__weakref__')
+    _factory = None
 
-    def __eq__(self, __value: object) -> bool:
-        return hash(self) == hash(__value)
+    def __hash__(self):
+        return self._hash
 
     def __repr__(self):
         return str(self)
- # To create propositions, create classes for them first, annotated with "@proposition" and the Encoding   
+
+    def __reduce__(self): # unpickling goes back through the interning table, e.g. in worker processes
+        return (self._factory, self._key)
+
+def interned(prop):
+    '''
+    Wraps a @proposition class so that there is one instance per argument tuple, e.g. Player(1, 'A') always returns the same object.
+    Looking up an existing proposition does not allocate, and its hash is computed once when it is first created.
+    '''
+    instances = {}
+    @wraps(prop)
+    def get(*args):
+        try:
+            return instances[args]
+        except KeyError:
+            obj = prop(*args)
+            obj._key = args
+            obj._hash = hash((prop.__name__,) + args)
+            type(obj)._factory = staticmethod(get)
+            instances[args] = obj
+            return obj
+    get.instances = instances
+    return get
+
+ # To create propositions, create classes for them first, annotated with "@interned", "@proposition" and the Encoding   
+@interned
 @proposition(E)
 class Player(Hashable):
+    __slots__ = ('a', 'b')
     def __init__(self, rank: int, suit: str):
         self.a = rank
         self.b = suit
@@ -37,44 +92,37 @@ class Player(Hashable):
     def __str__(self):
         return f"P({self.a}{self.b})"
     
+@interned
 @proposition(E)
 class Opponent(Hashable):
+    __slots__ = ('rank', 'suit')
     def __init__(self, rank: int, suit: str):
         self.rank = rank
         self.suit = suit
     
     def related_cards(self) -> list:
-        related_list = [] # 2D array list of conjunctions - all possible combination of meld 
-        # list of all possible SETS with opp_pick_card:
-        excl_suit_list = list(set(SUITS).difference(self.suit))
-        combination_list = list(combinations(excl_suit_list, 2))
-        combination_list.append(excl_suit_list) # add possible set of 4 with opp_pick_card
-        for comb in combination_list:
-            temp_list = []
-            for each_suit in comb:
-                temp_list.append(Opponent(self.rank, each_suit))
-            related_list.append(And(temp_list))
-        # list of all possible RUNS with opp_pick_card:
-        temp_list = [self.rank]
-        opp_c_list = []
-        for upper_r in range(self.rank, RANKS[-1]+1):
-            temp_list.append(upper_r)
-            for x in list(temp_list):
-                opp_c_list.append(Opponent(x, self.suit))
-            related_list.append(And(list(opp_c_list))) # a copy of the current list with opp card objects
-        temp_list = [self.rank]
-        opp_c_list = []
-        for lower_r in reversed(range(RANKS[0], self.rank)):
-            temp_list.insert(0, lower_r)
-            for x in list(temp_list):
-                opp_c_list.append(Opponent(x, self.suit))
-            related_list.append(And(list(opp_c_list))) # a copy of the current list with opp card objects
-        return related_list
+        '''List of conjunctions, one for every meld with this card: the opponent holds the other cards of the meld.'''
+        return [And([Opponent(c[0], c[1]) for c in others]) for others in CATALOGUE.completions((self.rank, self.suit))]
     def __str__(self):
         return f"O({self.rank}{self.suit})"
+
+@interned
+@proposition(E)
+class Opponent_at(Hashable):
+    '''The opponent in seat (1..N) of a game with N opponents holds card (rank, suit); the joint theory of the seats uses one family per seat.'''
+    __slots__ = ('seat', 'rank', 'suit')
+    def __init__(self, seat: int, rank: int, suit: str):
+        self.seat = seat
+        self.rank = rank
+        self.suit = suit
+
+    def __str__(self):
+        return f"O{self.seat}({self.rank}{self.suit})"
     
+@interned
 @proposition(E)
 class Pl_run(Hashable):
+    __slots__ = ('lower', 'upper', 'suit')
     def __init__(self, lower_rank, upper_rank, suit):
         self.lower = lower_rank
         self.upper = upper_rank
@@ -83,8 +131,10 @@ class Pl_run(Hashable):
     def __str__(self):
         return f"player_run_{self.lower}_{self.upper}_{self.suit}"
 
+@interned
 @proposition(E)
 class Pl_set(Hashable):
+    __slots__ = ('rank', 'excluded_suit')
     def __init__(self, rank: int, suit: str):
         self.rank = rank
         self.excluded_suit = suit
@@ -92,8 +142,62 @@ class Pl_set(Hashable):
     def __str__(self):
         return f"player_set_{self.rank}_{self.excluded_suit}"
     
+@interned
+@proposition(E)
+class Opp_run(Hashable):
+    # auxiliary variable of the "ladder" meld encoding: the opponent holds every card from lower_rank to upper_rank of suit
+    __slots__ = ('lower', 'upper', 'suit')
+    def __init__(self, lower_rank, upper_rank, suit):
+        self.lower = lower_rank
+        self.upper = upper_rank
+        self.suit = suit
+
+    def __str__(self):
+        return f"opp_run_{self.lower}_{self.upper}_{self.suit}"
+
+@interned
+@proposition(E)
+class Opp_set(Hashable):
+    # auxiliary variable of the "ladder" meld encoding: the opponent holds at least two cards of rank other than excluded_suit
+    __slots__ = ('rank', 'excluded_suit')
+    def __init__(self, rank: int, suit: str):
+        self.rank = rank
+        self.excluded_suit = suit
+
+    def __str__(self):
+        return f"opp_set_{self.rank}_{self.excluded_suit}"
+
+@interned
+@proposition(E)
+class Opp_suits(Hashable):
+    # auxiliary counter of the "ladder" meld encoding: the opponent holds at least k cards of rank in the suits SUITS[lo:hi]
+    __slots__ = ('rank', 'lo', 'hi', 'k')
+    def __init__(self, rank: int, lo: int, hi: int, k: int):
+        self.rank = rank
+        self.lo = lo
+        self.hi = hi
+        self.k = k
+
+    def __str__(self):
+        return f"opp_suits_{self.rank}_{self.lo}_{self.hi}_{self.k}"
+
+@interned
+@proposition(E)
+class Card_count(Hashable):
+    # register of the sequential counter of a card proposition: at least k of the first i cards of LAYOUT are in place
+    __slots__ = ('place', 'i', 'k')
+    def __init__(self, place: str, i: int, k: int):
+        self.place = place
+        self.i = i
+        self.k = k
+
+    def __str__(self):
+        return f"count_{self.place}_{self.i}_{self.k}"
+
+@interned
 @proposition(E)
 class Pl_want(Hashable):
+    __slots__ = ('a', 'b')
     def __init__(self, rank: int, suit: str):
         self.a = rank
         self.b = suit
@@ -101,8 +205,10 @@ class Pl_want(Hashable):
     def __str__(self):
         return f"player_want_{self.a}{self.b}"
 
+@interned
 @proposition(E)
 class Opp_pick(Hashable):
+    __slots__ = ('a', 'b')
     def __init__(self, rank: int, suit: str):
         self.a = rank
         self.b = suit
@@ -110,8 +216,10 @@ class Opp_pick(Hashable):
     def __str__(self):
         return f"opp_pick_{self.a}{self.b}"
 
+@interned
 @proposition(E)
 class Opp_discard(Hashable):
+    __slots__ = ('a', 'b')
     def __init__(self, rank: int, suit: str):
         self.a = rank
         self.b = suit
@@ -119,8 +227,10 @@ class Opp_discard(Hashable):
     def __str__(self):
         return f"opp_discard_{self.a}{self.b}"
 
+@interned
 @proposition(E)
 class Deck(Hashable):
+    __slots__ = ('a', 'b')
     def __init__(self, rank: int, suit: str):
         self.a = rank
         self.b = suit
@@ -128,8 +238,10 @@ class Deck(Hashable):
     def __str__(self):
         return f"deck_card{self.a}{self.b}"
 
+@interned
 @proposition(E)
 class Dump(Hashable):
+    __slots__ = ('a', 'b')
     def __init__(self, rank: int, suit: str):
         self.a = rank
         self.b = suit
@@ -155,94 +267,111 @@ def cards_to_rank_dict(my_cardlist: list) -> dict:
             my_dict[x[0]] = {x[1]}
     return my_dict
 
-def cards_to_suit_dict(my_cardlist: list) -> dict:
-    '''Takes in a list my_cardlist, returns the dictionary that maps every rank in the list into a set of suits'''
-    my_dict = {} # dictionary that maps the ranks into a set of suits, eg. {1:{'A', 'B'}, 3:{'C','A'}}
-    for x in my_cardlist:
-        if x[1] in my_dict:
-            my_dict[x[1]].add(x[0])
-        else:
-            my_dict[x[1]] = {x[0]}
-    return my_dict
-
-def remove_card_from_list(cards: list, remove_items, rank: int, suit: str) -> list:
-    if rank == None:
-        for target in remove_items:
-            cards.remove((target, suit))
-    else:
-        for target in remove_items:
-            cards.remove((rank, target))
-    return cards # updated card list that removes the target items
-
 def meld_list_generator(remaining_cards:list) -> list:
     '''
     Takes in a list of cards, find all the existing melds and potential melds
-    Return a list of three lists: [existing_meld_list, remaining_cards, potential_meld_list]
-    '''
-    existing_meld_list = []
-    potential_meld_list = []
-    wanting_list = []
-    # search for RUNS
-    cards_in_suit = cards_to_suit_dict(sorted(remaining_cards))
-    for el_suit, el_rank_set in cards_in_suit.items():
-        if(len(el_rank_set)>2):
-            temp_list = sorted(list(el_rank_set))
-            num_of_con_term = 1
-            from_index = 0
-            # Search for existing RUNS
-            for index in range (len(temp_list)):
-                if index == len(temp_list)-1: # check if the last element counts towards a run
-                    if (((temp_list[index-1]+1) == temp_list[index]) and (num_of_con_term>2)):
-                        existing_meld_list.append((el_suit,temp_list[from_index:index+1]))        
-                        wanting_list.append((temp_list[from_index]-1, el_suit))
-                        remaining_cards = remove_card_from_list(remaining_cards, temp_list[from_index:index+1], None, el_suit)
-                elif ((temp_list[index]+1) != temp_list[index+1]): # if the index card is not consecative with the next card
-                    # if the previous cards makes a run, add them into the existing_meld
-                    if num_of_con_term >2: 
-                        existing_meld_list.append((el_suit,temp_list[from_index:index+1]))
-                        if temp_list[from_index] > RANKS[0]:
-                            wanting_list.append((temp_list[from_index]-1, el_suit))
-                        if temp_list[index]+1 < RANKS[-1]:
-                            wanting_list.append((temp_list[index]+1, el_suit))
-                        remaining_cards = remove_card_from_list(remaining_cards, temp_list[from_index:index+1], None, el_suit)
-                        from_index = index + 1
-                    # if there is a potential meld, with Case 1: input_card = [4A, 5A] => wanting_list = [3A, 6A]
-                    elif num_of_con_term == 2: 
-                        potential_meld_list.append((temp_list[index-1], el_suit))
-                        potential_meld_list.append((temp_list[index], el_suit))
-                        if temp_list[index-1] > RANKS[0]:
-                            wanting_list.append((temp_list[index-1]-1, el_suit))
-                        if temp_list[index]+1 < RANKS[-1]:
-                            wanting_list.append((temp_list[index]+1, el_suit))
-                    num_of_con_term = 1
-                    from_index = index +1
-                # if the two cards are consecutive
-                elif ((temp_list[index]+1) == temp_list[index+1]): 
-                    num_of_con_term +=1 
-                # potential meld with Case 2: input_card = [4A, 6A], wanting_list = [5A]
-                elif (index<len(temp_list)-2) and ((temp_list[index]+2) == temp_list[index+2]): 
-                    if temp_list[index-1] > RANKS[0]:
-                        wanting_list.append((temp_list[index-1]-1, el_suit))
-                    if temp_list[index]+1 < RANKS[-1]:
-                        wanting_list.append((temp_list[index]+1, el_suit))
-    # search for SETS
-    cards_in_rank = cards_to_rank_dict(sorted(remaining_cards))
-    for el_rank, el_suit_set in cards_in_rank.items():
-        if (len(el_suit_set)>2):
-            existing_meld_list.append((el_rank, el_suit_set))
-            remaining_cards = remove_card_from_list(remaining_cards, list(el_suit_set), el_rank, None)
-        elif (len(el_suit_set)==2): # potential sets, add related cards to wanting linst
-            temp_diff_suit = list(set(SUITS).difference(el_suit_set))
-            for el_suit in el_suit_set:
-                potential_meld_list.append((el_rank, el_suit))
-            for diff_s in temp_diff_suit:
-                wanting_list.append((el_rank, diff_s))
-    wanting_list = list(set(wanting_list))
-    potential_meld_list = list(set(potential_meld_list))
-    remaining_cards = list(set(remaining_cards).difference(potential_meld_list)) # remaining card = all cards - melds - potential melds
-    return existing_meld_list, remaining_cards, wanting_list, potential_meld_list
-
-def example_theory(player_cards, opp_pickup_list, opp_not_pickup_list, opp_discard_list):
+    Return a list of four lists: [existing_meld_list, remaining_cards, wanting_list, potential_meld_list]
+    This is a list view over the bitboard analyzer LAYOUT.melds(), which the game loop uses directly.
+    '''
+    return LAYOUT.meld_lists(LAYOUT.to_mask(remaining_cards))
+
+def define(T: TheoryBuilder, aux, formula) -> None:
+    '''Adds aux <-> formula to T, so that the auxiliary variable does not change the number of models.'''
+    T.add_constraint(aux >> formula)
+    T.add_constraint(formula >> aux)
+
+def opp_run_ladder(defs: list, lower: int, upper: int, suit: str):
+    '''Opp_run(lower, upper, suit), defined in defs as a ladder: the run up to upper is the run up to upper-1 and the card at upper.'''
+    prev = Opponent(lower, suit)
+    for rank in range(lower+1, upper+1):
+        defs.append((Opp_run(lower, rank, suit), [(prev, Opponent(rank, suit))]))
+        prev = Opp_run(lower, rank, suit)
+    return prev
+
+def opp_suits_ladder(defs: list, rank: int, lo: int, hi: int, k: int):
+    '''Opp_suits(rank, lo, hi, k) for k = 1 or 2, defined in defs as a sequential counter that adds one suit at a time, or None if it is always false.'''
+    if hi - lo < k:
+        return None
+    step = 1 if lo == 0 else -1 # prefixes SUITS[0:hi] grow up, suffixes SUITS[lo:] grow down
+    prev_1 = prev_2 = None
+    for i in (range(lo, hi) if step == 1 else reversed(range(lo, hi))):
+        card = Opponent(rank, SUITS[i])
+        bounds = (lo, i+1) if step == 1 else (i, hi)
+        defs.append((Opp_suits(rank, bounds[0], bounds[1], 1), [(card,)] if prev_1 == None else [(prev_1,), (card,)]))
+        if prev_1 != None and k == 2:
+            defs.append((Opp_suits(rank, bounds[0], bounds[1], 2), [(prev_1, card)] if prev_2 == None else [(prev_2,), (prev_1, card)]))
+            prev_2 = Opp_suits(rank, bounds[0], bounds[1], 2)
+        prev_1 = Opp_suits(rank, bounds[0], bounds[1], 1)
+    return prev_2 if k == 2 else prev_1
+
+def opp_set_ladder(defs: list, rank: int, suit: str):
+    '''Opp_set(rank, suit), defined in defs from the counters of the suits before and after suit.'''
+    j = SUITS.index(suit)
+    before_1, before_2 = opp_suits_ladder(defs, rank, 0, j, 1), opp_suits_ladder(defs, rank, 0, j, 2)
+    after_1, after_2 = opp_suits_ladder(defs, rank, j+1, len(SUITS), 1), opp_suits_ladder(defs, rank, j+1, len(SUITS), 2)
+    terms = [(x,) for x in (before_2, after_2) if x != None]
+    if before_1 != None and after_1 != None:
+        terms.append((before_1, after_1))
+    defs.append((Opp_set(rank, suit), terms))
+    return Opp_set(rank, suit)
+
+def opp_meld_ladder(card):
+    '''
+    The "ladder" encoding of "the opponent holds two other cards that make a meld with card", described once for
+    opp_meld_with() and opp_meld_lits(). Returns (defs, terms): defs lists (aux, terms) in dependency order, aux being an
+    auxiliary variable that is true exactly when one of its terms is, and terms are the options of the meld. A term is a
+    tuple of propositions that are all true. The auxiliary variables are shared by every card, so the theory grows
+    linearly with the number of ranks and suits.
+    '''
+    rank, suit = card
+    defs = []
+    terms = [(opp_set_ladder(defs, rank, suit),)]
+    if rank-2 >= RANKS[0]:
+        terms.append((opp_run_ladder(defs, rank-2, rank-1, suit),))
+    if rank+2 <= RANKS[-1]:
+        terms.append((opp_run_ladder(defs, rank+1, rank+2, suit),))
+    if rank-1 >= RANKS[0] and rank+1 <= RANKS[-1]:
+        terms.append((Opponent(rank-1, suit), Opponent(rank+1, suit)))
+    return defs, terms
+
+def ladder_formula(terms):
+    '''The disjunction of terms of opp_meld_ladder as an nnf formula, without a one-child Or or And.'''
+    options = [term[0] if len(term) == 1 else And(list(term)) for term in terms]
+    return options[0] if len(options) == 1 else Or(options)
+
+def opp_meld_with(T: TheoryBuilder, card, meld_encoding=None):
+    '''
+    Returns a formula saying the opponent holds two other cards that make a meld with card.
+    "direct" lists the other cards of every meld with card; "ladder" defines the auxiliary variables of opp_meld_ladder
+    in T, once per game.
+    '''
+    if (meld_encoding or MELD_ENCODING) == "direct":
+        return Or(Opponent(card[0], card[1]).related_cards())
+    defs, terms = opp_meld_ladder(card)
+    for aux, aux_terms in defs:
+        define(T, aux, ladder_formula(aux_terms))
+    return Or([ladder_formula([term]) for term in terms])
+
+def card_placement_theory(T: TheoryBuilder, cards) -> TheoryBuilder:
+    for card in cards:
+        T.add_exactly_one(Player(card[0], card[1]), Opponent(card[0], card[1]), Deck(card[0], card[1]), Dump(card[0], card[1]))
+        T.add_constraint(Deck(card[0],card[1])>> Pl_want(card[0], card[1]))
+        T.add_constraint((Dump(card[0], card[1]) | Opponent(card[0],card[1]) | Player(card[0],card[1]) ) >> ~Pl_want(card[0], card[1]))
+    return T
+
+@lru_cache(maxsize=None)
+def base_theory_builder() -> TheoryBuilder:
+    '''The card placement constraints of every card of LAYOUT, to be forked (never added to) by the theories of a game state.'''
+    T = TheoryBuilder()
+    with profiling.family("card placement", T):
+        return card_placement_theory(T, LAYOUT.cards)
+
+def opponent_theory(opp_pickup_list, opp_not_pickup_list, opp_discard_list, T=None, meld_encoding=None) -> TheoryBuilder:
+    '''
+    Adds the constraints that do not depend on the player's hand (card placement and the opponent's observed moves) to T,
+    a new TheoryBuilder if none is given. The result can be forked for every candidate hand of the player.
+    meld_encoding is "direct" or "ladder" (see opp_meld_with), MELD_ENCODING by default.
+    '''
     global deck, discarded_pile
     opp_not_want_list = []
     #-------------------------------------------------------------------------------------------------------
@@ -250,15 +379,53 @@ def example_theory(player_cards, opp_pickup_list, opp_not_pickup_list, opp_disca
     #             If card(a,b) is in the deck, then the player want it
     #             If card(a,b) is in the dump, or in the opponent's hand, or in the player's hand, then the player does not want it
     #-------------------------------------------------------------------------------------------------------
-    for card in deck:
-        constraint.add_exactly_one(E, Player(card[0], card[1]), Opponent(card[0], card[1]), Deck(card[0], card[1]), Dump(card[0], card[1]))
-        E.add_constraint(Deck(card[0],card[1])>> Pl_want(card[0], card[1]))
-        E.add_constraint((Dump(card[0], card[1]) | Opponent(card[0],card[1]) | Player(card[0],card[1]) ) >> ~Pl_want(card[0], card[1]))
+    if T is None:
+        with profiling.family("base theory", None):
+            T = base_theory_builder().fork() # the card placement constraints are built once per process
+    else:
+        with profiling.family("card placement", T):
+            card_placement_theory(T, deck)
+    #-------------------------------------------------------------------------------------------------------
+    # CONSTRAINT: If opponent picks a card of “a” rank and “b” suit, then opponent has that card
+    #             If the opponent picks a card of “a” rank and “b” suit, that card must create a meld or contribute to an existing meld.
+    #-------------------------------------------------------------------------------------------------------
+    with profiling.family("opponent pick", T):
+        for opp_pick_card in opp_pickup_list:
+            T.add_constraint(Opp_pick(opp_pick_card[0], opp_pick_card[1]))
+            T.add_constraint(Opp_pick(opp_pick_card[0], opp_pick_card[1]) >> Opponent(opp_pick_card[0], opp_pick_card[1]))
+            T.add_constraint(Opp_pick(opp_pick_card[0], opp_pick_card[1])>> opp_meld_with(T, opp_pick_card, meld_encoding))
+    with profiling.family("opponent not pick", T):
+        for opp_not_pick in opp_not_pickup_list:
+            T.add_constraint(~Opp_pick(opp_not_pick[0], opp_not_pick[1]))
+            T.add_constraint(~Opp_pick(opp_not_pick[0], opp_not_pick[1]) >> ~(Opponent(opp_not_pick[0], opp_not_pick[1])))
+            T.add_constraint(~Opp_pick(opp_not_pick[0], opp_not_pick[1]) >> Dump(opp_not_pick[0], opp_not_pick[1]))
+            opp_not_want_list.append(opp_not_pick)
+    #-------------------------------------------------------------------------------------------------------
+    # CONSTRAINT: If the opponent discards a card of “a” rank and “b” suit, the opponent does not have any meld related to that card. 
+    #-------------------------------------------------------------------------------------------------------
+    with profiling.family("opponent discard", T):
+        for opp_discard_card in opp_discard_list:
+            T.add_constraint(Opp_discard(opp_discard_card[0], opp_discard_card[1])) 
+            T.add_constraint(Opp_discard(opp_discard_card[0], opp_discard_card[1]) >> ~Opponent(opp_discard_card[0], opp_discard_card[1]))
+            opp_not_want_list.append(opp_discard_card)
+    #-------------------------------------------------------------------------------------------------------
+    # CONSTRAINT: If the opponent does not want card (a,b), i.e., opponent does not pick or discard it, then they do not have related card that makes card (a,b) into a meld
+    #-------------------------------------------------------------------------------------------------------
+    with profiling.family("opponent not want", T):
+        for card in opp_not_want_list: 
+            # for every meld with card (a,b), the opponent is missing at least one of its other cards
+            no_meld = ~opp_meld_with(T, card, meld_encoding)
+            T.add_constraint(Opp_discard(card[0], card[1]) >> no_meld)
+            T.add_constraint(~Opp_pick(card[0], card[1]) >> no_meld)    
+    return T
+
+def player_theory(T: TheoryBuilder, player_cards, dumped=()) -> TheoryBuilder:
+    '''Adds the constraints on the player's hand, melds and wanted cards to T, leaving out the wanted cards known to be in the dump.'''
     #-------------------------------------------------------------------------------------------------------
     # CONSTRAINT: If the card is in player card list, then the player must have that card
     #-------------------------------------------------------------------------------------------------------
     for card in player_cards:
-        E.add_constraint(Player(card[0], card[1]))
+        T.add_constraint(Player(card[0], card[1]))
     #-------------------------------------------------------------------------------------------------------
     # CONSTRAINT: Definition of a SET in player_cards
     #             Definition of a RUN in player_cards
@@ -266,108 +433,882 @@ def example_theory(player_cards, opp_pickup_list, opp_not_pickup_list, opp_disca
     pl_info_list = meld_list_generator(list(player_cards))
     for meld in pl_info_list[0]: # [('A', [3, 4, 5]), (8, {'A', 'C', 'B', 'D'})]
         if meld[0] in RANKS: # the meld is a set
-            excl_suit_list = list(set(SUITS).difference(meld[1]))
+            excl_suit_list = sorted(set(SUITS).difference(meld[1]))
             excl_suit = 'Z'
             if len(excl_suit_list)>0:
                 excl_suit = excl_suit_list[0]
-            E.add_constraint(Pl_set(meld[0], excl_suit))
+            T.add_constraint(Pl_set(meld[0], excl_suit))
         elif meld[0] in SUITS: # the meld is a run
             from_index = meld[1][0]
             to_index = meld[1][-1]
-            E.add_constraint(Pl_run(from_index, to_index, meld[0]))
-    #-------------------------------------------------------------------------------------------------------
-    # CONSTRAINT: If opponent picks a card of “a” rank and “b” suit, then opponent has that card
-    #             If the opponent picks a card of “a” rank and “b” suit, that card must create a meld or contribute to an existing meld.
-    #-------------------------------------------------------------------------------------------------------
-    for opp_pick_card in opp_pickup_list:
-        E.add_constraint(Opp_pick(opp_pick_card[0], opp_pick_card[1]))
-        E.add_constraint(Opp_pick(opp_pick_card[0], opp_pick_card[1]) >> Opponent(opp_pick_card[0], opp_pick_card[1]))
-        predecessors = Opponent(opp_pick_card[0], opp_pick_card[1]).related_cards()
-        E.add_constraint(Opp_pick(opp_pick_card[0], opp_pick_card[1])>> Or(predecessors))
-    for opp_not_pick in opp_not_pickup_list:
-        E.add_constraint(~Opp_pick(opp_not_pick[0], opp_not_pick[0]))
-        E.add_constraint(~Opp_pick(opp_not_pick[0], opp_not_pick[0]) >> ~(Opponent(opp_not_pick[0], opp_not_pick[1])))
-        E.add_constraint(~Opp_pick(opp_not_pick[0], opp_not_pick[0]) >> Dump(opp_not_pick[0], opp_not_pick[1]))
-        opp_not_want_list.append(opp_not_pick)
-    #-------------------------------------------------------------------------------------------------------
-    # CONSTRAINT: If the opponent discards a card of “a” rank and “b” suit, the opponent does not have any meld related to that card. 
-    #-------------------------------------------------------------------------------------------------------
-    for opp_discard_card in opp_discard_list:
-        E.add_constraint(Opp_discard(opp_discard_card[0], opp_discard_card[1])) 
-        E.add_constraint(Opp_discard(opp_discard_card[0], opp_discard_card[1]) >> ~Opponent(opp_discard_card[0], opp_discard_card[1]))
-        opp_not_want_list.append(opp_discard_card)
-    #-------------------------------------------------------------------------------------------------------
-    # CONSTRAINT: If the opponent does not want card (a,b), i.e., opponent does not pick or discard it, then they do not have related card that makes card (a,b) into a meld
-    #-------------------------------------------------------------------------------------------------------
-    for card in opp_not_want_list: 
-        predecessors = [] # 2D array list of conjunctions - all possible combination of meld 
-        # list of all possible SETS with opp_pick_card:
-        excl_suit_list = list(set(SUITS).difference(card[1]))
-        combination_list = list(combinations(excl_suit_list, 2))
-        combination_list.append(excl_suit_list) # add possible set of 4 with opp_pick_card
-        for comb in combination_list:
-            temp_list = []
-            for each_suit in comb:
-                temp_list.append(Opponent(card[0], each_suit))
-            predecessors.append(Or(temp_list))
-        # list of all possible RUNS with opp_pick_card:
-        temp_list = [card[0]]
-        opp_c_list = []
-        for upper_r in range(card[0]+1, RANKS[-1]+1):
-            temp_list.append(upper_r)
-            for x in list(temp_list):
-                opp_c_list.append(Opponent(x, card[1]))
-            predecessors.append(~And(list(opp_c_list))) # a copy of the current list with opp card objects
-        temp_list = [card[0]]
-        opp_c_list = []
-        for lower_r in reversed(range(RANKS[0], card[0])):
-            temp_list.insert(0, lower_r)
-            for x in list(temp_list):
-                opp_c_list.append(Opponent(x, card[1]))
-            predecessors.append(~(And(list(opp_c_list)))) # a copy of the current list with opp card objects
-        E.add_constraint(Opp_discard(card[0], card[1]) >> Or(predecessors))
-        E.add_constraint(~Opp_pick(card[0], card[1]) >> Or(predecessors))    
+            T.add_constraint(Pl_run(from_index, to_index, meld[0]))
     #-------------------------------------------------------------------------------------------------------
     # CONSTRAINT: If the opponent has card(a,b), we assume they will not discard it, so the player does not want that card
     #-------------------------------------------------------------------------------------------------------
-    pl_info_list = meld_list_generator(list(player_cards))
     pl_wanting_list = pl_info_list[2]
     for wanting_c in pl_wanting_list:
-        E.add_constraint(Pl_want(wanting_c[0], wanting_c[1]))
-        E.add_constraint(Opponent(wanting_c[0], wanting_c[1]) >> ~ Pl_want(wanting_c[0], wanting_c[1]))
-    return E
+        if wanting_c in dumped or wanting_c in player_cards: # the other suit of a potential set may be held in a run
+            continue
+        T.add_constraint(Pl_want(wanting_c[0], wanting_c[1]))
+        T.add_constraint(Opponent(wanting_c[0], wanting_c[1]) >> ~ Pl_want(wanting_c[0], wanting_c[1]))
+    return T
+
+# exact number of cards in the player's hand, the opponent's hand and the deck at a decision; the dump holds the rest
+GameCounts = namedtuple('GameCounts', ['player', 'opponent', 'deck'])
+
+COUNTED_PLACES = (Player, Opponent, Deck) # the fields of GameCounts; Dump follows from them and the card placement
+
+def card_count_var(T: TheoryBuilder, place, depth: int) -> list:
+    '''
+    Sequential counter over place(card) for the cards of LAYOUT: returns the registers [Card_count(place, n, k) for k in 1..depth],
+    at least k of the n cards are in place. Every register is defined from the row before it, so the counter adds no models.
+    '''
+    prev = [] # registers of the cards so far, prev[k-1]: at least k of them
+    for i, card in enumerate(LAYOUT.cards):
+        x = place(card[0], card[1])
+        row = []
+        for k in range(1, min(i + 1, depth) + 1):
+            with_card = x if k == 1 else x & prev[k-2]
+            define(T, Card_count(place.__name__, i + 1, k), prev[k-1] | with_card if k <= len(prev) else with_card)
+            row.append(Card_count(place.__name__, i + 1, k))
+        prev = row
+    return prev
+
+def exactly_theory(T: TheoryBuilder, place, k: int) -> None:
+    '''CONSTRAINT: exactly k cards are in place, encoded with a sequential counter rather than by listing the combinations'''
+    if k == 0 or k == LAYOUT.num_cards:
+        for card in LAYOUT.cards:
+            T.add_constraint(place(card[0], card[1]) if k else ~place(card[0], card[1]))
+        return
+    registers = card_count_var(T, place, k + 1)
+    T.add_constraint(registers[k-1])
+    T.add_constraint(~registers[k])
+
+def counts_theory(T: TheoryBuilder, counts: GameCounts) -> TheoryBuilder:
+    '''Adds the number of cards in the player's hand, the opponent's hand and the deck to T.'''
+    for place, k in zip(COUNTED_PLACES, counts):
+        exactly_theory(T, place, k)
+    return T
+
+def example_theory(player_cards, opp_pickup_list, opp_not_pickup_list, opp_discard_list, T=None, meld_encoding=None, counts=None) -> TheoryBuilder:
+    '''Builds the theory of one game state into T, a new TheoryBuilder if none is given. counts (GameCounts) adds the hand, deck and dump sizes.'''
+    T = opponent_theory(opp_pickup_list, opp_not_pickup_list, opp_discard_list, T, meld_encoding)
+    with profiling.family("player melds", T):
+        player_theory(T, player_cards, opp_not_pickup_list) # the cards the opponent passed on are in the dump
+    if counts is not None:
+        with profiling.family("card counts", T):
+            counts_theory(T, counts)
+    return T
+
+CARD_PROPS = (Player, Opponent, Deck, Dump, Pl_want) # the propositions with one variable per card
+
+def new_varmap() -> VarMap:
+    '''Variable numbering shared by the CNF theories of a deck configuration: the per-card propositions come first, in LAYOUT order.'''
+    return VarMap(LAYOUT, CARD_PROPS)
+
+def opp_meld_with_var(S: ClauseStore, others) -> int:
+    '''Literal of an auxiliary variable that is true exactly when the opponent holds both cards in others, shared by every card.'''
+    x, y = sorted(others)
+    aux = S.pos(("opp_holds", x, y))
+    if aux not in S.defined: # define aux <-> O(x) & O(y) once
+        S.defined.add(aux)
+        S.add(-aux, S.pos(Opponent(x[0], x[1])))
+        S.add(-aux, S.pos(Opponent(y[0], y[1])))
+        S.add(aux, S.neg(Opponent(x[0], x[1])), S.neg(Opponent(y[0], y[1])))
+    return aux
+
+def define_cnf(S: ClauseStore, aux, terms) -> int:
+    '''Literal of aux, defined once per store as true exactly when one of terms (tuples of propositions, all true) is, see opp_meld_ladder.'''
+    lit = S.pos(aux)
+    if lit not in S.defined:
+        S.defined.add(lit)
+        terms = [[S.pos(prop) for prop in term] for term in terms]
+        for choice in product(*terms): # aux -> one of the terms, distributed over their propositions
+            S.add_clause([-lit] + list(choice))
+        for term in terms: # every term -> aux
+            S.add_clause([lit] + [-x for x in term])
+    return lit
+
+def opp_meld_lits(S: ClauseStore, card, meld_encoding=None) -> list:
+    '''
+    Literals of which one is true exactly when the opponent holds two other cards that make a meld with card, the clause
+    counterpart of opp_meld_with(): "direct" has one per meld, "ladder" one per term of opp_meld_ladder, whose auxiliary
+    variables it defines with define_cnf.
+    '''
+    if (meld_encoding or MELD_ENCODING) == "direct":
+        return [opp_meld_with_var(S, others) for others in CATALOGUE.completions(card)]
+    defs, terms = opp_meld_ladder(card)
+    for aux, aux_terms in defs:
+        define_cnf(S, aux, aux_terms)
+    return [S.pos(term[0]) if len(term) == 1 else opp_meld_with_var(S, [(prop.rank, prop.suit) for prop in term]) for term in terms]
+
+def card_placement_cnf(S: ClauseStore, cards) -> None:
+    '''CONSTRAINT: Card(a,b) is either in the player's hand, the opponent's hand, the deck, or in the dump, and the player only wants deck cards'''
+    for card in cards:
+        p, o, de, du, w = (S.pos(prop(card[0], card[1])) for prop in (Player, Opponent, Deck, Dump, Pl_want))
+        S.add(p, o, de, du)
+        S.add(-p, -o); S.add(-p, -de); S.add(-p, -du); S.add(-o, -de); S.add(-o, -du); S.add(-de, -du)
+        S.add(-de, w)
+        S.add(-du, -w); S.add(-o, -w); S.add(-p, -w)
+
+def base_cnf(layout=None) -> ClauseStore:
+    '''The card placement clauses of every card of a deck configuration (LAYOUT by default), the part of every theory that no observation changes.'''
+    layout = layout or LAYOUT
+    S = ClauseStore(VarMap(layout, CARD_PROPS))
+    with profiling.family("card placement", S):
+        card_placement_cnf(S, layout.cards)
+    return S
+
+def base_theory_path(layout=None) -> str:
+    layout = layout or LAYOUT
+    return os.path.join(BASE_THEORY_DIR, f"base_{layout.ranks[0]}-{layout.ranks[-1]}_{''.join(layout.suits)}.bin")
+
+def build_base_theory(layout=None) -> str:
+    '''Build step: compiles the base CNF of a deck configuration with dsharp and writes both to base_theory_path(). Returns the path.'''
+    layout = layout or LAYOUT
+    S = base_cnf(layout)
+    path = base_theory_path(layout)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    config = {'ranks': list(layout.ranks), 'suits': list(layout.suits), 'props': [prop.__name__ for prop in CARD_PROPS]}
+    base_theory.save(path, config, S, S.compile())
+    return path
+
+@lru_cache(maxsize=None)
+def load_base_theory() -> base_theory.BaseTheory:
+    '''The base theory of LAYOUT mapped from its file, which is built on first use if the build step has not made it.'''
+    path = base_theory_path()
+    config = {'ranks': list(LAYOUT.ranks), 'suits': list(LAYOUT.suits), 'props': [prop.__name__ for prop in CARD_PROPS]}
+    try:
+        base = base_theory.BaseTheory(path)
+        if all(base.header.get(key) == value for key, value in config.items()):
+            return base
+    except (FileNotFoundError, ValueError):
+        pass
+    build_base_theory()
+    return base_theory.BaseTheory(path)
+
+def base_store() -> ClauseStore:
+    '''A new ClauseStore over new_varmap() that starts with the base clauses.'''
+    return load_base_theory().store(new_varmap())
+
+@lru_cache(maxsize=None)
+def base_sentence():
+    '''The d-DNNF of the base clauses over the variable names, shared by every InferenceSession of the process.'''
+    return load_base_theory().sentence(new_varmap().names)
+
+def opp_pick_cnf(S: ClauseStore, card, meld_encoding=None) -> None:
+    '''CONSTRAINT: If opponent picks card (a,b), then opponent has that card and it makes a meld with two other cards they hold'''
+    pick = S.pos(Opp_pick(card[0], card[1]))
+    S.add(pick)
+    S.add(-pick, S.pos(Opponent(card[0], card[1])))
+    S.add_clause([-pick] + opp_meld_lits(S, card, meld_encoding))
+
+def opp_not_pick_cnf(S: ClauseStore, card) -> None:
+    '''CONSTRAINT: If opponent does not pick card (a,b), it goes to the dump'''
+    pick = S.pos(Opp_pick(card[0], card[1]))
+    S.add(-pick)
+    S.add(pick, S.neg(Opponent(card[0], card[1])))
+    S.add(pick, S.pos(Dump(card[0], card[1])))
+
+def opp_discard_cnf(S: ClauseStore, card) -> None:
+    '''CONSTRAINT: If the opponent discards card (a,b), the opponent does not have that card'''
+    discard = S.pos(Opp_discard(card[0], card[1]))
+    S.add(discard)
+    S.add(-discard, S.neg(Opponent(card[0], card[1])))
+
+def opp_not_want_cnf(S: ClauseStore, card, meld_encoding=None) -> None:
+    '''CONSTRAINT: If the opponent does not want card (a,b), they do not hold the other cards of any meld with it'''
+    discard, pick = S.pos(Opp_discard(card[0], card[1])), S.pos(Opp_pick(card[0], card[1]))
+    for aux in opp_meld_lits(S, card, meld_encoding):
+        S.add(-discard, -aux)
+        S.add(pick, -aux)
+
+def opponent_cnf(opp_pickup_list, opp_not_pickup_list, opp_discard_list, S=None, meld_encoding=None) -> ClauseStore:
+    '''
+    Same theory as opponent_theory(), written as integer clauses into the ClauseStore S (a new one over new_varmap() if
+    none is given) without building nnf formulas. meld_encoding is "direct" or "ladder" (see opp_meld_lits), MELD_ENCODING by default.
+    '''
+    global deck
+    if S is None:
+        with profiling.family("base theory", None):
+            S = base_store() # the card placement clauses, precompiled
+    else:
+        with profiling.family("card placement", S):
+            card_placement_cnf(S, deck)
+    with profiling.family("opponent pick", S):
+        for card in opp_pickup_list:
+            opp_pick_cnf(S, card, meld_encoding)
+    with profiling.family("opponent not pick", S):
+        for card in opp_not_pickup_list:
+            opp_not_pick_cnf(S, card)
+    with profiling.family("opponent discard", S):
+        for card in opp_discard_list:
+            opp_discard_cnf(S, card)
+    with profiling.family("opponent not want", S):
+        for card in list(opp_not_pickup_list) + list(opp_discard_list):
+            opp_not_want_cnf(S, card, meld_encoding)
+    return S
+
+# Games with N opponents: the theory of every seat is the one-opponent theory, with Opponent standing for that seat and
+# Deck for every card the player has not seen and the seat does not hold (the deck and the other seats' hands), so that
+# the seats are inferred independently. The joint theory renames the variables of every seat into its own family.
+
+SHARED_PROPS = (Player, Deck, Dump, Pl_want, Pl_run, Pl_set) # the player's side of the theory, the same for every seat
+
+def seat_name(seat: int, name):
+    '''The name in the joint theory of a variable of the one-opponent theory of seat.'''
+    factory = getattr(name, '_factory', None)
+    if factory is Opponent:
+        return Opponent_at(seat, *name._key)
+    if factory in SHARED_PROPS:
+        return name
+    return ("seat", seat, name) # the opponent's picks, discards and meld variables
+
+def known_dump_cnf(S: ClauseStore, card) -> None:
+    '''CONSTRAINT: a card that the seat after its discarder passed on is in the dump'''
+    S.add(S.pos(Dump(card[0], card[1])))
+
+def held_elsewhere_cnf(S: ClauseStore, card) -> None:
+    '''CONSTRAINT: a card another opponent picked up (and still holds) is not this seat's, and is among the cards the player has not seen'''
+    S.add(S.pos(Deck(card[0], card[1])))
+
+def seat_placement_cnf(S: ClauseStore, cards, seats: int) -> None:
+    '''CONSTRAINT: Card(a,b) is in exactly one of the player's hand, the hand of one of the seats, the deck or the dump, and the player only wants deck cards'''
+    for card in cards:
+        de, w = S.pos(Deck(card[0], card[1])), S.pos(Pl_want(card[0], card[1]))
+        places = [S.pos(Player(card[0], card[1])), de, S.pos(Dump(card[0], card[1]))]
+        places += [S.pos(Opponent_at(seat, card[0], card[1])) for seat in range(1, seats + 1)]
+        S.add_clause(places)
+        for i, x in enumerate(places):
+            for y in places[i+1:]:
+                S.add(-x, -y)
+            S.add(-x, w if x == de else -w)
+
+def joint_cnf(player_cards, seats, dumped=(), S=None) -> ClauseStore:
+    '''
+    The theory of a game with len(seats) opponents, seats[i] being the (opp_pickup_list, opp_not_pickup_list,
+    opp_discard_list) of seat i + 1: the observations of every seat in its own family of variables, over one card
+    placement. Its size grows with the number of seats, and its count is not the product of the seats', so it is only
+    meant for a joint model (solve), when the per-seat theories are not enough.
+    '''
+    S = ClauseStore(VarMap()) if S is None else S
+    seat_placement_cnf(S, LAYOUT.cards, len(seats))
+    for seat, (opp_pickup_list, opp_not_pickup_list, opp_discard_list) in enumerate(seats, 1):
+        scratch = ClauseStore(VarMap())
+        for card in opp_pickup_list:
+            opp_pick_cnf(scratch, card)
+        for card in opp_not_pickup_list:
+            opp_not_pick_cnf(scratch, card)
+        for card in opp_discard_list:
+            opp_discard_cnf(scratch, card)
+        for card in list(opp_not_pickup_list) + list(opp_discard_list):
+            opp_not_want_cnf(scratch, card)
+        player_cnf(scratch, player_cards, dumped) # the player's wanted cards are not held by any seat
+        for clause in scratch.named():
+            S.add_named(tuple((seat_name(seat, name), value) for name, value in clause))
+    for card in dumped:
+        known_dump_cnf(S, card)
+    return S
+
+def player_cnf(S: ClauseStore, player_cards, dumped=()) -> ClauseStore:
+    '''
+    Same constraints as player_theory(), written as integer clauses into S. The wanted cards known to be in the dump are
+    left out as well as the wanted cards the player holds, as neither can be drawn. Every other wanted card is put in the
+    deck, so a state where the opponent's picks prove they hold one (the picked card itself, or the only cards it can meld
+    with) has no model: the theory has no notion of time either, and such states are reported as not satisfiable.
+    '''
+    for card in player_cards:
+        S.add(S.pos(Player(card[0], card[1])))
+    pl_info_list = meld_list_generator(list(player_cards))
+    for meld in pl_info_list[0]:
+        if meld[0] in RANKS: # the meld is a set
+            excl_suit_list = sorted(set(SUITS).difference(meld[1]))
+            S.add(S.pos(Pl_set(meld[0], excl_suit_list[0] if len(excl_suit_list)>0 else 'Z')))
+        elif meld[0] in SUITS: # the meld is a run
+            S.add(S.pos(Pl_run(meld[1][0], meld[1][-1], meld[0])))
+    for wanting_c in pl_info_list[2]:
+        if wanting_c in dumped or wanting_c in player_cards:
+            continue
+        w = S.pos(Pl_want(wanting_c[0], wanting_c[1]))
+        S.add(w)
+        S.add(S.neg(Opponent(wanting_c[0], wanting_c[1])), -w)
+    return S
+
+def card_count_cnf(S: ClauseStore, place, depth: int) -> list:
+    '''Same counter as card_count_var(), as clauses: the literals of the registers "at least k of the cards are in place", k in 1..depth.'''
+    prev = []
+    for i, card in enumerate(LAYOUT.cards):
+        x = S.pos(place(card[0], card[1]))
+        row = []
+        for k in range(1, min(i + 1, depth) + 1):
+            r = S.pos(Card_count(place.__name__, i + 1, k))
+            row.append(r)
+            if r in S.defined:
+                continue
+            S.defined.add(r) # r <-> before | (x & below), before: at least k of the cards so far, below: at least k-1 of them
+            before = prev[k-1] if k <= len(prev) else None
+            below = prev[k-2] if k > 1 else None
+            S.add_clause([-x, r] + ([-below] if below else []))
+            S.add_clause([-r, x] + ([before] if before else []))
+            if below:
+                S.add_clause([-r, below] + ([before] if before else []))
+            if before:
+                S.add(-before, r)
+        prev = row
+    return prev
+
+def exactly_cnf(S: ClauseStore, place, k: int) -> None:
+    '''CONSTRAINT: exactly k cards are in place (sequential counter)'''
+    if k == 0 or k == LAYOUT.num_cards:
+        for card in LAYOUT.cards:
+            S.add(S.pos(place(card[0], card[1])) if k else S.neg(place(card[0], card[1])))
+        return
+    registers = card_count_cnf(S, place, k + 1)
+    S.add(registers[k-1])
+    S.add(-registers[k])
+
+def counts_cnf(S: ClauseStore, counts: GameCounts) -> ClauseStore:
+    '''Same constraints as counts_theory(), written as integer clauses into S.'''
+    for place, k in zip(COUNTED_PLACES, counts):
+        exactly_cnf(S, place, k)
+    return S
+
+def count_groups() -> dict:
+    '''The variables GameCounts counts, {place(card): index of place in COUNTED_PLACES}, for the sized counts of ddnnf.'''
+    return {place(card[0], card[1]): i for i, place in enumerate(COUNTED_PLACES) for card in LAYOUT.cards}
+
+def move_counts(counts: GameCounts, action) -> GameCounts:
+    '''
+    The counts after a move of evaluate_moves: the player holds one more card, unless they discarded one. A drawn card
+    leaves the deck (it is the player's card the theory does not name); a picked up card leaves the dump.
+    '''
+    kind, discard = action
+    return GameCounts(counts.player + 1 - (discard is not None), counts.opponent, counts.deck - (kind == "draw"))
+
+def draw_choices(hand, possible) -> int:
+    '''
+    The cards the drawn card of a draw move can be: the cards not in hand for which possible(card), i.e. Player(card) is
+    true in some model. With counts, the theory of a draw holds a player card it does not name, so its count adds up the
+    models of every card drawn, while a pick names its card; evaluate_moves divides the draw counts by this number, so
+    that both moves are counted per card taken.
+    '''
+    return sum(1 for card in LAYOUT.cards if card not in hand and possible(card))
+
+def example_cnf(player_cards, opp_pickup_list, opp_not_pickup_list, opp_discard_list, S=None, counts=None, meld_encoding=None) -> ClauseStore:
+    '''CNF counterpart of example_theory(), which can be handed to kissat (S.solve()) and dsharp (S.compile()) directly.'''
+    S = opponent_cnf(opp_pickup_list, opp_not_pickup_list, opp_discard_list, S, meld_encoding)
+    with profiling.family("player melds", S):
+        player_cnf(S, player_cards, opp_not_pickup_list) # the cards the opponent passed on are in the dump
+    if counts is not None:
+        with profiling.family("card counts", S):
+            counts_cnf(S, counts)
+    return S
+
+MoveEval = namedtuple('MoveEval', ['model_count', 'meld_count', 'model'])
+
+@profiling.profiled("evaluate_moves")
+def evaluate_moves(player_cards, face_up_card, opp_pickup_list, opp_not_pickup_list, opp_discard_list, discards=True, cache=None, budget=None, counts=None) -> dict:
+    '''
+    Evaluates every candidate move of the player with one dsharp compilation. A move is ("pick", discard) or ("draw", discard),
+    where discard is a card of player_cards or None for no discard. The constraints on the player's hand after each move
+    are guarded by a selector variable ("move", action); the theory is compiled once with the selectors free and every move
+    is counted by conditioning on its selector, which is a linear pass over the d-DNNF.
+    Returns {action: MoveEval(model_count, meld_count, model)}; the counts are the ones of the theory of that move alone.
+    With counts (GameCounts before the move), only the models with the hand and deck sizes after each move (move_counts)
+    are counted; the sizes are counted on the d-DNNF (ddnnf.count_sized) rather than compiled as cardinality constraints.
+    The count of a draw is per card drawn (draw_choices), as comparable with the count of picking up the face up card.
+    If the compilation runs over budget, the ("draw", None) and ("pick", None) moves are evaluated by approx_evaluate_moves
+    instead, which raises BudgetExceeded if it runs out of time too.
+    '''
+    with profiling.phase("encode"):
+        S = opponent_cnf(opp_pickup_list, opp_not_pickup_list, opp_discard_list)
+        base_vars = {abs(lit) for lit in S.lits}
+        hands = {}
+        for kind in ("draw", "pick"):
+            hand = list(player_cards) + ([face_up_card] if kind == "pick" else [])
+            hands[(kind, None)] = hand
+            if discards:
+                for card in player_cards:
+                    hands[(kind, card)] = [c for c in hand if c != card]
+        clauses = {action: set(player_cnf(ClauseStore(S.varmap), hand, opp_not_pickup_list)) for action, hand in hands.items()}
+        common = set.intersection(*clauses.values())
+        for clause in common:
+            S.add_clause(clause)
+        selectors = {action: S.pos(("move", action)) for action in hands}
+        for action, action_clauses in clauses.items():
+            for clause in action_clauses - common:
+                S.add_clause(clause + (-selectors[action],))
+    try:
+        with profiling.phase("compile"):
+            sentence = S.compile(cache=cache, budget=budget)
+    except BudgetExceeded:
+        return approx_evaluate_moves(hands, opp_pickup_list, opp_not_pickup_list, opp_discard_list, counts=counts)
+    all_vars = set(range(1, len(S.varmap)+1)) - set(selectors.values())
+    groups = count_groups()
+    results = {}
+    for action, hand in hands.items():
+        assignment = {("move", other): other == action for other in hands}
+        # variables that only occur in the constraints of other moves are free here, and are not in the theory of this move alone
+        used = base_vars.union(*({abs(lit) for lit in clause} for clause in common | clauses[action]))
+        if counts is None:
+            with profiling.phase("count"):
+                num_models = ddnnf.count(sentence, assignment) >> len(all_vars - used)
+            with profiling.phase("solve"):
+                model = ddnnf.solve(sentence, assignment) if num_models > 0 else None
+        else:
+            sizes = move_counts(counts, action)
+            with profiling.phase("count"):
+                if action[0] == "draw":
+                    num_models, true_counts = ddnnf.marginals_sized(sentence, groups, sizes, assignment)
+                    choices = draw_choices(hand, lambda card: true_counts.get(Player(card[0], card[1]), 0) > 0)
+                    num_models = (num_models >> len(all_vars - used)) // max(choices, 1)
+                else:
+                    num_models = ddnnf.count_sized(sentence, groups, sizes, assignment) >> len(all_vars - used)
+            with profiling.phase("solve"):
+                model = ddnnf.solve_sized(sentence, groups, sizes, assignment) if num_models > 0 else None
+        results[action] = MoveEval(num_models, len(meld_list_generator(hand)[0]), model)
+    return results
+
+def approx_evaluate_moves(hands, opp_pickup_list, opp_not_pickup_list, opp_discard_list, epsilon=None, delta=None, rng=None, counts=None,
+                          seconds=None, iterations=None) -> dict:
+    '''
+    evaluate_moves without compilation, for theories too large for dsharp: hands is {action: player's hand after the move}.
+    Only the ("draw", None) and ("pick", None) moves that recommend compares are evaluated, each in its share of seconds
+    (APPROX_SECONDS). A move is counted with approx.approx_count, within a factor 1 + epsilon with probability 1 - delta
+    but with at most iterations (APPROX_ITERATIONS) repetitions, and its model is one found by the SAT backend. With counts,
+    the sizes after the move are counted on approx.size_polynomial rather than encoded as cardinality constraints, and a
+    draw is counted per card drawn, over the cards that unit propagation leaves possible. The
+    moves share the opponent's constraints, so the counts of their components are shared. Raises BudgetExceeded if a
+    move gets no estimate in its share of the time.
+    '''
+    epsilon = epsilon or APPROX_EPSILON
+    delta = delta or APPROX_DELTA
+    iterations = iterations or APPROX_ITERATIONS
+    end = time.perf_counter() + (seconds or APPROX_SECONDS)
+    rng = rng or random.Random()
+    memo = {}
+    results = {}
+    actions = [action for action in (("draw", None), ("pick", None)) if action in hands]
+    for i, action in enumerate(actions):
+        deadline = time.perf_counter() + (end - time.perf_counter()) / (len(actions) - i)
+        hand = hands[action]
+        T = example_cnf(hand, opp_pickup_list, opp_not_pickup_list, opp_discard_list)
+        if counts is None:
+            num_models = approx.approx_count(T, epsilon, delta, rng=rng, iterations=iterations, memo=memo, deadline=deadline)
+        else:
+            sizes = move_counts(counts, action)
+            poly = approx.size_polynomial(T, count_groups(), sizes, epsilon, delta, rng=rng, iterations=iterations, memo=memo, deadline=deadline)
+            num_models = poly.get(tuple(sizes), 0)
+            if action[0] == "draw": # the cards not ruled out by unit propagation, a bound on draw_choices
+                units = (approx.decompose(T) or ({}, []))[0]
+                num_models //= max(draw_choices(hand, lambda card: units.get(T.varmap.var(Player(card[0], card[1]))) is not False), 1)
+        model = T.solve() if num_models > 0 else None
+        results[action] = MoveEval(num_models, len(meld_list_generator(hand)[0]), model)
+    return results
+
+MARGINAL_PROPS = (Opponent, Deck, Dump, Pl_want)
+
+def card_marginals(sentence, assignment=None, props=MARGINAL_PROPS, counts=None, context=None):
+    '''
+    Probability of every card proposition over the models of a smooth d-DNNF, from one pass of ddnnf.marginals.
+    Returns an array of shape (len(props), LAYOUT.num_cards): row i is props[i], column LAYOUT.index(card) is the card.
+    All zeros if the sentence has no model under assignment. With counts (GameCounts) only the models with those hand
+    and deck sizes are counted; context is then the size polynomial of the parts of the theory outside the sentence.
+    '''
+    assignment = assignment or {}
+    if counts is None:
+        num_models, true_counts = ddnnf.marginals(sentence, assignment)
+    else:
+        num_models, true_counts = ddnnf.marginals_sized(sentence, count_groups(), counts, assignment, context)
+    result = np.zeros((len(props), LAYOUT.num_cards))
+    if num_models == 0:
+        return result
+    for row, prop in enumerate(props):
+        for column, card in enumerate(LAYOUT.cards):
+            name = prop(card[0], card[1])
+            if name in true_counts:
+                result[row, column] = true_counts[name] / num_models
+            elif name in assignment:
+                result[row, column] = float(assignment[name])
+            else: # not in the sentence, so it is free
+                result[row, column] = 0.5
+    return result
+
+def sampled_marginals(store, num_samples=MARGINAL_SAMPLES, props=MARGINAL_PROPS, epsilon=None, rng=None, samples=None, weight=None):
+    '''
+    card_marginals of a theory too large to compile, estimated from near-uniform samples (approx.sample) of store, or from
+    the given samples. weight(sample) weighs every sample, e.g. by the models of the rest of a theory it is conjoined with.
+    All zeros if there is no sample of positive weight.
+    '''
+    if samples is None:
+        samples = approx.sample(store, num_samples, epsilon or APPROX_EPSILON, rng=rng)
+    result = np.zeros((len(props), LAYOUT.num_cards))
+    total = 0
+    for sample in samples:
+        w = 1 if weight is None else weight(sample)
+        total += w
+        if not w:
+            continue
+        for row, prop in enumerate(props):
+            for column, card in enumerate(LAYOUT.cards):
+                result[row, column] += w * sample.get(prop(card[0], card[1]), False)
+    return result / total if total else result
+
+Estimate = namedtuple('Estimate', ['model_count', 'opponent_cards', 'model'])
+
+class InferenceSession:
+    '''
+    Round-by-round inference of the opponent's hand. The card placement constraints are compiled once. The observations of
+    every round are split into unit literals, which are applied by conditioning, and meld clauses, which are grouped into
+    connected components (cards linked by meld constraints) that are compiled on their own. A round only compiles the
+    components its observations change, so the cost of an estimate stays flat as the game grows.
+    A component that dsharp cannot compile within budget makes estimate() raise BudgetExceeded, while marginals() estimates
+    the marginals of its cards from near-uniform samples (sampled_marginals) instead.
+    '''
+    def __init__(self, cards=None, cache=None, budget=None, samples=MARGINAL_SAMPLES):
+        self.cards = list(deck if cards is None else cards)
+        self.cache = cache
+        self.budget = budget
+        self.samples = samples
+        if set(self.cards) == set(LAYOUT.cards):
+            self.static = base_sentence()
+        else:
+            static = ClauseStore(new_varmap())
+            card_placement_cnf(static, self.cards)
+            self.static = static.compile(cache=cache)
+        block = ClauseStore(VarMap())
+        card_placement_cnf(block, self.cards[:1])
+        self.block_count = block.model_count(cache) # models of the placement of a single card
+        self.opponent_vars = {Opponent(card[0], card[1]): card for card in self.cards}
+        self.units = {} # name -> value, observed so far
+        self.dumped = set() # cards known to be in the dump: those the opponent passed on, and see observe_known
+        self.conflict = False # two observations fixed a variable to different values
+        self.clauses = set() # meld clauses observed so far, as frozensets of (name, value)
+        self.compiled = {} # component (frozenset of clauses) -> (d-DNNF, cards of the component)
+        self.over_budget = set() # components that dsharp could not compile within budget
+
+    def _add(self, emit, card) -> None:
+        scratch = ClauseStore(VarMap())
+        emit(scratch, card)
+        self._split(scratch.named(), self.units, self.clauses)
+
+    def _split(self, clauses, units, non_units) -> None:
+        for clause in clauses:
+            if len(clause) == 1:
+                name, value = clause[0]
+                if units.get(name, value) != value:
+                    self.conflict = True
+                units[name] = value
+            else:
+                non_units.add(frozenset(clause))
+
+    def observe(self, opp_pickup, opp_discard) -> None:
+        '''Adds the observations of one round: opp_pickup = (picked up?, card) and the card opp_discard, as returned by one_round_of_game_opp_pl.'''
+        picked, card = opp_pickup
+        if picked:
+            self._add(opp_pick_cnf, card)
+        else:
+            self._add(opp_not_pick_cnf, card)
+            self._add(opp_not_want_cnf, card)
+            self.dumped.add(tuple(card))
+        self._add(opp_discard_cnf, opp_discard)
+        self._add(opp_not_want_cnf, opp_discard)
+
+    def observe_known(self, dumped=(), elsewhere=()) -> None:
+        '''Adds what the other seats of a game with several opponents tell about this one: cards in the dump, and cards another seat holds.'''
+        for card in dumped:
+            self._add(known_dump_cnf, card)
+            self.dumped.add(tuple(card))
+        for card in elsewhere:
+            self._add(held_elsewhere_cnf, card)
+
+    def observe_history(self, opp_pickup_list, opp_not_pickup_list, opp_discard_list) -> None:
+        '''Adds the observations of a game state given as the lists of opponent_cnf rather than round by round.'''
+        for card in opp_pickup_list:
+            self._add(opp_pick_cnf, card)
+        for card in opp_not_pickup_list:
+            self._add(opp_not_pick_cnf, card)
+            self._add(opp_not_want_cnf, card)
+            self.dumped.add(tuple(card))
+        for card in opp_discard_list:
+            self._add(opp_discard_cnf, card)
+            self._add(opp_not_want_cnf, card)
+
+    def _components(self, clauses) -> list:
+        '''Groups the clauses that share variables (union-find over the variable names).'''
+        parent = {}
+        def find(x):
+            while parent.setdefault(x, x) != x:
+                parent[x] = parent[parent[x]]
+                x = parent[x]
+            return x
+        for clause in clauses:
+            names = [name for name, value in clause]
+            for name in names[1:]:
+                parent[find(name)] = find(names[0])
+        groups = {}
+        for clause in clauses:
+            groups.setdefault(find(next(iter(clause))[0]), set()).add(clause)
+        return [frozenset(group) for group in groups.values()]
+
+    def _compile(self, component):
+        if component in self.over_budget:
+            raise BudgetExceeded("the component ran over budget before")
+        if component not in self.compiled:
+            store, cards = self._component_store(component)
+            try:
+                self.compiled[component] = (store.compile(cache=self.cache, budget=self.budget), cards)
+            except BudgetExceeded:
+                self.over_budget.add(component)
+                raise
+        return self.compiled[component]
+
+    def _component_store(self, component, units=None):
+        '''The clauses of a component with the card placement of its cards and the units on its variables, and the cards.'''
+        cards = sorted({self.opponent_vars[name] for clause in component for name, value in clause if name in self.opponent_vars})
+        store = ClauseStore(VarMap())
+        card_placement_cnf(store, cards)
+        for clause in component:
+            store.add_named(clause)
+        for name, value in (units or {}).items():
+            if name in store.varmap.ids:
+                store.add_named(((name, value),))
+        return store, cards
+
+    @staticmethod
+    def _propagate(units: dict, clauses) -> set:
+        '''
+        Unit propagation: drops the clauses satisfied by units and the literals they falsify, adding the clauses left with one
+        literal to units. Returns the remaining clauses, or None if a clause is falsified.
+        '''
+        pending = list(clauses)
+        while True:
+            changed, remaining = False, []
+            for clause in pending:
+                if any(units.get(name) == value for name, value in clause):
+                    continue
+                left = frozenset((name, value) for name, value in clause if name not in units)
+                if not left:
+                    return None
+                if len(left) == 1:
+                    name, value = next(iter(left))
+                    units[name] = value
+                    changed = True
+                else:
+                    remaining.append(left)
+            pending = remaining
+            if not changed:
+                return set(pending)
+
+    def _condition(self, player_cards, sampled=None):
+        '''
+        Conditions the theory of the game so far on the player's hand. Returns (units, compiled components, units of the
+        static theory, number of free auxiliary variables), or None if the hand contradicts the observations. A component
+        over budget raises BudgetExceeded, unless sampled is a dict: it then gets the component's cards, {component: cards}.
+        '''
+        if self.conflict:
+            return None
+        units = dict(self.units)
+        with profiling.phase("encode"):
+            player = ClauseStore(VarMap())
+            player_cnf(player, player_cards, self.dumped)
+            self._split(player.named(), units, set()) # the player's clauses are units, or binary clauses that reduce to units
+            clauses = self._propagate(units, self.clauses | {frozenset(clause) for clause in player.named() if len(clause) > 1})
+        if clauses is None or self.conflict:
+            self.conflict = False # a conflict with this hand does not carry over to the next one
+            return None
+        with profiling.phase("compile"):
+            compiled = {}
+            for component in self._components(clauses):
+                try:
+                    compiled[component] = self._compile(component)
+                except BudgetExceeded:
+                    if sampled is None:
+                        raise
+                    sampled[component] = self._component_store(component)[1]
+        self.compiled = compiled # only the components of the current game are kept
+        component_cards = {card for sentence, cards in compiled.values() for card in cards} | {card for cards in (sampled or {}).values() for card in cards}
+        component_names = {name for component in list(compiled) + list(sampled or ()) for clause in component for name, value in clause}
+        card_vars = {prop(card[0], card[1]) for card in self.cards for prop in (Player, Opponent, Deck, Dump, Pl_want)}
+        # auxiliary variables whose clauses were all satisfied by the units are free
+        free = {name for clause in self.clauses for name, value in clause} - card_vars - component_names - units.keys()
+        component_vars = {prop(card[0], card[1]) for card in component_cards for prop in (Player, Opponent, Deck, Dump, Pl_want)}
+        rest_units = {name: value for name, value in units.items() if name not in component_vars}
+        return units, compiled, rest_units, len(free)
+
+    def _sized_parts(self, condition, counts: GameCounts, sampled=None):
+        '''
+        The independent parts of a conditioned theory as [(d-DNNF, assignment)], the static theory first, with their size
+        polynomials up to counts. In the static theory the cards of the components are fixed to one placement that counts
+        towards no size (in the dump), so that each of their placements is counted once, in its component (or in the
+        sampled components, {component: cards}, which are not among the parts).
+        '''
+        units, compiled, rest_units, num_free = condition
+        static_units = dict(rest_units)
+        for cards in [cards for sentence, cards in compiled.values()] + list((sampled or {}).values()):
+            for card in cards:
+                static_units.update({prop(card[0], card[1]): prop is Dump for prop in (Player, Opponent, Deck, Dump, Pl_want)})
+        parts = [(self.static, static_units)] + [(sentence, units) for sentence, cards in compiled.values()]
+        groups = count_groups()
+        return parts, [ddnnf.size_polynomial(sentence, groups, counts, assignment) for sentence, assignment in parts]
+
+    @profiling.profiled("estimate")
+    def estimate(self, player_cards, counts=None) -> Estimate:
+        '''
+        Model count and one model of the theory of the game so far with the player's current hand, and the cards the opponent
+        holds in that model. With counts (GameCounts), only the models with those hand and deck sizes are counted.
+        '''
+        condition = self._condition(player_cards)
+        if condition is None:
+            return Estimate(0, [], None)
+        units, compiled, rest_units, num_free = condition
+        if counts is not None:
+            return self._estimate_sized(condition, counts)
+        with profiling.phase("count"):
+            num_models = 1
+            for sentence, cards in compiled.values():
+                num_models *= ddnnf.count(sentence, units)
+            # the cards of the components are counted there, so they are taken out of the static theory where they are unconstrained
+            num_component_cards = sum(len(cards) for sentence, cards in compiled.values())
+            num_models *= ddnnf.count(self.static, rest_units) // self.block_count ** num_component_cards << num_free
+        if num_models == 0:
+            return Estimate(0, [], None)
+        with profiling.phase("solve"):
+            model = ddnnf.solve(self.static, rest_units)
+            for sentence, cards in compiled.values():
+                model.update(ddnnf.solve(sentence, units))
+        model.update(units)
+        return Estimate(num_models, [card for card in self.cards if model.get(Opponent(card[0], card[1]))], model)
+
+    def _estimate_sized(self, condition, counts: GameCounts) -> Estimate:
+        '''estimate() with counts: the parts are independent, so the size polynomial of the theory is the product of theirs.'''
+        units, compiled, rest_units, num_free = condition
+        counts = tuple(counts)
+        groups = count_groups()
+        with profiling.phase("count"):
+            parts, polys = self._sized_parts(condition, counts)
+            product = {(0,) * len(counts): 1}
+            for poly in polys:
+                product = ddnnf.multiply(product, poly, counts)
+            num_models = product.get(counts, 0) << num_free
+        if num_models == 0:
+            return Estimate(0, [], None)
+        with profiling.phase("solve"):
+            model = {}
+            for (sentence, assignment), sizes in zip(parts, ddnnf.split(polys, counts)):
+                model.update(ddnnf.solve_sized(sentence, groups, sizes, assignment))
+        model.update(units)
+        return Estimate(num_models, [card for card in self.cards if model.get(Opponent(card[0], card[1]))], model)
+
+    def marginals(self, player_cards, props=MARGINAL_PROPS, counts=None):
+        '''
+        card_marginals of the theory of the game so far with the player's current hand. The components are independent, so the
+        marginals of their cards are those of their own d-DNNF, and the marginals of the other cards those of the static theory.
+        With counts (GameCounts), the sizes couple the parts: each part is counted in the context of the product of the others.
+        The marginals of a component over budget are those of its samples; with counts, its size polynomial is the histogram
+        of the sizes of its samples, and a sample is weighed by the context of its sizes.
+        '''
+        sampled = {}
+        condition = self._condition(player_cards, sampled)
+        if condition is None:
+            return np.zeros((len(props), LAYOUT.num_cards))
+        units, compiled, rest_units, num_free = condition
+        if counts is None:
+            result = card_marginals(self.static, rest_units, props)
+            for sentence, cards in compiled.values():
+                columns = [LAYOUT.index(card) for card in cards]
+                result[:, columns] = card_marginals(sentence, units, props)[:, columns]
+            for component, cards in sampled.items():
+                columns = [LAYOUT.index(card) for card in cards]
+                result[:, columns] = sampled_marginals(self._component_store(component, units)[0], self.samples, props)[:, columns]
+            return result
+        counts = tuple(counts)
+        groups = count_groups()
+        if counts[0] == len(player_cards): # the hand is the player's cards: no other card is the player's in a counted model
+            units = {**units, **{Player(card[0], card[1]): False for cards in sampled.values() for card in cards if card not in player_cards}}
+        parts, polys = self._sized_parts(condition, counts, sampled)
+        stores, sampled_sizes = [], []
+        for component in sampled:
+            store, cards = self._component_store(component, units)
+            samples = approx.sample(store, self.samples, APPROX_EPSILON)
+            stores.append((store, samples))
+            sampled_sizes.append([tuple(sum(1 for name, value in sample.items() if value and groups.get(name) == i) for i in range(len(counts))) for sample in samples])
+            polys.append(approx.size_polynomial(store, groups, counts, APPROX_EPSILON, APPROX_DELTA, iterations=APPROX_ITERATIONS))
+        columns = [[LAYOUT.index(card) for card in self.cards if all(card not in cards for sentence, cards in compiled.values()) and all(card not in cards for cards in sampled.values())]]
+        columns += [[LAYOUT.index(card) for card in cards] for sentence, cards in compiled.values()]
+        result = np.zeros((len(props), LAYOUT.num_cards))
+        def context(i):
+            product = {(0,) * len(counts): 1}
+            for poly in polys[:i] + polys[i+1:]:
+                product = ddnnf.multiply(product, poly, counts)
+            return product
+        for i, ((sentence, assignment), part_columns) in enumerate(zip(parts, columns)):
+            result[:, part_columns] = card_marginals(sentence, assignment, props, counts, context(i))[:, part_columns]
+        for j, (cards, (store, samples), sizes) in enumerate(zip(sampled.values(), stores, sampled_sizes)):
+            rest = context(len(parts) + j)
+            weights = {id(sample): rest.get(tuple(c - s for c, s in zip(counts, size)), 0) for sample, size in zip(samples, sizes)}
+            part_columns = [LAYOUT.index(card) for card in cards]
+            result[:, part_columns] = sampled_marginals(store, props=props, samples=samples, weight=lambda sample: weights[id(sample)])[:, part_columns]
+        return result
+
+    def evaluate_move(self, action, hand, counts=None) -> MoveEval:
+        '''
+        A move of evaluate_moves on the session: action, the player's hand after it and the GameCounts before it, counted
+        with move_counts and, for a draw, per card drawn (draw_choices), as evaluate_moves counts it.
+        '''
+        sizes = move_counts(counts, action) if counts is not None else None
+        estimate = self.estimate(hand, sizes)
+        num_models = estimate.model_count
+        if sizes is not None and action[0] == "draw" and num_models:
+            possible = self.marginals(hand, (Player,), sizes)[0]
+            num_models //= max(draw_choices(hand, lambda card: possible[LAYOUT.index(card)] > 0), 1)
+        return MoveEval(num_models, len(meld_list_generator(hand)[0]), estimate.model)
+
+def lookahead(session: InferenceSession, player_cards, face_up_card, discarded_cards, counts=None, seconds=LOOKAHEAD_SECONDS) -> search.SearchResult:
+    '''
+    The best move several turns ahead (search.Searcher) within seconds. The draws and the opponent's hand are weighted by the
+    marginals of the session, so the theory is conditioned once per turn and the search itself encodes no theory.
+    '''
+    marginals = session.marginals(player_cards, counts=counts)
+    searcher = search.Searcher(LAYOUT, marginals[MARGINAL_PROPS.index(Deck)], marginals[MARGINAL_PROPS.index(Opponent)])
+    return searcher.best_move(searcher.state(player_cards, face_up_card, discarded_cards), seconds)
+
+def deal(rng=random):
+    '''Shuffles a deck with rng (the random module or a random.Random) and deals the player's and the opponent's hands from it.'''
+    cards = list (product (RANKS, SUITS))
+    rng.shuffle(cards)
+    return cards, cards[:NUM_OF_CARDS], cards[NUM_OF_CARDS:NUM_OF_CARDS*2]
 
 def initial_game() -> None :
     global deck
-    deck = list (product (RANKS, SUITS))
-    random.shuffle(deck)
-    player_cards = deck[:NUM_OF_CARDS] # distribute cards to the player and opponent
-    opponent_cards = deck[NUM_OF_CARDS:NUM_OF_CARDS*2]
+    deck, player_cards, opponent_cards = deal() # distribute cards to the player and opponent
     return player_cards, opponent_cards 
 
-def one_round_of_game_opp_pl(deck_index, discard_pile_top_card, player_cards, opponent_cards):
-    global deck, discarded_pile
+# what one_round_of_game_opp_pl prints when play_round ends the game
+GAME_OVER = {'player': "Player wins!", 'opponent': "Opponent wins!", 'draw': "Deck is empty"}
+
+def play_round(deck, discarded_pile, deck_index, discard_pile_top_card, player_cards, opponent_cards):
+    '''
+    One round of the heuristic game on the given state, without globals. Returns the same tuple as one_round_of_game_opp_pl,
+    or the winner ('player', 'opponent', or 'draw' when the deck is empty) if the game is over.
+    '''
     description_str = ''
     if deck_index >= len(deck):
-        print("Deck is empty")
-        return -1
-    current_card = deck[deck_index]
-    opp_info_list = meld_list_generator(list(opponent_cards))
-    pl_info_list = meld_list_generator(list(player_cards))
+        return 'draw'
+    opp_melds = LAYOUT.melds(LAYOUT.to_mask(opponent_cards))
+    pl_melds = LAYOUT.melds(LAYOUT.to_mask(player_cards))
     opp_pickup = False
     opp_discard = None
 
-    if len(opp_info_list[1]) == 0 and len(opp_info_list[3]) == 0:
-        print("Opponent wins!")
-        return -1
-    if len(pl_info_list[1]) == 0 and len(pl_info_list[3]) == 0:
-        print("Player wins!")
-        return -1
+    if not opp_melds.remaining and not opp_melds.potential:
+        return 'opponent'
+    if not pl_melds.remaining and not pl_melds.potential:
+        return 'player'
     
     description_str = description_str + str(discard_pile_top_card) + "      " # card facing up
     # PLAYER"S TURN
     # -------------- Step 1: Player takes a card either from the discarding pile or draw a new card -------------- 
-    if discard_pile_top_card in pl_info_list[2]: # pl_info_list[2] = wanting_list
+    if LAYOUT.bit(discard_pile_top_card) & pl_melds.wanted:
         player_cards.append(discard_pile_top_card)
         description_str = description_str + "Player picks up "+ str(discard_pile_top_card)
     # Player does not pick up and decide to draw a new card
@@ -376,15 +1317,13 @@ def one_round_of_game_opp_pl(deck_index, discard_pile_top_card, player_cards, op
         discarded_pile.append(discard_pile_top_card)
         deck_index = deck_index +1
         description_str = description_str + "Player draws a card"
-    if len(pl_info_list[1])>0: # pl_info_list[1] = remaining cards
-        discard_pile_top_card = pl_info_list[1][-1]
-    else:
-        discard_pile_top_card = pl_info_list[3][-1] # pl_info_list[3] = potential_melds
+    # discard the last remaining card, or the last card of a potential meld if there is no remaining card
+    discard_pile_top_card = LAYOUT.highest(pl_melds.remaining or pl_melds.potential)
     player_cards.remove(discard_pile_top_card)
     description_str = description_str + " and discard " + str(discard_pile_top_card)+ ". "
     # OPPONENT'S TURN
     # -------------- Step 2: opponent takes a card either from the discarding pile or draw a new card -------------- 
-    if discard_pile_top_card in opp_info_list[2]: # if the card is in the opponent wanting list 
+    if LAYOUT.bit(discard_pile_top_card) & opp_melds.wanted: # if the card is in the opponent wanting list 
         opp_pickup = (True, discard_pile_top_card)        
         opponent_cards.append(discard_pile_top_card)
         description_str = description_str + "Opponent picks up " + str(discard_pile_top_card)
@@ -393,55 +1332,155 @@ def one_round_of_game_opp_pl(deck_index, discard_pile_top_card, player_cards, op
         opp_pickup = (False, discard_pile_top_card)
         discarded_pile.append(discard_pile_top_card)
         if deck_index >= len(deck):
-            print("Deck is empty")
-            return -1
+            return 'draw'
         opponent_cards.append(deck[deck_index])
         deck_index = deck_index +1
         description_str = description_str + "Opponent draws a card"
 
     # -------------- Step 3: Opponent discard a card-------------- 
-    if len(opp_info_list[1])>0: # pl_info_list[1] = remaining cards
-        opp_discard = opp_info_list[1][-1]
-    else:
-        opp_discard = opp_info_list[3][-1] # pl_info_list[3] = potential_melds
+    opp_discard = LAYOUT.highest(opp_melds.remaining or opp_melds.potential)
     opponent_cards.remove(opp_discard)
     discard_pile_top_card = opp_discard
     description_str = description_str + " and discard " + str(discard_pile_top_card) + "."
     return deck_index, player_cards, opponent_cards, opp_pickup, opp_discard, description_str
 
+
+def one_round_of_game_opp_pl(deck_index, discard_pile_top_card, player_cards, opponent_cards):
+    global deck, discarded_pile
+    status = play_round(deck, discarded_pile, deck_index, discard_pile_top_card, player_cards, opponent_cards)
+    if isinstance(status, str):
+        print(GAME_OVER[status])
+        return -1
+    return status
+
+class Game:
+    '''
+    The state of one game, with its own random generator: games with the same seed are dealt and played the same way,
+    and any number of games can run in one process since nothing is kept in the module globals.
+    '''
+    def __init__(self, seed=None):
+        self.seed = seed
+        self.deck, self.player_cards, self.opponent_cards = deal(random.Random(seed))
+        self.deck_index = NUM_OF_CARDS*2
+        self.discard_pile_top_card = self.deck[self.deck_index]
+        self.deck_index = self.deck_index + 1
+        self.discarded_pile = []
+        self.rounds = 0
+        self.winner = None # 'player', 'opponent' or 'draw' once the game is over
+
+    def play_round(self):
+        '''Plays one round. Returns what the player observes of the opponent, (opp_pickup, opp_discard), or None once the game is over.'''
+        if self.winner is not None:
+            return None
+        status = play_round(self.deck, self.discarded_pile, self.deck_index, self.discard_pile_top_card, self.player_cards, self.opponent_cards)
+        if isinstance(status, str):
+            self.winner = status
+            return None
+        self.deck_index, self.player_cards, self.opponent_cards, opp_pickup, opp_discard, description_str = status
+        self.discard_pile_top_card = opp_discard
+        self.rounds = self.rounds + 1
+        return opp_pickup, opp_discard
+
+def recommend(moves) -> str:
+    '''
+    The advice of Exploration 2 from the ("draw", None) and ("pick", None) evaluations of evaluate_moves: "pick" if picking
+    up the face up card leaves more models or more melds, "either" if both moves have as many models, "draw" otherwise,
+    and None if neither move is satisfiable.
+    '''
+    n_pick_up_sol, np_meld, np_sol = moves[("draw", None)]
+    pick_up_sol, p_meld, p_sol = moves[("pick", None)]
+    if p_sol == None and np_sol == None:
+        return None
+    if pick_up_sol-n_pick_up_sol > 0 or p_meld - np_meld > 0:
+        return "pick"
+    if pick_up_sol == n_pick_up_sol:
+        return "either"
+    return "draw"
+
+class ModelView:
+    '''
+    Typed decoding of the models of the card theories. The variables of every class of CARD_PROPS are kept in LAYOUT.cards
+    order, as names and as ids of varmap (new_varmap() by default), so that a model decodes into one boolean vector per
+    class indexed by LAYOUT.index(card), and cards come back as (int, str) tuples. Only the variables of interest are read.
+    '''
+    def __init__(self, props=CARD_PROPS, varmap=None):
+        self.varmap = varmap or new_varmap()
+        self.names = {prop: tuple(prop(rank, suit) for rank, suit in LAYOUT.cards) for prop in props}
+        self.ids = {prop: np.array([self.varmap.var(name) for name in names]) for prop, names in self.names.items()}
+        # every Pl_set/Pl_run that player_cnf can assert, one per meld of the catalogue
+        melds = []
+        for cards in CATALOGUE.members:
+            if len({suit for rank, suit in cards}) == 1: # a run
+                melds.append(Pl_run(cards[0][0], cards[-1][0], cards[0][1]))
+            else:
+                excluded = sorted(set(SUITS).difference(suit for rank, suit in cards))
+                melds.append(Pl_set(cards[0][0], excluded[0] if excluded else 'Z'))
+        self.player_melds = tuple(dict.fromkeys(melds))
+
+    def vector(self, model, prop) -> np.ndarray:
+        '''
+        Boolean vector of prop over the cards. model is a dict {name: bool} (missing names are false), or a boolean array
+        indexed by the ids of varmap.
+        '''
+        if isinstance(model, np.ndarray):
+            return model[self.ids[prop]]
+        names = self.names[prop]
+        return np.fromiter((model.get(name, False) for name in names), dtype=bool, count=len(names))
+
+    def vectors(self, model) -> dict:
+        return {prop: self.vector(model, prop) for prop in self.names}
+
+    def cards(self, model, prop) -> list:
+        '''The cards (rank, suit) for which prop is true in model.'''
+        return [LAYOUT.cards[i] for i in np.flatnonzero(self.vector(model, prop))]
+
+    def meld_count(self, model) -> int:
+        '''Number of melds of the player (true Pl_run and Pl_set variables) in a model {name: bool}.'''
+        return sum(1 for name in self.player_melds if model.get(name, False))
+
+MODEL_VIEW = ModelView()
+
 def print_sol_opp_holding(sol):
-    global deck
-    opp_possible_cards = []
-    player_want_cards = []
-    for card in deck:
-        if sol != None and Opponent(card[0], card[1]) in sol and sol[Opponent(card[0], card[1])]:
-            opp_possible_cards.append((card[0], card[1]))
-        elif sol != None and Pl_want(card[0], card[1]) in sol and sol[Pl_want(card[0], card[1])]:
-            player_want_cards.append((card[0], card[1]))
-    return opp_possible_cards
+    if sol == None:
+        return []
+    return MODEL_VIEW.cards(sol, Opponent)
 
 def count_pl_meld(sol):
-    pl_meld_num = 0
-    if sol != None:
-        for value in dict(sol):
-            if sol != None and sol[value] == True:
-                temp_str = str(value)
-                if temp_str.__contains__("player_set") or temp_str.__contains__("player_run"):
-                    pl_meld_num = pl_meld_num + 1
-    return pl_meld_num
+    if sol == None:
+        return 0
+    return MODEL_VIEW.meld_count(sol)
 
 def suggest_player_want_list(sol):
-    pl_wants= []
-    if sol != None:
-        for value in dict(sol):
-            if sol != None and sol[value] == True:
-                temp_str = str(value)
-                if temp_str.__contains__("player_want"):
-                    # print((temp_str[12:-1], temp_str[-1])) 
-                    # print(temp_str + "\n")
-                    pl_wants.append((temp_str[12:-1], temp_str[-1]))
-    return pl_wants
+    if sol == None:
+        return []
+    return MODEL_VIEW.cards(sol, Pl_want)
+
+def configure(ranks=None, suits=None, num_of_cards=None) -> None:
+    '''
+    Switches the module to another deck configuration (the defaults keep the current one): RANKS, SUITS, NUM_OF_CARDS and
+    the layout, meld catalogue and model view built from them, dropping the base theories of the old configuration.
+    '''
+    global RANKS, SUITS, NUM_OF_CARDS, LAYOUT, CATALOGUE, MODEL_VIEW
+    RANKS = tuple(ranks or RANKS)
+    SUITS = tuple(suits or SUITS)
+    NUM_OF_CARDS = num_of_cards or NUM_OF_CARDS
+    assert 2 * NUM_OF_CARDS < len(RANKS) * len(SUITS), "The deck is too small to deal both hands and the face up card."
+    LAYOUT = CardLayout(RANKS, SUITS)
+    CATALOGUE = MeldCatalogue(LAYOUT)
+    MODEL_VIEW = ModelView()
+    for cached in (base_theory_builder, load_base_theory, base_sentence):
+        cached.cache_clear()
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Plays a few rounds, infers the opponent's hand and advises the player's next move.")
+    parser.add_argument('--portfolio', nargs='+', choices=sorted(cnf.PORTFOLIO_BACKENDS), metavar='BACKEND',
+                        help="race these SAT backends on every SAT call of the decisions instead of running kissat alone, from: %(choices)s")
+    parser.add_argument('--verify-models', action='store_true', help="check the model of every portfolio backend against the clauses, not only the untrusted ones")
+    args = parser.parse_args()
+    if args.portfolio:
+        cnf.PORTFOLIO = Portfolio({name: cnf.PORTFOLIO_BACKENDS[name] for name in args.portfolio},
+                                  verify=args.portfolio if args.verify_models else cnf.UNTRUSTED_BACKENDS)
+
     TOTAL_ROUNDS = 3
     print("|-------- Exploration 1: Play the game", TOTAL_ROUNDS,"rounds and find the cards that the opponent is potentially holding --------|\n")
     # ================= Exploration 1: Given the game runs for a few turns, guess the cards that the opponent is holding =================
@@ -455,6 +1494,7 @@ if __name__ == "__main__":
     opp_not_pickup_list = []
     opp_discard_list = []
     discarded_card_list = []
+    session = InferenceSession(budget=COMPILE_BUDGET) # compiles the card placement of the shuffled deck once, the rounds only add observations
     for round in range(TOTAL_ROUNDS):
         updated_game_status = one_round_of_game_opp_pl(deck_index, discard_pile_top_card, player_cards, opponent_cards) # returns a list
         if updated_game_status != -1:
@@ -475,26 +1515,30 @@ if __name__ == "__main__":
                 opp_not_pickup_list.append(updated_game_status[3][1])
             opp_discard_list.append(updated_game_status[4])
             discard_pile_top_card = updated_game_status[4]
+            session.observe(updated_game_status[3], updated_game_status[4])
 
-    T1 = example_theory(player_cards, opp_pickup_list, opp_not_pickup_list, opp_discard_list)
-    T1 = T1.compile()
-    solution = T1.solve()
-    satisfiable = T1.satisfiable()
+    counts = GameCounts(len(player_cards), NUM_OF_CARDS, len(deck) - deck_index) # the opponent always holds NUM_OF_CARDS after discarding
+    opp_marginals = session.marginals(player_cards, counts=counts)[MARGINAL_PROPS.index(Opponent)] # P(Opponent(card)) by LAYOUT.index(card)
+    try:
+        satisfiable = session.estimate(player_cards, counts).model_count > 0
+    except BudgetExceeded: # a component is too large to compile: the marginals are sampled, and all zeros if there is no model
+        satisfiable = bool(opp_marginals.any())
     print("\nPlayer cards:", sorted(player_cards))
     print("Opponent cards:", sorted(opponent_cards), "\n")
 
     print("\n----------------- Exploration 1 OUTPUT: -----------------\n")
 
-    if satisfiable == False:
+    if satisfiable == False: # e.g. the opponent picked up a card the player wants, which player_cnf puts in the deck
         print("The model is not satisfiable.")
     else: 
        
-        opp_guess = print_sol_opp_holding(solution)
+        opp_guess = [card for card in LAYOUT.cards if opp_marginals[LAYOUT.index(card)] > 0.5] # held in most of the models
         accuarcy = 0
         for opp_c in opp_guess:
             if opp_c in opponent_cards:
                 accuarcy = accuarcy + 1
         print('The opponent is potentially holding cards: ', sorted(opp_guess))
+        print('Probability of each guess:', ', '.join(f'{card}: {opp_marginals[LAYOUT.index(card)]:.2f}' for card in sorted(opp_guess)))
         print(f'{accuarcy}/{len(opp_guess)} guess of the opponent cards are correct.')
 
     # ================= Exploration 2: Given this facing up card, how should the player make the best move? =================
@@ -504,31 +1548,29 @@ if __name__ == "__main__":
     print("Cards have been discarded are:", sorted(discarded_pile))
     print("Player cards:", sorted(player_cards), "\n")
 
-    # T_NP is the model if player does not pick up
-    discarded_pile.append(discard_pile_top_card)
-    T_NP = example_theory(player_cards, opp_pickup_list, opp_not_pickup_list, opp_discard_list)
-    T_NP = T_NP.compile()
-    n_pick_up_sol = count_solutions(T_NP)
-    np_meld = count_pl_meld(T_NP.solve())
-
-    # T_P is the model if the player picks up the card
-    discarded_pile.remove(discard_pile_top_card)
-    player_cards.append(discard_pile_top_card)
-    T_P = example_theory(player_cards, opp_pickup_list, opp_not_pickup_list, opp_discard_list)
-    T_P = T_P.compile()
-    pick_up_sol = count_solutions(T_P)
-    p_meld = count_pl_meld(T_P.solve())
-
-    pl_wants = suggest_player_want_list(T_P.solve())
+    # Both moves (and every discard after them) are counted on one compilation of the theory
+    cache = CompileCache(COMPILE_CACHE_DIR) # theories seen in earlier runs are not compiled again
+    timed_out = False
+    try:
+        moves = evaluate_moves(player_cards, discard_pile_top_card, opp_pickup_list, opp_not_pickup_list, opp_discard_list, cache=cache, budget=COMPILE_BUDGET, counts=counts)
+    except BudgetExceeded: # neither dsharp nor the approximate counts finished within their budgets
+        timed_out = True
+        moves = {action: MoveEval(0, 0, None) for action in (("draw", None), ("pick", None))}
+    n_pick_up_sol, np_meld, np_sol = moves[("draw", None)] # the player does not pick up
+    pick_up_sol, p_meld, p_sol = moves[("pick", None)] # the player picks up the card
+    pl_wants = suggest_player_want_list(p_sol)
     
     print("\n----------------- Exploration 2 OUTPUT: -----------------\n")
 
-    if not T_P.satisfiable() and not T_NP.satisfiable():
+    advice = recommend(moves)
+    if timed_out:
+        print("The moves could not be counted within the time budgets.")
+    elif advice == None:
         print("The model is not satisfiable.")
     else:
-        if pick_up_sol-n_pick_up_sol > 0 or p_meld - np_meld > 0: # there exist more model if the player picks up the discarding card.  
+        if advice == "pick": # there exist more model if the player picks up the discarding card.  
             print("The model suggests the player to pick up the card", discard_pile_top_card, "from the discarding pile. ") 
-        elif pick_up_sol == n_pick_up_sol: # there is no difference in the number of solution that satisfy the model if the player picks up or not
+        elif advice == "either": # there is no difference in the number of solution that satisfy the model if the player picks up or not
             print("the number of solutions is the same either the player picks up the card or not.")
         else: # there exist more model if the player does NOT pick up the discarding card, i.e. should draw a new card from the deck, OR there is solution that satisfy the model
             print("The model suggests the player to NOT pick up the card", discard_pile_top_card, "and draws a new card from the deck. ") 
@@ -537,5 +1579,10 @@ if __name__ == "__main__":
         print("\nThere is no card that is still in the deck for player to win, consider rearranging your melds.")
     else:
         print("\nThe model sugguest the cards that is still possible to pick up from the player and would lead to a win are:\n", sorted(pl_wants))
+
+    if satisfiable: # the marginals of an unsatisfiable session weigh no card, so the search would have nothing to go on
+        best = lookahead(session, player_cards, discard_pile_top_card, discarded_pile, counts)
+        kind, discard = best.action
+        print(f"\nLooking {best.depth} turns ahead, the player should", f"pick up {discard_pile_top_card} and discard {discard}." if kind == "pick" else "draw a new card from the deck.")
     print()
 
@@ -0,0 +1,257 @@
+import random
+import time
+from collections import namedtuple
+from bitboard import CardLayout
+
+# The player's side of a game, as bitboards: the hand (before picking up or drawing), the face up card (a single bit,
+# 0 if none) and the cards out of play (in the dump or taken by the opponent). The rest of the deck is unknown: each of
+# those cards is in the deck or in the opponent's hand. key is the Zobrist hash of the three fields.
+SearchState = namedtuple('SearchState', ['hand', 'face_up', 'gone', 'key'])
+
+# Result of Searcher.best_move: the move as in evaluate_moves, ("pick", discard) or ("draw", None) since the discard
+# after a draw depends on the card drawn, its value in [0, 1], the deepest search completed (in turns) and statistics
+SearchResult = namedtuple('SearchResult', ['action', 'value', 'depth', 'values', 'nodes', 'tt_hits'])
+
+EXACT, LOWER, UPPER = 0, 1, 2 # transposition table bounds: the value is exact, a lower bound or an upper bound
+CHANCE_WIDTH = 5 # outcomes kept at a chance node, the most likely ones, their probabilities renormalized
+FEED_PENALTY = 0.1 # share of the value lost by a discard the opponent surely picks up
+TABLE_CAPACITY = 1 << 18 # transposition table entries; the table is emptied when it is full
+
+class _Timeout(Exception):
+    pass
+
+def popcount(mask: int) -> int:
+    '''Number of cards of a bitboard (int.bit_count needs Python 3.10).'''
+    return bin(mask).count('1')
+
+class Zobrist:
+    '''
+    Zobrist hashing of SearchStates: a random 64-bit key for every card in each location (hand, face up, gone), XORed
+    together, so that a move updates the hash with one XOR per card it moves instead of hashing the whole state.
+    '''
+    HAND, FACE_UP, GONE = 0, 1, 2
+
+    def __init__(self, layout: CardLayout, seed: int = 0):
+        rng = random.Random(seed)
+        self.layout = layout
+        self.keys = [[rng.getrandbits(64) for card in layout.cards] for location in range(3)]
+
+    def mask_key(self, location: int, mask: int) -> int:
+        key = 0
+        while mask:
+            low = mask & -mask
+            key ^= self.keys[location][low.bit_length() - 1]
+            mask ^= low
+        return key
+
+    def state(self, hand: int, face_up: int, gone: int) -> SearchState:
+        key = self.mask_key(self.HAND, hand) ^ self.mask_key(self.FACE_UP, face_up) ^ self.mask_key(self.GONE, gone)
+        return SearchState(hand, face_up, gone, key)
+
+    def flip(self, key: int, location: int, bit: int) -> int:
+        '''key with the card bit put in or taken out of location; a move is one flip out of its location and one into the next.'''
+        return key ^ self.keys[location][bit.bit_length() - 1] if bit else key
+
+class Searcher:
+    '''
+    Expectimax search of the player's moves several turns ahead. A turn is the player's move (pick up the face up card or
+    draw, then discard), then the opponent's response: they pick up the discard with the probability that it is wanted by
+    a hand drawn from opp_probs (P(Opponent(card)), e.g. the Opponent row of card_marginals), and discard one of their
+    cards, which becomes the next face up card. Draws follow deck_probs (P(Deck(card))). Both are renormalized over the
+    cards still unknown, and only the chance_width most likely outcomes are searched.
+
+    A hand is worth the share of its cards in melds (half for a potential meld), 1 if it wins, less a penalty for the
+    discards that feed the opponent. The search deepens one turn at a time until the time budget runs out, keeping the
+    best move of the last completed depth. Values are bounded, so chance nodes are pruned with the bounds of their
+    remaining outcomes (Star1) and choices by alpha-beta; the transposition table, keyed by the Zobrist hash of the
+    state, keeps values across depths and moves, and the best move found at the previous depth is searched first.
+    '''
+    def __init__(self, layout: CardLayout, deck_probs, opp_probs, chance_width: int = CHANCE_WIDTH, feed_penalty: float = FEED_PENALTY, seed: int = 0):
+        assert 0 <= feed_penalty < 1, "A discard the opponent surely picks up must keep part of the value, or the search bounds divide by zero."
+        self.layout = layout
+        self.deck_probs = [float(p) for p in deck_probs]
+        self.opp_probs = [float(p) for p in opp_probs]
+        self.chance_width = chance_width
+        self.feed_penalty = feed_penalty
+        self.zobrist = Zobrist(layout, seed)
+        self.table = {} # key -> (depth, value, bound, best action)
+        self._scores = {} # hand -> (value, discard candidates)
+        self._deadline = None
+        self.nodes = self.tt_hits = 0
+        # the cards next to each card (same rank, or one or two ranks away in its suit): it is wanted by a hand holding one
+        self._neighbours = []
+        for bit in (1 << i for i in range(layout.num_cards)):
+            index = bit.bit_length() - 1
+            same_rank = layout.rank_masks[index % layout.num_ranks] & ~bit
+            near = layout.above(bit) | layout.below(bit) | layout.above(layout.above(bit)) | layout.below(layout.below(bit))
+            self._neighbours.append(same_rank | near)
+
+    def state(self, hand_cards, face_up_card, gone_cards) -> SearchState:
+        layout = self.layout
+        return self.zobrist.state(layout.to_mask(hand_cards), layout.bit(face_up_card) if face_up_card else 0, layout.to_mask(gone_cards))
+
+    def _score(self, hand: int):
+        '''Value of a hand and the cards worth discarding from it (not in a meld, or in a potential one), highest rank first.'''
+        if hand not in self._scores:
+            melds = self.layout.melds(hand)
+            if not melds.remaining and not melds.potential:
+                value = 1.0
+            else:
+                value = (2 * popcount(melds.existing) + popcount(melds.potential)) / (2 * popcount(hand) + 2)
+            candidates = self.layout.to_cards(melds.remaining or melds.potential or hand)[::-1]
+            self._scores[hand] = (value, [self.layout.bit(card) for card in candidates])
+        return self._scores[hand]
+
+    def _outcomes(self, unknown: int, probs) -> list:
+        '''The chance_width most likely unknown cards by probs, as (probability, bit), renormalized.'''
+        weighted = []
+        mask = unknown
+        while mask:
+            low = mask & -mask
+            weighted.append((probs[low.bit_length() - 1], low))
+            mask ^= low
+        if not weighted:
+            return []
+        weighted.sort(key=lambda item: -item[0])
+        weighted = weighted[:self.chance_width]
+        total = sum(p for p, bit in weighted)
+        if total <= 0:
+            return [(1 / len(weighted), bit) for p, bit in weighted]
+        return [(p / total, bit) for p, bit in weighted if p > 0]
+
+    def _pick_probability(self, bit: int, unknown: int) -> float:
+        '''Probability that the opponent wants the card: that they hold one of its unknown neighbours.'''
+        missing = 1.0
+        mask = self._neighbours[bit.bit_length() - 1] & unknown
+        while mask:
+            low = mask & -mask
+            missing *= 1 - self.opp_probs[low.bit_length() - 1]
+            mask ^= low
+        return 1 - missing
+
+    def _tick(self) -> None:
+        self.nodes += 1
+        if self._deadline is not None and self.nodes % 256 == 0 and time.perf_counter() > self._deadline:
+            raise _Timeout()
+
+    def _chance(self, outcomes, child, alpha: float, beta: float) -> float:
+        '''Expected value of child(outcome, alpha, beta) over outcomes [(probability, outcome)], with Star1 cutoffs (values in [0, 1]).'''
+        total, left = 0.0, 1.0
+        for p, outcome in outcomes:
+            left -= p
+            value = child(outcome, max(0.0, (alpha - total - left) / p), min(1.0, (beta - total) / p))
+            total += p * value
+            if total + left <= alpha: # even if the rest were worth 1
+                return total + left
+            if total >= beta: # even if the rest were worth 0
+                return total
+        return total
+
+    def _respond(self, hand: int, gone: int, key: int, discard: int, depth: int, alpha: float, beta: float) -> float:
+        '''
+        Value of the player's hand after the discard, over the opponent's responses. gone already holds the discard, which
+        goes out of play whether or not the opponent picks it up, and key is the hash of (hand, no face up card, gone).
+        '''
+        self._tick()
+        value = self._score(hand)[0]
+        if value == 1.0:
+            return value
+        unknown = self.layout.full & ~hand & ~gone
+        keep = 1 - self.feed_penalty * self._pick_probability(discard, unknown)
+        outcomes = self._outcomes(unknown, self.opp_probs) if depth > 1 else []
+        if not outcomes:
+            return keep * value
+        def next_turn(face_up, a, b):
+            following = SearchState(hand, face_up, gone, self.zobrist.flip(key, Zobrist.FACE_UP, face_up))
+            return keep * self._turn(following, depth - 1, min(1.0, a / keep), min(1.0, b / keep))
+        return self._chance(outcomes, next_turn, alpha, beta)
+
+    def _discard(self, hand: int, gone: int, key: int, depth: int, alpha: float, beta: float) -> float:
+        '''Value of the best discard from hand, by alpha-beta over the discard candidates; key hashes (hand, gone).'''
+        best = -1.0
+        for bit in self._score(hand)[1]:
+            after = self.zobrist.flip(self.zobrist.flip(key, Zobrist.HAND, bit), Zobrist.GONE, bit)
+            value = self._respond(hand & ~bit, gone | bit, after, bit, depth, alpha, beta)
+            best = max(best, value)
+            alpha = max(alpha, value)
+            if alpha >= beta:
+                break
+        return best
+
+    def _actions(self, state: SearchState) -> list:
+        actions = [("draw", None)]
+        if state.face_up:
+            candidates = self._score(state.hand | state.face_up)[1]
+            actions = [("pick", self.layout.cards[bit.bit_length() - 1]) for bit in candidates if bit != state.face_up] + actions
+        entry = self.table.get(state.key)
+        if entry is not None and entry[3] in actions: # the best action of an earlier search first
+            actions.remove(entry[3])
+            actions.insert(0, entry[3])
+        return actions
+
+    def _action_value(self, state: SearchState, action, depth: int, alpha: float, beta: float) -> float:
+        kind, discard = action
+        flip = self.zobrist.flip
+        up = state.face_up
+        if kind == "pick":
+            bit = self.layout.bit(discard)
+            key = flip(flip(flip(flip(state.key, Zobrist.FACE_UP, up), Zobrist.HAND, up), Zobrist.HAND, bit), Zobrist.GONE, bit)
+            return self._respond((state.hand | up) & ~bit, state.gone | bit, key, bit, depth, alpha, beta)
+        gone = state.gone | up # the face up card goes to the dump
+        key = flip(flip(state.key, Zobrist.FACE_UP, up), Zobrist.GONE, up)
+        def drawn(bit, a, b):
+            return self._discard(state.hand | bit, gone, flip(key, Zobrist.HAND, bit), depth, a, b)
+        outcomes = self._outcomes(self.layout.full & ~state.hand & ~gone, self.deck_probs)
+        if not outcomes:
+            return 0.0
+        return self._chance(outcomes, drawn, alpha, beta)
+
+    def _turn(self, state: SearchState, depth: int, alpha: float, beta: float) -> float:
+        '''Value of the player's turn at state with depth turns left, within the window (alpha, beta).'''
+        self._tick()
+        if depth <= 0:
+            return self._score(state.hand)[0]
+        entry = self.table.get(state.key)
+        if entry is not None and entry[0] >= depth:
+            self.tt_hits += 1
+            stored_depth, value, bound, action = entry
+            if bound == EXACT or (bound == LOWER and value >= beta) or (bound == UPPER and value <= alpha):
+                return value
+        original_alpha = alpha
+        best, best_action = -1.0, None
+        for action in self._actions(state):
+            value = self._action_value(state, action, depth, alpha, beta)
+            if value > best:
+                best, best_action = value, action
+            alpha = max(alpha, value)
+            if alpha >= beta:
+                break
+        bound = LOWER if best >= beta else UPPER if best <= original_alpha else EXACT
+        if len(self.table) >= TABLE_CAPACITY:
+            self.table.clear()
+        if entry is None or entry[0] <= depth:
+            self.table[state.key] = (depth, best, bound, best_action)
+        return best
+
+    def best_move(self, state: SearchState, seconds: float = None, max_depth: int = 8) -> SearchResult:
+        '''
+        Iterative deepening from one turn up to max_depth turns, until seconds run out; the first depth always completes.
+        Returns the best move of the deepest completed search, with the value of every move at that depth.
+        '''
+        start = time.perf_counter()
+        result = None
+        for depth in range(1, max_depth + 1):
+            self._deadline = start + seconds if seconds is not None and depth > 1 else None
+            try:
+                values = {}
+                for action in self._actions(state): # every root move gets an exact value, to report them all
+                    values[action] = self._action_value(state, action, depth, 0.0, 1.0)
+            except _Timeout:
+                break
+            action = max(values, key=values.get)
+            self.table[state.key] = (depth, values[action], EXACT, action)
+            result = SearchResult(action, values[action], depth, values, self.nodes, self.tt_hits)
+            if seconds is not None and time.perf_counter() - start > seconds:
+                break
+        self._deadline = None
+        return result
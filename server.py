@@ -0,0 +1,125 @@
+import argparse
+import asyncio
+import json
+import sys
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import run
+from compile_cache import CompileCache
+
+# Sessions of the current worker process, by observation history, least recently used first
+_SESSIONS = OrderedDict()
+_CACHE = None
+
+def _cards(cards) -> list:
+    return [(int(rank), str(suit)) for rank, suit in cards]
+
+def history_key(request: dict) -> tuple:
+    '''The observation history of a request, in a canonical order: requests of the same game state share one theory.'''
+    return tuple(tuple(sorted(_cards(request.get(field, ())))) for field in ('opp_pickup', 'opp_not_pickup', 'opp_discard'))
+
+def session_for(key: tuple, capacity: int) -> run.InferenceSession:
+    '''The InferenceSession of an observation history from the LRU of this process, compiled on a miss.'''
+    global _CACHE
+    if key in _SESSIONS:
+        _SESSIONS.move_to_end(key)
+        return _SESSIONS[key]
+    if _CACHE is None:
+        _CACHE = CompileCache(run.COMPILE_CACHE_DIR)
+    session = run.InferenceSession(run.LAYOUT.cards, _CACHE)
+    session.observe_history(*key)
+    _SESSIONS[key] = session
+    while len(_SESSIONS) > capacity:
+        _SESSIONS.popitem(last=False)
+    return session
+
+def advise(request: dict, capacity: int = 64) -> dict:
+    '''
+    Answers one game state: the pick up recommendation of run.recommend, the probability that the opponent holds each
+    card (the cards held in most models are the estimate of their hand) and the cards the player wants. Both moves are
+    counted by conditioning the session of the observation history on the player's hand after the move. A request with
+    counts, [player, opponent, deck] cards before the move, only counts the models with the sizes after each move
+    (run.move_counts), so its counts are those of run.evaluate_moves.
+    '''
+    player_cards = _cards(request['player_cards'])
+    face_up = tuple(_cards([request['face_up']])[0])
+    counts = run.GameCounts(*request['counts']) if request.get('counts') else None
+    session = session_for(history_key(request), capacity)
+    moves = {}
+    for action, hand in ((("draw", None), player_cards), (("pick", None), player_cards + [face_up])):
+        moves[action] = session.evaluate_move(action, hand, counts) # the sizes of run.move_counts, as in evaluate_moves
+    opponent = session.marginals(player_cards, counts=counts)[run.MARGINAL_PROPS.index(run.Opponent)]
+    return {
+        'id': request.get('id'),
+        'advice': run.recommend(moves),
+        'model_counts': {kind: moves[(kind, None)].model_count for kind in ("draw", "pick")},
+        'opponent_estimate': [card for card in run.LAYOUT.cards if opponent[run.LAYOUT.index(card)] > 0.5],
+        'opponent_probabilities': {f'{rank}{suit}': float(opponent[run.LAYOUT.index((rank, suit))]) for rank, suit in run.LAYOUT.cards},
+        'wanted': run.suggest_player_want_list(moves[("pick", None)].model),
+    }
+
+class Advisor:
+    '''
+    Dispatches requests to worker processes. A request goes to the worker chosen by the hash of its observation history,
+    so each worker's LRU holds the theories of its own share of the games and a game's next request finds its theory warm.
+    '''
+    def __init__(self, workers: int = 2, capacity: int = 64):
+        self.capacity = capacity
+        self.pools = [ProcessPoolExecutor(1) for _ in range(workers)]
+
+    async def handle(self, line: str) -> dict:
+        request = {}
+        try:
+            request = json.loads(line)
+            pool = self.pools[zlib.crc32(repr(history_key(request)).encode()) % len(self.pools)]
+            return await asyncio.get_running_loop().run_in_executor(pool, advise, request, self.capacity)
+        except Exception as e: # a bad request gets an error answer, the server keeps running
+            return {'id': request.get('id') if isinstance(request, dict) else None, 'error': f'{type(e).__name__}: {e}'}
+
+    async def serve(self, reader: asyncio.StreamReader, write) -> None:
+        '''Answers the JSON lines of reader concurrently; answers are written as they are ready, matched by their id.'''
+        tasks = set()
+        async def answer(line):
+            write(json.dumps(await self.handle(line)) + '\n')
+        while line := await reader.readline():
+            if line.strip():
+                task = asyncio.create_task(answer(line.decode()))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        await asyncio.gather(*tasks)
+
+    def shutdown(self) -> None:
+        for pool in self.pools:
+            pool.shutdown()
+
+async def serve_stdio(advisor: Advisor) -> None:
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    def write(text):
+        sys.stdout.write(text)
+        sys.stdout.flush()
+    await advisor.serve(reader, write)
+
+async def serve_socket(advisor: Advisor, path: str) -> None:
+    async def connection(reader, writer):
+        await advisor.serve(reader, lambda text: writer.write(text.encode()))
+        await writer.drain()
+        writer.close()
+    server = await asyncio.start_unix_server(connection, path)
+    async with server:
+        await server.serve_forever()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Resident advisor answering JSON-lines game states on stdin/stdout or a unix socket.")
+    parser.add_argument('--socket', help="path of a unix socket to listen on instead of stdin/stdout")
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--capacity', type=int, default=64, help="compiled theories kept per worker")
+    args = parser.parse_args()
+    advisor = Advisor(args.workers, args.capacity)
+    try:
+        asyncio.run(serve_socket(advisor, args.socket) if args.socket else serve_stdio(advisor))
+    finally:
+        advisor.shutdown()
@@ -0,0 +1,132 @@
+import argparse
+import itertools
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import run
+from compile_cache import CompileCache
+from batch import BatchGames
+
+# One finished game: the winner ('player', 'opponent' or 'draw'), the rounds played, the opponent cards guessed
+# from the marginals and how many of them were right, and the seconds spent in every phase
+GameResult = namedtuple('GameResult', ['seed', 'winner', 'rounds', 'guesses', 'correct_guesses', 'times'])
+
+PHASES = ('play', 'observe', 'infer')
+
+def play_game(seed, inference_every=1, max_rounds=None, cache_dir=None) -> GameResult:
+    '''
+    Plays the game of the given seed to the end (or max_rounds), feeding every round to an InferenceSession. Every
+    inference_every rounds (0: never) the opponent's hand is guessed from the Opponent marginals, a card being guessed
+    when it is held in most of the models.
+    '''
+    game = run.Game(seed)
+    cache = CompileCache(cache_dir) if cache_dir else None
+    times = dict.fromkeys(PHASES, 0.0)
+    start = time.perf_counter()
+    session = run.InferenceSession(game.deck, cache) if inference_every else None
+    times['infer'] += time.perf_counter() - start
+    guesses = correct_guesses = 0
+    while max_rounds is None or game.rounds < max_rounds:
+        start = time.perf_counter()
+        observation = game.play_round()
+        times['play'] += time.perf_counter() - start
+        if observation is None:
+            break
+        if session is None:
+            continue
+        start = time.perf_counter()
+        session.observe(*observation)
+        times['observe'] += time.perf_counter() - start
+        if game.rounds % inference_every == 0:
+            start = time.perf_counter()
+            marginals = session.marginals(game.player_cards)[run.MARGINAL_PROPS.index(run.Opponent)]
+            guess = [card for card in run.LAYOUT.cards if marginals[run.LAYOUT.index(card)] > 0.5]
+            times['infer'] += time.perf_counter() - start
+            guesses += len(guess)
+            correct_guesses += len(set(guess) & set(game.opponent_cards))
+    return GameResult(seed, game.winner, game.rounds, guesses, correct_guesses, times)
+
+class Aggregate:
+    '''Running totals of many GameResults, updated one game at a time so that results can be reported while games run.'''
+    def __init__(self):
+        self.games = 0
+        self.wins = dict.fromkeys(('player', 'opponent', 'draw', None), 0) # None: stopped by max_rounds
+        self.rounds = 0
+        self.guesses = 0
+        self.correct_guesses = 0
+        self.times = dict.fromkeys(PHASES, 0.0)
+
+    def update(self, result: GameResult) -> None:
+        self.games += 1
+        self.wins[result.winner] += 1
+        self.rounds += result.rounds
+        self.guesses += result.guesses
+        self.correct_guesses += result.correct_guesses
+        for phase, seconds in result.times.items():
+            self.times[phase] += seconds
+
+    def summary(self) -> dict:
+        games = max(self.games, 1)
+        return {
+            'games': self.games,
+            'win_rates': {str(winner): wins / games for winner, wins in self.wins.items()},
+            'mean_rounds': self.rounds / games,
+            'guess_accuracy': self.correct_guesses / self.guesses if self.guesses else None,
+            'seconds_per_game': {phase: seconds / games for phase, seconds in self.times.items()},
+        }
+
+def _play_games(seeds, inference_every, max_rounds, cache_dir) -> list:
+    return [play_game(seed, inference_every, max_rounds, cache_dir) for seed in seeds]
+
+def simulate(seeds, inference_every=1, max_rounds=None, workers=None, batch_size=16, cache_dir=None):
+    '''
+    Plays the games of seeds in a ProcessPoolExecutor and yields (GameResult, Aggregate) as games finish, in completion
+    order. Seeds are sent in batches of batch_size, and at most 2 batches per worker are in flight, so that an iterator
+    of 100k seeds is consumed lazily instead of being submitted up front.
+    '''
+    aggregate = Aggregate()
+    seeds = iter(seeds)
+    workers = workers or os.cpu_count()
+    run.load_base_theory() # built once here rather than by every worker on a first run
+    with ProcessPoolExecutor(workers) as pool:
+        pending = set()
+        while True:
+            while len(pending) < 2 * workers:
+                batch = list(itertools.islice(seeds, batch_size))
+                if not batch:
+                    break
+                pending.add(pool.submit(_play_games, batch, inference_every, max_rounds, cache_dir))
+            if not pending:
+                return
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                for result in future.result():
+                    aggregate.update(result)
+                    yield result, aggregate
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Plays many seeded games in parallel and reports aggregated results.")
+    parser.add_argument('--games', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0, help="seed of the first game, the games use consecutive seeds")
+    parser.add_argument('--every', type=int, default=1, help="run inference every k rounds, 0 for no inference")
+    parser.add_argument('--max-rounds', type=int, default=None)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--report', type=int, default=100, help="print the aggregate every n games")
+    parser.add_argument('--batch', action='store_true', help="play the games without inference, vectorized with batch.BatchGames")
+    args = parser.parse_args()
+
+    if args.batch:
+        games = BatchGames.shuffled(run.LAYOUT, args.games, run.NUM_OF_CARDS, seed=args.seed)
+        games.run(args.max_rounds)
+        print(games.stats())
+        raise SystemExit
+
+    seeds = range(args.seed, args.seed + args.games)
+    aggregate = Aggregate()
+    for result, aggregate in simulate(seeds, args.every, args.max_rounds, args.workers, cache_dir=run.COMPILE_CACHE_DIR):
+        if aggregate.games % args.report == 0:
+            print(aggregate.summary(), flush=True)
+    if aggregate.games % args.report:
+        print(aggregate.summary())
@@ -1,20 +1,622 @@
 
-import os, sys
+import os, sys, pickle, random, json, asyncio
+import pytest
+import numpy as np
+import run
 
-from run import example_theory
+from run import example_theory, meld_list_generator, Deck, Pl_want, Opponent, CATALOGUE
+from theory import TheoryBuilder
+from cnf import VarMap, ClauseStore, Portfolio, Budget, BudgetExceeded
+import approx
+from compile_cache import CompileCache
+import ddnnf
+import simulate
+import server
+from batch import BatchGames, WINNERS
 
 USAGE = '\n\tpython3 test.py [draft|final]\n'
 EXPECTED_VAR_MIN = 10
 EXPECTED_CONS_MIN = 50
 
 def test_theory():
-    T = example_theory()
+    run.initial_game()
+    player_cards = [(1,'A'), (2,'A'), (3,'A'), (5,'B'), (5,'C'), (7,'D'), (8,'D'), (9,'A'), (4,'C'), (2,'D')]
+    T = example_theory(player_cards, [(7,'B')], [(1,'C'), (9,'C')], [(8,'A'), (3,'B'), (1,'D')]).compile()
 
     assert len(T.vars()) > EXPECTED_VAR_MIN, "Only %d variables -- your theory is likely not sophisticated enough for the course project." % len(T.vars())
     assert T.size() > EXPECTED_CONS_MIN, "Only %d operators in the formula -- your theory is likely not sophisticated enough for the course project." % T.size()
     assert not T.valid(), "Theory is valid (every assignment is a solution). Something is likely wrong with the constraints."
     assert not T.negate().valid(), "Theory is inconsistent (no solutions exist). Something is likely wrong with the constraints."
 
+def test_theory_builder():
+    T = TheoryBuilder()
+    assert T.add_constraint(Deck(1, 'A') >> Pl_want(1, 'A'))
+    assert not T.add_constraint(Deck(1, 'A') >> Pl_want(1, 'A')), "Identical constraints should only be stored once."
+    T.add_exactly_one(Deck(1, 'A'), Deck(2, 'A'))
+    size = len(T)
+    pick, no_pick = T.fork(), T.fork()
+    pick.add_constraint(Deck(1, 'A'))
+    no_pick.add_constraint(~Deck(1, 'A'))
+    assert len(T) == size and len(pick) == size + 1 and len(no_pick) == size + 1
+    assert Deck(1, 'A') in pick and Deck(1, 'A') not in no_pick and Deck(1, 'A') not in T
+    assert pick.compile().satisfiable() and not T.fork().compile().negate().valid()
+
+def test_interned_propositions():
+    assert Opponent(2, 'B') is Opponent(2, 'B')
+    assert Opponent(2, 'B') != Opponent(2, 'C') and Opponent(2, 'B') != Deck(2, 'B')
+    assert pickle.loads(pickle.dumps(Opponent(2, 'B'))) is Opponent(2, 'B')
+    assert len({Opponent(2, 'B'): 1, Opponent(2, 'B')._var.name: 2}) == 1
+
+def reference_meld_lists(cards, ranks, suits):
+    '''The list-based meld_list_generator of the original game loop, kept as the reference of CardLayout.melds.'''
+    def by_key(cards, key, value):
+        groups = {}
+        for card in cards:
+            groups.setdefault(card[key], set()).add(card[value])
+        return groups
+    remaining_cards = list(cards)
+    existing_meld_list, potential_meld_list, wanting_list = [], [], []
+    for el_suit, el_rank_set in by_key(sorted(remaining_cards), 1, 0).items():
+        if len(el_rank_set) > 2:
+            temp_list = sorted(el_rank_set)
+            num_of_con_term, from_index = 1, 0
+            for index in range(len(temp_list)):
+                if index == len(temp_list)-1:
+                    if temp_list[index-1]+1 == temp_list[index] and num_of_con_term > 2:
+                        existing_meld_list.append((el_suit, temp_list[from_index:index+1]))
+                        wanting_list.append((temp_list[from_index]-1, el_suit))
+                        for rank in temp_list[from_index:index+1]:
+                            remaining_cards.remove((rank, el_suit))
+                elif temp_list[index]+1 != temp_list[index+1]:
+                    if num_of_con_term > 2:
+                        existing_meld_list.append((el_suit, temp_list[from_index:index+1]))
+                        if temp_list[from_index] > ranks[0]:
+                            wanting_list.append((temp_list[from_index]-1, el_suit))
+                        if temp_list[index]+1 < ranks[-1]:
+                            wanting_list.append((temp_list[index]+1, el_suit))
+                        for rank in temp_list[from_index:index+1]:
+                            remaining_cards.remove((rank, el_suit))
+                    elif num_of_con_term == 2:
+                        potential_meld_list += [(temp_list[index-1], el_suit), (temp_list[index], el_suit)]
+                        if temp_list[index-1] > ranks[0]:
+                            wanting_list.append((temp_list[index-1]-1, el_suit))
+                        if temp_list[index]+1 < ranks[-1]:
+                            wanting_list.append((temp_list[index]+1, el_suit))
+                    num_of_con_term, from_index = 1, index+1
+                else:
+                    num_of_con_term += 1
+    for el_rank, el_suit_set in by_key(sorted(remaining_cards), 0, 1).items():
+        if len(el_suit_set) > 2:
+            existing_meld_list.append((el_rank, el_suit_set))
+            for suit in el_suit_set:
+                remaining_cards.remove((el_rank, suit))
+        elif len(el_suit_set) == 2:
+            potential_meld_list += [(el_rank, suit) for suit in el_suit_set]
+            wanting_list += [(el_rank, suit) for suit in set(suits).difference(el_suit_set)]
+    potential_meld_list = list(set(potential_meld_list))
+    return existing_meld_list, list(set(remaining_cards).difference(potential_meld_list)), list(set(wanting_list)), potential_meld_list
+
+def test_meld_list_generator():
+    hand = [(3,'A'), (4,'A'), (5,'A'), (6,'A'), (6,'B'), (6,'C'), (8,'B'), (9,'B'), (1,'D'), (3,'D'), (2,'C'), (9,'C'), (9,'D')]
+    existing, remaining, wanting, potential = meld_list_generator(hand)
+    assert existing == [('A', [3, 4, 5, 6]), (9, {'B', 'C', 'D'})]
+    assert sorted(remaining) == [(1, 'D'), (2, 'C'), (3, 'D'), (8, 'B')]
+    assert sorted(potential) == [(6, 'B'), (6, 'C')]
+    assert sorted(wanting) == [(2, 'A'), (6, 'A'), (6, 'D')]
+    # the bitboard analyzer gives the lists of the original generator on random hands of several decks
+    from bitboard import CardLayout
+    rng = random.Random(3)
+    for ranks, suits in ((range(1, 10), 'ABCD'), (range(1, 14), 'ABCD'), (range(1, 7), 'ABC'), (range(1, 14), 'ABCDEFGH')):
+        layout = CardLayout(ranks, suits)
+        for _ in range(1000):
+            hand = rng.sample(layout.cards, rng.randint(0, min(20, layout.num_cards)))
+            existing, remaining, wanting, potential = layout.meld_lists(layout.to_mask(hand))
+            old_existing, old_remaining, old_wanting, old_potential = reference_meld_lists(hand, layout.ranks, layout.suits)
+            assert sorted((str(key), sorted(meld)) for key, meld in existing) == sorted((str(key), sorted(meld)) for key, meld in old_existing), hand
+            assert set(remaining) == set(old_remaining) and set(potential) == set(old_potential), hand
+            assert set(wanting) == set(old_wanting) & set(layout.cards), hand # the old list can hold the rank below the lowest
+
+def test_meld_catalogue():
+    assert len(CATALOGUE) == 9 * 5 + 4 * 28 # sets of 3 or 4 suits for 9 ranks, runs of 3 to 9 cards in 4 suits
+    assert all((5, 'A') in CATALOGUE.members[i] for i in CATALOGUE.by_card[(5, 'A')])
+    assert sorted(CATALOGUE.completions((5, 'A'))) == [((3, 'A'), (4, 'A')), ((4, 'A'), (6, 'A')), ((5, 'B'), (5, 'C')),
+                                                       ((5, 'B'), (5, 'D')), ((5, 'C'), (5, 'D')), ((6, 'A'), (7, 'A'))]
+
+def test_ladder_meld_encoding():
+    run.initial_game()
+    player_cards = [(1,'A'), (2,'A'), (3,'A'), (5,'B'), (5,'C'), (7,'D'), (8,'D'), (9,'A'), (4,'C'), (2,'D')]
+    observations = ([(6,'B')], [(1,'C')], [(8,'A'), (3,'B')])
+    direct = example_theory(player_cards, *observations, meld_encoding="direct").compile()
+    ladder = example_theory(player_cards, *observations, meld_encoding="ladder").compile()
+    assert direct.satisfiable() and ladder.satisfiable()
+    model = ladder.solve()
+    assert direct.satisfied_by({v: model[v] for v in direct.vars()}), "The auxiliary variables should not change the models."
+    # the clause emitter honours the encoding too, with the same model count since every auxiliary variable is defined
+    direct_cnf = run.example_cnf(player_cards, *observations, meld_encoding="direct")
+    ladder_cnf = run.example_cnf(player_cards, *observations, meld_encoding="ladder")
+    assert any(getattr(name, '_factory', None) is run.Opp_set for name in ladder_cnf.varmap.names)
+    assert ladder_cnf.model_count() == direct_cnf.model_count()
+    # both emitters write out the one description of the ladder, with the same auxiliary variables
+    auxiliary = (run.Opp_run, run.Opp_suits, run.Opp_set)
+    assert {name for name in ladder_cnf.varmap.names if getattr(name, '_factory', None) in auxiliary} == \
+           {name for name in ladder.vars() if getattr(name, '_factory', None) in auxiliary}
+
+def test_direct_cnf_emitter():
+    run.initial_game()
+    player_cards = [(1,'A'), (2,'A'), (3,'A'), (5,'B'), (5,'C'), (7,'D'), (8,'D'), (9,'A'), (4,'C'), (2,'D')]
+    observations = ([(6,'B')], [(1,'C')], [(8,'A'), (3,'B')])
+    theory = example_theory(player_cards, *observations).compile()
+    clauses = run.example_cnf(player_cards, *observations)
+    assert clauses.lits[-1] == 0 and list(clauses.lits).count(0) == len(clauses)
+    model = clauses.solve()
+    assert model != None and theory.satisfied_by({v: model[v] for v in theory.vars()})
+    assert clauses.to_nnf().satisfied_by(model)
+
+def test_compile_cache(tmp_path):
+    cache = CompileCache(str(tmp_path), max_bytes=2**20)
+    first, second = ClauseStore(VarMap()), ClauseStore(VarMap())
+    a, b, c = (first.pos(x) for x in 'abc')
+    first.add(a, b); first.add(-b, c)
+    z, y, x = (second.pos(name) for name in 'cba') # same clauses, numbered and ordered differently
+    second.add(z, -y); second.add(y, x); second.add(x, y)
+    assert first.compile(cache=cache).model_count() == 4
+    assert second.compile(cache=cache).model_count() == 4
+    assert cache.hits == 1 and cache.misses == 1 and cache.stats()['entries'] == 1
+    first.add(-a); first.add(-b)
+    assert first.model_count(cache) == 0 and cache.misses == 2
+    # caches of several workers storing the same entries at once, on a cold cache
+    from concurrent.futures import ThreadPoolExecutor
+    def compile_cold(i):
+        return CompileCache(str(tmp_path / 'shared')).compile(second).model_count()
+    with ThreadPoolExecutor(8) as pool:
+        assert set(pool.map(compile_cold, range(16))) == {4}
+    assert [name for name in os.listdir(tmp_path / 'shared' / os.listdir(tmp_path / 'shared')[0]) if not name.endswith('.nnf')] == []
+
+def test_evaluate_moves():
+    run.initial_game()
+    player_cards = [(1,'A'), (2,'A'), (3,'A'), (5,'B'), (5,'C'), (7,'D'), (8,'D'), (9,'A'), (4,'C'), (2,'D')]
+    observations = ([], [(1,'C')], [(8,'A'), (3,'B')])
+    moves = run.evaluate_moves(player_cards, (6,'D'), *observations)
+    assert len(moves) == 2 + 2 * len(player_cards)
+    for action, hand in [(("draw", None), player_cards), (("pick", None), player_cards + [(6,'D')]),
+                         (("pick", (4,'C')), [c for c in player_cards if c != (4,'C')] + [(6,'D')])]:
+        assert moves[action].model_count == run.example_cnf(hand, *observations).model_count()
+        assert moves[action].meld_count == len(meld_list_generator(hand)[0])
+    assert moves[("pick", None)].model[run.Player(6, 'D')]
+
+def test_inference_session():
+    run.initial_game()
+    player_cards = [(1,'A'), (2,'A'), (3,'A'), (5,'B'), (5,'C'), (7,'D'), (8,'D'), (9,'A'), (4,'C'), (2,'D')]
+    session = run.InferenceSession()
+    pickup, not_pickup, discards = [], [], []
+    for opp_pickup, opp_discard in [((False, (1,'C')), (8,'A')), ((True, (7,'B')), (3,'B')), ((False, (9,'C')), (1,'D'))]:
+        session.observe(opp_pickup, opp_discard)
+        (pickup if opp_pickup[0] else not_pickup).append(opp_pickup[1])
+        discards.append(opp_discard)
+        estimate = session.estimate(player_cards)
+        assert estimate.model_count == run.example_cnf(player_cards, pickup, not_pickup, discards).model_count()
+    assert estimate.model_count > 0
+    assert not set(estimate.opponent_cards) & set(player_cards)
+    # a wanted card the opponent passed on is in the dump, which leaves the theory satisfiable rather than wanting it from the deck
+    session.observe((False, (5,'A')), (6,'C'))
+    estimate = session.estimate(player_cards)
+    assert estimate.model_count > 0 and (5,'A') in session.dumped
+    assert estimate.model_count == run.example_cnf(player_cards, pickup, not_pickup + [(5,'A')], discards + [(6,'C')]).model_count()
+
+def play_observed(seed, rounds=3):
+    '''The player's hand and the observations (pickups, cards passed on, discards) of the opponent after rounds of Game(seed).'''
+    game, observations = run.Game(seed), ([], [], [])
+    for _ in range(rounds):
+        (picked, card), discard = game.play_round()
+        observations[0 if picked else 1].append(card)
+        observations[2].append(discard)
+    return list(game.player_cards), observations
+
+def test_passed_on_wanted_card():
+    # game 7: the opponent passes on a card the player wants, which was unsatisfiable while the player wanted it from the deck
+    player_cards, observations = play_observed(7)
+    passed_on = set(observations[1]) & set(meld_list_generator(player_cards)[2])
+    assert passed_on
+    store = run.opponent_cnf(*observations)
+    assert run.player_cnf(store, player_cards).solve() is None
+    assert run.example_cnf(player_cards, *observations).solve() is not None
+    session = run.InferenceSession(run.LAYOUT.cards)
+    session.observe_history(*observations)
+    assert passed_on <= session.dumped and session.estimate(player_cards).model_count > 0
+    # game 21: the opponent picks up a card the player wants, which the theory puts in the deck, so the state has no model
+    player_cards, observations = play_observed(21)
+    assert set(observations[0]) & set(meld_list_generator(player_cards)[2])
+    assert run.opponent_cnf(*observations).solve() is not None and run.example_cnf(player_cards, *observations).solve() is None
+
+def test_card_marginals():
+    run.initial_game()
+    player_cards = [(1,'A'), (2,'A'), (3,'A'), (5,'B'), (5,'C'), (7,'D'), (8,'D'), (9,'A'), (4,'C'), (2,'D')]
+    session = run.InferenceSession()
+    for opp_pickup, opp_discard in [((False, (1,'C')), (8,'A')), ((True, (7,'B')), (3,'B'))]:
+        session.observe(opp_pickup, opp_discard)
+    marginals = session.marginals(player_cards)
+    sentence = run.example_cnf(player_cards, [(7,'B')], [(1,'C')], [(8,'A'), (3,'B')]).compile()
+    num_models = ddnnf.count(sentence)
+    assert marginals.shape == (len(run.MARGINAL_PROPS), run.LAYOUT.num_cards)
+    for row, prop in enumerate(run.MARGINAL_PROPS):
+        for card in run.LAYOUT.cards:
+            expected = ddnnf.count(sentence, {prop(card[0], card[1]): True}) / num_models
+            assert abs(marginals[row, run.LAYOUT.index(card)] - expected) < 1e-9
+    assert marginals[0, run.LAYOUT.index((1,'A'))] == 0 # the player holds it
+
+def test_sampled_marginals():
+    run.initial_game()
+    player_cards = [(1,'A'), (2,'A'), (3,'A'), (5,'B'), (5,'C'), (7,'D'), (8,'D'), (9,'A'), (4,'C'), (2,'D')]
+    exact, sampled = run.InferenceSession(), run.InferenceSession(budget=Budget(seconds=0), samples=20)
+    for session in (exact, sampled):
+        session.observe_history([(7,'B')], [(1,'C')], [(8,'A'), (3,'B')])
+    marginals = sampled.marginals(player_cards)
+    assert sampled.over_budget # every component is over a zero budget, so its marginals are sampled
+    with pytest.raises(BudgetExceeded):
+        sampled.estimate(player_cards)
+    assert ((marginals >= 0) & (marginals <= 1)).all()
+    assert all(marginals[0, run.LAYOUT.index(card)] == 0 for card in player_cards)
+    assert np.abs(marginals - exact.marginals(player_cards)).max() < 0.4
+    first, second = run.Game(7), run.Game(7)
+    assert first.deck == second.deck
+    while first.winner is None:
+        assert first.play_round() == second.play_round()
+    assert first.winner == second.winner and first.rounds == second.rounds
+    results = {}
+    for result, aggregate in simulate.simulate(range(6), inference_every=2, workers=2, batch_size=2):
+        results[result.seed] = result
+    assert aggregate.games == 6 and sorted(results) == list(range(6))
+    for seed in (0, 5):
+        expected = simulate.play_game(seed, inference_every=2)
+        assert results[seed][:5] == expected[:5]
+
+def test_batch_games():
+    games = [run.Game(seed) for seed in range(200)]
+    batch = BatchGames(run.LAYOUT, [[run.LAYOUT.index(card) for card in game.deck] for game in games], run.NUM_OF_CARDS)
+    ownership = batch.ownership()
+    assert (ownership == 1).sum(axis=1).tolist() == [run.NUM_OF_CARDS] * len(games)
+    assert ownership[0, run.LAYOUT.index(games[0].opponent_cards[0])] == 2
+    batch.run()
+    for game, winner, rounds in zip(games, batch.winner, batch.rounds):
+        while game.play_round() is not None:
+            pass
+        assert (WINNERS[winner], rounds) == (game.winner, game.rounds)
+
+def test_portfolio():
+    store = run.example_cnf([(1,'A'), (2,'A'), (3,'A'), (5,'B'), (5,'C'), (7,'D'), (8,'D'), (9,'A'), (4,'C'), (2,'D')], [(7,'B')], [(1,'C')], [(8,'A')])
+    portfolio = Portfolio(learn_after=2)
+    for backend in ['native', None, None]:
+        solver = Portfolio({backend: portfolio.backends[backend]}) if backend else portfolio
+        model = solver.solve(store)
+        assert store.to_nnf().satisfied_by({**dict.fromkeys(store.varmap.names[1:], False), **model})
+    [wins] = portfolio.stats().values()
+    assert sum(wins.values()) == 2 and portfolio.contenders(portfolio.instance_class(store)) == list(wins)
+    unsat = ClauseStore(VarMap())
+    unsat.add(unsat.pos('a'))
+    unsat.add(unsat.neg('a'))
+    assert portfolio.solve(unsat) is None
+    # a backend that crashes or answers garbage drops out of the race, and only a race without a valid answer fails
+    crash, garbage = ['false'], ['sh', '-c', 'echo v 1 x 0; exit 10', 'garbage']
+    flaky = Portfolio({'crash': crash, 'garbage': garbage, 'native': portfolio.backends['native']})
+    assert store.to_nnf().satisfied_by({**dict.fromkeys(store.varmap.names[1:], False), **flaky.solve(store)})
+    assert flaky.stats() == {flaky.instance_class(store): {'native': 1}}
+    with pytest.raises(RuntimeError):
+        Portfolio({'crash': crash, 'garbage': garbage}).solve(store)
+    # only the models of the backends in verify are checked against the clauses
+    wrong = ['sh', '-c', 'echo v 0; exit 10', 'wrong']
+    assert Portfolio({'wrong': wrong}).solve(store) == {}
+    with pytest.raises(RuntimeError):
+        Portfolio({'wrong': wrong}, verify=['wrong']).solve(store)
+
+def test_approx_count():
+    store = ClauseStore(VarMap())
+    for i in range(15):
+        store.add(store.pos(('x', i)), store.pos(('x', i+1))) # 16 variables, no two neighbours false: 2584 models
+    store.add(store.pos('unit'))
+    store.pos('free')
+    rng = random.Random(0)
+    count = approx.approx_count(store, epsilon=0.8, rng=rng, iterations=3)
+    assert 2 * 2584 / 1.8 <= count <= 2 * 2584 * 1.8
+    # by sizes: the number of true x_i, from 8 (every other one) to 16
+    poly = approx.size_polynomial(store, {('x', i): 0 for i in range(16)}, (16,), rng=rng, iterations=3)
+    assert 2 * 2584 / 1.8 <= sum(poly.values()) <= 2 * 2584 * 1.8 and min(poly) >= (8,)
+    with pytest.raises(BudgetExceeded):
+        approx.approx_count(store, rng=rng, deadline=0)
+    samples = approx.sample(store, 5, rng=rng)
+    assert len(samples) == 5
+    assert all(store.to_nnf().satisfied_by(sample) for sample in samples)
+    with pytest.raises(BudgetExceeded):
+        store.compile(budget=Budget(nnf_bytes=1))
+    # the fallback of evaluate_moves counts the two moves recommend compares, with the sizes, within its own time budget
+    run.initial_game()
+    player_cards = [(1,'A'), (2,'A'), (3,'A'), (5,'B'), (5,'C'), (7,'D'), (8,'D'), (9,'A'), (4,'C'), (2,'D')]
+    observations = ([(7,'B')], [(1,'C')], [(8,'A'), (3,'B')])
+    counts = run.GameCounts(10, 10, 10)
+    exact = run.evaluate_moves(player_cards, (6,'D'), *observations, discards=False, counts=counts)
+    hands = {("draw", None): player_cards, ("pick", None): player_cards + [(6,'D')], ("pick", (4,'C')): player_cards[:-2] + [(6,'D')]}
+    moves = run.approx_evaluate_moves(hands, *observations, epsilon=3, rng=rng, counts=counts, seconds=20, iterations=3)
+    assert set(moves) == {("draw", None), ("pick", None)}
+    for action, move in moves.items():
+        assert exact[action].model_count / 4 <= move.model_count <= exact[action].model_count * 4
+
+def test_model_view():
+    run.initial_game()
+    player_cards = [(1,'A'), (2,'A'), (3,'A'), (5,'B'), (5,'C'), (5,'D'), (7,'D'), (8,'D'), (9,'D'), (2,'D')]
+    store = run.example_cnf(player_cards, [(7,'B')], [(1,'C')], [(8,'A')])
+    model = store.solve()
+    assert run.count_pl_meld(model) == 3
+    wants = run.suggest_player_want_list(model)
+    assert set(meld_list_generator(player_cards)[2]) <= set(wants)
+    assert all(isinstance(rank, int) and isinstance(suit, str) for rank, suit in wants)
+    values = np.zeros(len(store.varmap) + 1, dtype=bool)
+    for name, value in model.items():
+        values[store.varmap.ids[name]] = value
+    vector = run.MODEL_VIEW.vector(values, Opponent)
+    assert vector.tolist() == run.MODEL_VIEW.vector(model, Opponent).tolist()
+    assert [run.LAYOUT.cards[i] for i in np.flatnonzero(vector)] == run.print_sol_opp_holding(model)
+
+def test_advisor_server():
+    run.initial_game()
+    player_cards = [(1,'A'), (2,'A'), (3,'A'), (5,'B'), (5,'C'), (7,'D'), (8,'D'), (9,'A'), (4,'C'), (2,'D')]
+    observations = ([(7,'B')], [(1,'C')], [(8,'A'), (3,'B')])
+    request = {'id': 7, 'player_cards': player_cards, 'face_up': (6,'D'), 'opp_pickup': observations[0],
+               'opp_not_pickup': observations[1], 'opp_discard': observations[2]}
+    moves = run.evaluate_moves(player_cards, (6,'D'), *observations, discards=False)
+    answer = server.advise(request)
+    assert answer['model_counts'] == {kind: moves[(kind, None)].model_count for kind in ("draw", "pick")}
+    assert answer['advice'] == run.recommend(moves)
+    # with counts, the moves are sized as evaluate_moves sizes them
+    counts = run.GameCounts(10, 10, 12)
+    moves = run.evaluate_moves(player_cards, (6,'D'), *observations, discards=False, counts=counts)
+    sized = server.advise(dict(request, counts=list(counts)))
+    assert sized['model_counts'] == {kind: moves[(kind, None)].model_count for kind in ("draw", "pick")}
+
+    async def exchange(lines):
+        reader = asyncio.StreamReader()
+        reader.feed_data(''.join(line + '\n' for line in lines).encode())
+        reader.feed_eof()
+        written = []
+        advisor = server.Advisor(workers=1)
+        try:
+            await advisor.serve(reader, written.append)
+        finally:
+            advisor.shutdown()
+        return [json.loads(line) for line in written]
+    answers = {answer['id']: answer for answer in asyncio.run(exchange([json.dumps(request), 'not json']))}
+    assert answers[7]['model_counts'] == answer['model_counts']
+    assert 'error' in answers[None]
+
+def test_base_theory(tmp_path, monkeypatch):
+    from base_theory import BaseTheory
+    from bitboard import CardLayout
+    monkeypatch.setattr(run, 'BASE_THEORY_DIR', str(tmp_path))
+    layout = CardLayout(range(1, 4), ('A', 'B'))
+    base_path = run.build_base_theory(layout)
+    base = BaseTheory(base_path)
+    assert base.header['ranks'] == [1, 2, 3] and base.header['suits'] == ['A', 'B']
+    S = run.base_cnf(layout)
+    loaded = base.store(VarMap(layout, run.CARD_PROPS))
+    assert list(loaded) == list(S)
+    assert ddnnf.count(base.sentence(S.varmap.names)) == ddnnf.count(S.compile()) == S.model_count()
+    # workers that build the same file at once on a first run
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(8) as pool:
+        paths = set(pool.map(lambda i: run.build_base_theory(layout), range(8)))
+    assert list(BaseTheory(paths.pop()).lits) == list(S.lits) and os.listdir(tmp_path) == [os.path.basename(base_path)]
+    # the theories of the game use the base theory of LAYOUT
+    run.initial_game()
+    assert sorted(run.opponent_cnf([], [], [])) == sorted(run.opponent_cnf([], [], [], S=ClauseStore(run.new_varmap())))
+
+def test_profiling(tmp_path):
+    import profiling
+    run.initial_game()
+    player_cards = [(1,'A'), (2,'A'), (3,'A'), (5,'B'), (5,'C'), (7,'D'), (8,'D'), (9,'A'), (4,'C'), (2,'D')]
+    observations = ([(7,'B')], [(1,'C'), (9,'C')], [(8,'A'), (3,'B'), (1,'D')])
+    assert profiling.family("player melds", TheoryBuilder()) is profiling._OFF # disabled: the hooks measure nothing
+    expected = run.example_cnf(player_cards, *observations).model_count()
+    run.base_theory_builder() # built once per process, before the profiled decisions
+    with profiling.Profiler() as profiler:
+        assert run.example_cnf(player_cards, *observations).model_count() == expected
+        run.example_theory(player_cards, *observations)
+        run.evaluate_moves(player_cards, (4,'A'), *observations, discards=False)
+    assert profiling.PROFILER is None
+    families = {row['family']: row for row in profiler.families()}
+    assert set(families) == {"base theory", "opponent pick", "opponent not pick", "opponent discard", "opponent not want", "player melds"}
+    assert families["base theory"]['calls'] > 0 and families["base theory"]['constraints'] == 0 # forked, not built
+    assert families["opponent not want"]['nnf_nodes'] > 0 and families["opponent not want"]['cnf_vars'] > 0
+    assert [row['decision'] for row in profiler.decisions] == ["evaluate_moves"]
+    assert all(profiler.decisions[0][phase] > 0 for phase in profiling.PHASES)
+    # the card placement is measured where it is built, by the build step of the base theory
+    with profiling.Profiler() as build:
+        run.base_cnf()
+    [placement] = build.families()
+    assert placement['family'] == "card placement" and placement['constraints'] > 0 and placement['dsharp_seconds'] > 0
+    profiler.to_json(tmp_path / "profile.json")
+    profiler.to_csv(tmp_path / "families.csv")
+    assert json.load(open(tmp_path / "profile.json"))['families'] == json.loads(json.dumps(profiler.families()))
+    assert open(tmp_path / "families.csv").read().count('\n') == len(families) + 1
+
+def test_benchmark():
+    import benchmark
+    cases = benchmark.grid_cases({'ranks': (4, 6), 'suits': (3,), 'hand': (4, 6), 'rounds': (2,)}, seeds=(1,))
+    assert [(case['ranks'], case['hand']) for case in cases] == [(4, 4), (6, 4), (6, 6)] # 4x3 cards cannot deal two hands of 6
+    baseline = list(benchmark.run_cases(cases[:1], repeat=1))
+    result = baseline[0]
+    assert set(result['seconds']) == set(benchmark.PHASES) and result['peak_rss_kb'] > 0
+    assert result['history']['rounds'] <= 2 and result['model_count'] >= 0
+    # replaying the recorded history measures the same workload
+    again = list(benchmark.run_cases(cases[:1], repeat=1, histories=[json.loads(json.dumps(result['history']))]))
+    assert again[0]['history_digest'] == result['history_digest'] and again[0]['model_count'] == result['model_count']
+    slower = dict(result, seconds=dict(result['seconds'], compile=result['seconds']['compile'] * 2 + 1))
+    assert [regression['metric'] for regression in benchmark.compare([slower], baseline)] == ['compile']
+    assert benchmark.compare(baseline, baseline) == []
+    # the same case in both meld encodings: the same model count, and one row of ladder / direct ratios
+    both = benchmark.grid_cases({'ranks': (6,), 'suits': (3,), 'hand': (4,), 'rounds': (2,), 'encoding': ('direct', 'ladder')}, seeds=(1,))
+    results = list(benchmark.run_cases(both, repeat=1))
+    assert [result['case']['encoding'] for result in results] == ['direct', 'ladder']
+    assert results[0]['model_count'] == results[1]['model_count']
+    (row,) = benchmark.compare_encodings(results)
+    assert row['case'] == {'ranks': 6, 'suits': 3, 'hand': 4, 'rounds': 2, 'seed': 1} and row['variables'] > 0
+
+def test_card_counts():
+    from math import comb
+    run.configure(range(1, 4), 'AB', 2)
+    try:
+        # the counter allows exactly k of the 6 cards in the opponent's hand and adds no models of its own
+        for k in range(7):
+            S = ClauseStore(run.new_varmap())
+            run.card_placement_cnf(S, run.LAYOUT.cards)
+            run.exactly_cnf(S, Opponent, k)
+            T = TheoryBuilder()
+            run.card_placement_theory(T, run.LAYOUT.cards)
+            run.exactly_theory(T, Opponent, k)
+            assert S.model_count() == comb(6, k) * 3 ** (6 - k)
+            assert T.compile().model_count() == comb(6, k) * 3 ** (6 - k)
+        placement = run.base_sentence()
+        counts = run.GameCounts(2, 2, 1)
+        assert ddnnf.count_sized(placement, run.count_groups(), counts) == comb(6, 2) * comb(4, 2) * 2
+        S = run.counts_cnf(run.base_cnf(run.LAYOUT), counts)
+        assert S.model_count() == ddnnf.count_sized(placement, run.count_groups(), counts)
+        model = ddnnf.solve_sized(placement, run.count_groups(), counts)
+        assert [sum(model[place(*card)] for card in run.LAYOUT.cards) for place in run.COUNTED_PLACES] == list(counts)
+    finally:
+        run.configure(range(1, 10), 'ABCD', 10)
+    # the session counts the sizes over its components, as the whole theory does
+    game = run.Game(4)
+    observations = [], [], []
+    session = run.InferenceSession(run.LAYOUT.cards)
+    while game.rounds < 4:
+        (picked, card), discard = game.play_round()
+        observations[0 if picked else 1].append(card)
+        observations[2].append(discard)
+        session.observe((picked, card), discard)
+    counts = run.GameCounts(len(game.player_cards), run.NUM_OF_CARDS, len(game.deck) - game.deck_index)
+    S = run.example_cnf(list(game.player_cards), *observations)
+    sentence = S.compile()
+    free = len(S.varmap) - len(sentence.vars())
+    assert session.estimate(list(game.player_cards), counts).model_count == ddnnf.count_sized(sentence, run.count_groups(), counts) << free
+    marginals = session.marginals(list(game.player_cards), counts=counts)
+    assert marginals[run.MARGINAL_PROPS.index(Opponent)].sum() == pytest.approx(counts.opponent)
+    assert marginals[run.MARGINAL_PROPS.index(Deck)].sum() == pytest.approx(counts.deck)
+    # a draw is counted per card drawn, on the same basis as picking up the face up card, by evaluate_moves and the session alike
+    hand = list(game.player_cards)
+    moves = run.evaluate_moves(hand, game.discard_pile_top_card, *observations, discards=False, counts=counts)
+    drawn = session.marginals(hand, (run.Player,), run.move_counts(counts, ("draw", None)))[0]
+    choices = run.draw_choices(hand, lambda card: drawn[run.LAYOUT.index(card)] > 0)
+    total = ddnnf.count_sized(sentence, run.count_groups(), run.move_counts(counts, ("draw", None))) << free
+    assert choices > 1 and moves[("draw", None)].model_count == total // choices
+    for action, move_hand in ((("draw", None), hand), (("pick", None), hand + [game.discard_pile_top_card])):
+        assert session.evaluate_move(action, move_hand, counts).model_count == moves[action].model_count
+
+def test_lookahead():
+    from search import Searcher, Zobrist
+    uniform = [0.5] * run.LAYOUT.num_cards
+    searcher = Searcher(run.LAYOUT, uniform, uniform)
+    # one card short of a win: picking up (9,'C') and discarding the odd card wins at once
+    hand = [(1,'A'), (2,'A'), (3,'A'), (4,'A'), (5,'B'), (6,'B'), (7,'B'), (9,'A'), (9,'B'), (2,'D')]
+    state = searcher.state(hand, (9,'C'), [(8,'C')])
+    result = searcher.best_move(state, max_depth=1)
+    assert result.action == ("pick", (2,'D')) and result.value == 1.0
+    assert set(result.values) >= {("draw", None), ("pick", (2,'D'))}
+    # the hash of a state is the same whether it is built at once or by moving cards one at a time
+    z = searcher.zobrist
+    up, discard = run.LAYOUT.bit((9,'C')), run.LAYOUT.bit((2,'D'))
+    key = z.flip(z.flip(z.flip(z.flip(state.key, Zobrist.FACE_UP, up), Zobrist.HAND, up), Zobrist.HAND, discard), Zobrist.GONE, discard)
+    assert key == z.state((state.hand | up) & ~discard, 0, state.gone | discard).key
+    # a discard the opponent surely picks up keeps a share of the value, so the bounds of its subtree stay finite
+    sure = [1.0] * run.LAYOUT.num_cards
+    assert 0 <= Searcher(run.LAYOUT, uniform, sure, feed_penalty=0.99).best_move(state, max_depth=2).value <= 1
+    with pytest.raises(AssertionError):
+        Searcher(run.LAYOUT, uniform, sure, feed_penalty=1)
+    # iterative deepening stops at the time budget, with the transposition table reused across depths
+    hand = [(1,'A'), (2,'B'), (3,'C'), (5,'D'), (6,'A'), (7,'B'), (8,'C'), (9,'D'), (4,'A'), (2,'D')]
+    searcher = Searcher(run.LAYOUT, uniform, uniform)
+    result = searcher.best_move(searcher.state(hand, (6,'B'), []), seconds=0.5)
+    assert 1 <= result.depth < 4 and 0 < result.value < 1 # four turns take about a minute, far over the budget
+    complete = Searcher(run.LAYOUT, uniform, uniform).best_move(searcher.state(hand, (6,'B'), []), max_depth=result.depth)
+    assert result.values == complete.values and result.nodes == complete.nodes # the last depth is kept only if it completed
+    # searching the same state again finds its subtrees in the transposition table
+    searcher = Searcher(run.LAYOUT, uniform, uniform)
+    first = searcher.best_move(searcher.state(hand, (6,'B'), []), max_depth=2)
+    again = searcher.best_move(searcher.state(hand, (6,'B'), []), max_depth=2)
+    assert again.tt_hits > first.tt_hits and again.values == first.values
+    # the move of run.lookahead is one of the moves of evaluate_moves
+    run.initial_game()
+    session = run.InferenceSession(run.LAYOUT.cards)
+    session.observe_history([(7,'B')], [(1,'C')], [(8,'A'), (3,'B')])
+    player_cards = [(1,'A'), (2,'A'), (3,'A'), (5,'B'), (5,'C'), (7,'D'), (8,'D'), (9,'A'), (4,'C'), (2,'D')]
+    best = run.lookahead(session, player_cards, (6,'D'), [(1,'C')], seconds=0.2)
+    moves = run.evaluate_moves(player_cards, (6,'D'), [(7,'B')], [(1,'C')], [(8,'A'), (3,'B')])
+    assert best.action in moves
+
+def test_replay():
+    import replay
+    events = [json.dumps(event) for event in replay.record_events(2, 4)]
+    game = run.Game(2)
+    pickup, not_pickup, discards = [], [], []
+    for _ in range(4):
+        (picked, card), discard = game.play_round()
+        (pickup if picked else not_pickup).append(card)
+        discards.append(discard)
+    # the game state is rebuilt from the log: the checkpoint at round 4 is the state of the game after 4 rounds
+    (checkpoint,) = replay.checkpoints(replay.read_events(events), every=4)
+    assert checkpoint['id'] == [2, 4] and checkpoint['face_up'] == game.discard_pile_top_card
+    assert sorted(checkpoint['player_cards']) == sorted(game.player_cards)
+    assert sorted(checkpoint['opponent_cards']) == sorted(game.opponent_cards)
+    assert (checkpoint['opp_pickup'], checkpoint['opp_not_pickup'], checkpoint['opp_discard']) == (pickup, not_pickup, discards)
+    assert checkpoint['counts'] == [len(game.player_cards), run.NUM_OF_CARDS, len(game.deck) - game.deck_index]
+    # without the opponent's cards in the log there is nothing to score the guesses against
+    hidden = [dict(event, card=None) if event.get('who') == 'opponent' and event['type'] == 'draw' else event
+              for event in replay.read_events(events) if event['type'] != 'deal']
+    deal = dict(next(replay.read_events(events)))
+    del deal['opponent_cards']
+    requests = list(replay.checkpoints([deal] + hidden, every=2))
+    assert [request['id'] for request in requests] == [[2, 2], [2, 4]] and requests[1]['opponent_cards'] is None
+    # results come back in order, and the log is read no further ahead than the window of checkpoints in flight
+    read = []
+    def stream():
+        for request in requests + [checkpoint]:
+            read.append(request['id'])
+            yield request
+    results = replay.replay(stream(), workers=1, window=2)
+    first = next(results)
+    assert len(read) == 2
+    results = [first] + list(results)
+    assert [(result['game'], result['round']) for result in results] == [(2, 2), (2, 4), (2, 4)]
+    assert results[0]['correct'] is None and results[2]['correct'] is not None
+    assert results[2]['model_counts'] == server.advise(checkpoint)['model_counts']
+
+def test_multi_opponent():
+    import multiplayer
+    assert run.seat_name(2, run.Opponent(3, 'A')) is run.Opponent_at(2, 3, 'A')
+    assert run.seat_name(2, run.Deck(3, 'A')) is run.Deck(3, 'A')
+    assert run.seat_name(1, run.Opp_pick(3, 'A')) != run.seat_name(2, run.Opp_pick(3, 'A'))
+    game = multiplayer.MultiGame(0, opponents=2)
+    for _ in range(2):
+        assert game.play_round()
+    hands = [card for hand in game.hands for card in hand]
+    assert len(hands) == len(set(hands)) and not set(hands) & set(game.dumped)
+    requests = [game.seat_request(seat) for seat in (1, 2)]
+    assert requests[0]['counts'][2] == len(game.deck) - game.deck_index + len(game.hands[2])
+    # each seat is inferred on its own, the same in worker processes, with the seat's hand size
+    results = multiplayer.infer_seats(requests)
+    assert multiplayer.infer_seats(requests, workers=2) == results
+    for request, result in zip(requests, results):
+        assert result['model_count'] > 0
+        assert abs(sum(result['probabilities']) - request['counts'][1]) < 1e-6
+    # the wanted card seat 2 passed on went to the dump, which its observations tell: the player knows it cannot draw it
+    session = run.InferenceSession(run.LAYOUT.cards)
+    session.observe_history(*requests[1]['observations'])
+    assert session.dumped & set(meld_list_generator(requests[1]['player_cards'])[2])
+    assert session.estimate(requests[1]['player_cards']).model_count > 0
+    session.observe_known(requests[1]['dumped'], requests[1]['elsewhere'])
+    assert session.estimate(requests[1]['player_cards']).model_count > 0
+    # the joint theory places every card once, the seats in their own families
+    model = multiplayer.joint_model(game)
+    assert model is not None
+    placed = [card for cards in model.values() for card in cards] + game.hands[0]
+    assert len(placed) == len(set(placed))
+
 def file_checks(stage):
     proofs_jp = os.path.isfile(os.path.join('.','documents',stage,'proofs.jp'))
     modelling_report_docx = os.path.isfile(os.path.join('.','documents',stage,'modelling_report.docx'))
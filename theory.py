@@ -0,0 +1,63 @@
+import nnf
+from itertools import combinations
+
+class TheoryBuilder:
+    '''
+    Stores the constraints of one game state, keyed by their canonical nnf form so that a constraint is only added once.
+    fork() returns a copy-on-write snapshot: the constraints added so far become a frozen layer shared by the parent and
+    the child, and each of them keeps adding to its own layer afterwards (e.g. the "pick up" and "don't pick up" theories).
+    '''
+    def __init__(self):
+        self._layers = () # frozen layers shared with forks, each a dict {canonical constraint: None}
+        self._own = {} # constraints added since the last fork, insertion ordered
+
+    @staticmethod
+    def canonical(constraint) -> nnf.NNF:
+        '''Converts a bauhaus constraint or a proposition into its nnf form. nnf And/Or are frozensets, so equal constraints compare equal.'''
+        if isinstance(constraint, nnf.NNF):
+            return constraint
+        if hasattr(constraint, '_var') and not hasattr(constraint, 'typ'): # a bare proposition
+            return constraint._var
+        return constraint.compile()
+
+    def __contains__(self, constraint) -> bool:
+        key = self.canonical(constraint)
+        return key in self._own or any(key in layer for layer in self._layers)
+
+    def __len__(self) -> int:
+        return len(self._own) + sum(len(layer) for layer in self._layers)
+
+    def __iter__(self):
+        for layer in self._layers:
+            yield from layer
+        yield from self._own
+
+    def add_constraint(self, constraint) -> bool:
+        '''Adds the constraint unless an identical one is already stored. Returns True if it was added.'''
+        key = self.canonical(constraint)
+        if key in self._own or any(key in layer for layer in self._layers):
+            return False
+        self._own[key] = None
+        return True
+
+    def add_exactly_one(self, *props) -> None:
+        '''Same theory as bauhaus' constraint.add_exactly_one: at least one of props is true and no two are true together.'''
+        lits = [self.canonical(p) for p in props]
+        self.add_constraint(nnf.Or(lits))
+        for a, b in combinations(lits, 2):
+            self.add_constraint(nnf.Or([a.negate(), b.negate()]))
+
+    def fork(self) -> 'TheoryBuilder':
+        '''Returns a snapshot that shares every constraint added so far without copying them.'''
+        if self._own:
+            self._layers = self._layers + (self._own,)
+            self._own = {}
+        child = TheoryBuilder()
+        child._layers = self._layers
+        return child
+
+    def compile(self) -> nnf.NNF:
+        '''Returns the theory as the conjunction of the stored constraints, like Encoding.compile() for custom constraints.'''
+        if len(self) == 0:
+            raise ValueError("The theory has no constraints.")
+        return nnf.And(list(self))